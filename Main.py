@@ -1,259 +1,227 @@
 # main.py
+import time
+# Mốc thời gian sớm nhất để đo thời gian import khi chạy với --startup-time
+_STARTED = time.perf_counter()
+
 import sys
 import os
-from dotenv import load_dotenv
-import time
 import shutil
 import threading
-import google.generativeai as genai
-from PIL import Image
+import importlib
 
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QLabel, QPushButton, 
                             QVBoxLayout, QHBoxLayout, QWidget, QFileDialog, 
                             QTextEdit, QProgressBar, QMessageBox, QInputDialog, QLineEdit,
-                            QFrame, QSizePolicy, QScrollArea, QGridLayout)
+                            QFrame, QSizePolicy, QCheckBox, QSpinBox, QComboBox)
 from PyQt6.QtGui import QPixmap, QFont
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QTimer
+from PyQt6.QtCore import Qt, QThread, QObject, QEvent, pyqtSignal, QTimer
+
+from tryon_engine import (UPLOAD_FOLDER, OUTPUT_FOLDER, DEFAULT_PROMPT, TryOnEngine, TryOnJob,
+                          GeminiBackend, JobCancelled)
+from rate_limiter import AdaptiveRateLimiter
+from key_pool import ApiKeyPool, read_api_keys
+from image_prep import ImagePreparer
+from result_cache import ResultCache
+from results_store import ResultStore, DEFAULT_MAX_BYTES as RESULTS_MAX_BYTES
+from job_queue import JobQueue, new_batch_id, DONE, FAILED
+from worker_pool import WorkerPool, FirstKBatch
+from thumbnails import ThumbnailLoader
+from results_view import ResultsModel, ResultsView
+from telemetry import Telemetry, MetricsRegistry
+from hedging import HedgePolicy
+from exporter import ExportJob, export_zip, export_folder, render_contact_sheet, DEFAULT_QUALITY as EXPORT_QUALITY
+from sweep import load_spec, plan_sweep
+
+_IMPORTED = time.perf_counter()
+
+# Số biến thể mặc định và tối đa của một lần tạo ảnh
+DEFAULT_VARIANTS = 10
+MAX_VARIANTS = 500
+# Chế độ "K ảnh tốt đầu tiên": số request chạy thêm ngoài K để bù cho request lỗi
+FIRST_K_EXTRA = 1
 
-# Thư mục để lưu ảnh kết quả
-UPLOAD_FOLDER = 'uploads'
-OUTPUT_FOLDER = 'results'
+# Các thư viện nặng chỉ cần khi tạo ảnh, được import ở luồng nền sau khi cửa sổ đã hiện
+PRELOAD_MODULES = ('google.generativeai', 'PIL.Image')
+
+def preload_heavy_modules():
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"Không thể import trước {name}: {str(e)}")
 
 # Đảm bảo các thư mục tồn tại
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-def read_api_key_from_file(file_path='api_key.txt'):
-    """Đọc API key từ file api_key.txt"""
-    try:
-        with open(file_path, 'r') as file:
-            api_key = file.read().strip()
-            return api_key if api_key else None
-    except FileNotFoundError:
-        print(f"Không tìm thấy file {file_path}")
-        return None
-    except Exception as e:
-        print(f"Lỗi khi đọc file API key: {str(e)}")
-        return None
-
 class GeminiThread(QThread):
     """
-    Lớp xử lý luồng riêng để gọi API Gemini mà không làm đơ giao diện
+    Lớp xử lý luồng riêng để gọi API Gemini mà không làm đơ giao diện.
+    Toàn bộ logic sinh ảnh nằm trong TryOnEngine, thread này chỉ chuyển tiếp tín hiệu.
+    Giao diện chính dùng WorkerPool; lớp này giữ lại cho code cần chạy một job trong QThread.
     """
     finished_signal = pyqtSignal(bool, str, int)  # Thêm int để theo dõi thứ tự kết quả
     progress_signal = pyqtSignal(int, int)  # progress, thread_id
     
-    def __init__(self, person_image_path, clothing_image_path, prompt, thread_id, api_key=None):
+    def __init__(self, person_image_path, clothing_image_path, prompt, thread_id, api_key=None, engine=None,
+                 job_id=None):
         super().__init__()
         self.person_image_path = person_image_path
         self.clothing_image_path = clothing_image_path
         self.prompt = prompt
         self.thread_id = thread_id
         self.api_key = api_key
+        self.engine = engine or TryOnEngine(GeminiBackend(api_key))
+        self.job_id = job_id
         self.is_cancelled = False
         
     def run(self):
-        try:
-            if self.is_cancelled:
-                return
-                
-            if not self.api_key:
-                raise Exception("Không tìm thấy API key")
-            
-            # Báo hiệu tiến trình
-            self.progress_signal.emit(10, self.thread_id)
-            
-            # Cấu hình API Gemini
-            genai.configure(api_key=self.api_key)
-            
-            # Tải ảnh
-            if self.is_cancelled:
-                return
-            self.progress_signal.emit(30, self.thread_id)
-            
-            # Mở ảnh bằng Pillow để đảm bảo tương thích với thư viện
-            person_img = Image.open(self.person_image_path)
-            clothing_img = Image.open(self.clothing_image_path)
-            
-            if self.is_cancelled:
-                return
-            self.progress_signal.emit(50, self.thread_id)
-            
-            # Khởi tạo mô hình Gemini
-            model = genai.GenerativeModel("gemini-2.0-flash-exp-image-generation")
-            
-            if self.is_cancelled:
-                return
-            self.progress_signal.emit(60, self.thread_id)
-            
-            # Tạo biến thể khác nhau cho mỗi kết quả
-            temperature = 0.4 + (self.thread_id * 0.05)  # Tăng dần độ sáng tạo
-            
-            # Cấu hình generation với nhiệt độ biến đổi theo thread_id
-            generation_config = {
-                "response_modalities": ["TEXT", "IMAGE"],
-                "temperature": temperature,
-                "top_k": 32,
-                "top_p": 1,
-                "max_output_tokens": 2048,
-            }
-            
-            # Đợi 2 giây trước khi gọi API để tạo khoảng cách giữa các request
-            for i in range(20):  # 2 giây, kiểm tra mỗi 0.1 giây
-                if self.is_cancelled:
-                    return
-                time.sleep(0.1)
-            
-            if self.is_cancelled:
-                return
-                
-            # Tạo yêu cầu API với prompt và ảnh
-            response = model.generate_content(
-                [self.prompt, person_img, clothing_img],
-                generation_config=generation_config
-            )
-            
-            if self.is_cancelled:
-                return
-            self.progress_signal.emit(80, self.thread_id)
-            
-            # Kiểm tra xem có ảnh trong phản hồi không
-            result_image_path = None
-            
-            # Kiểm tra các phần trong phản hồi
-            print(f"Xử lý phản hồi từ API cho kết quả {self.thread_id + 1}")
+        if self.is_cancelled:
+            return
             
-            for part in response.candidates[0].content.parts:
-                if self.is_cancelled:
-                    return
-                    
-                # Kiểm tra nếu phần này là text
-                if hasattr(part, 'text') and part.text:
-                    print(f"Phản hồi văn bản từ API (kết quả {self.thread_id + 1}):", part.text)
-                
-                # Kiểm tra nếu phần này là hình ảnh
-                if hasattr(part, 'inline_data'):
-                    print(f"Tìm thấy dữ liệu hình ảnh cho kết quả {self.thread_id + 1}")
-                    
-                    # Lưu ảnh kết quả
-                    result_image_path = os.path.join(OUTPUT_FOLDER, f"result_{self.thread_id}_{int(time.time())}.png")
-                    with open(result_image_path, "wb") as f:
-                        f.write(part.inline_data.data)
-                        
-                    print(f"Đã lưu ảnh kết quả {self.thread_id + 1} tại: {result_image_path}")
-                    break
+        job = TryOnJob(self.person_image_path, self.clothing_image_path, self.prompt, self.thread_id,
+                       job_id=self.job_id)
+        try:
+            result = self.engine.generate(job, self.progress_signal.emit, lambda: self.is_cancelled)
+        except JobCancelled:
+            return
             
-            if result_image_path and not self.is_cancelled:
-                self.progress_signal.emit(100, self.thread_id)
-                self.finished_signal.emit(True, result_image_path, self.thread_id)
-            elif not self.is_cancelled:
-                raise Exception(f"API không trả về ảnh kết quả nào cho kết quả {self.thread_id + 1}")
-                
-        except Exception as e:
-            if not self.is_cancelled:
-                import traceback
-                traceback.print_exc()
-                self.finished_signal.emit(False, str(e), self.thread_id)
+        if not self.is_cancelled:
+            self.finished_signal.emit(result.success, result.message, self.thread_id)
     
     def cancel(self):
         """Đánh dấu thread này đã bị hủy"""
         self.is_cancelled = True
 
-class ResultWidget(QWidget):
+class BatchSignals(QObject):
     """
-    Widget hiển thị một kết quả thử đồ
+    Tín hiệu của một lô chạy trên WorkerPool. Mỗi lô có một đối tượng riêng để
+    kết quả đến muộn của lô đã hủy không ghi đè lên lô mới.
     """
-    def __init__(self, id, parent=None):
-        super().__init__(parent)
-        self.id = id
-        self.result_image_path = None
-        self.initUI()
-        
-    def initUI(self):
-        layout = QVBoxLayout(self)
-        
-        # Tiêu đề
-        title = QLabel(f"Phiên bản {self.id + 1}")
-        title.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        title.setStyleSheet("font-size: 14pt; font-weight: bold;")
-        
-        # Khung ảnh kết quả
-        self.image_frame = QFrame()
-        self.image_frame.setFrameShape(QFrame.Shape.StyledPanel)
-        self.image_frame.setFrameShadow(QFrame.Shadow.Sunken)
-        self.image_frame.setStyleSheet("background-color: #f5f5f5;")
-        self.image_frame.setMinimumSize(250, 350)
-        
-        frame_layout = QVBoxLayout(self.image_frame)
-        
-        self.image_label = QLabel()
-        self.image_label.setMinimumSize(220, 320)
-        self.image_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.image_label.setText("Đang xử lý...")
-        
-        frame_layout.addWidget(self.image_label)
-        
-        # Thanh tiến trình
-        self.progress_bar = QProgressBar()
-        self.progress_bar.setValue(0)
-        
-        # Nút lưu kết quả
-        self.save_btn = QPushButton("Lưu")
-        self.save_btn.setEnabled(False)
-        
-        # Thêm widgets vào layout
-        layout.addWidget(title)
-        layout.addWidget(self.image_frame)
-        layout.addWidget(self.progress_bar)
-        layout.addWidget(self.save_btn)
-        
-    def display_image(self, image_path):
-        """Hiển thị ảnh kết quả"""
-        self.result_image_path = image_path
-        pixmap = QPixmap(image_path)
-        
-        # Giữ tỷ lệ khung hình khi hiển thị
-        pixmap = pixmap.scaled(
-            self.image_label.width(), 
-            self.image_label.height(),
-            Qt.AspectRatioMode.KeepAspectRatio,
-            Qt.TransformationMode.SmoothTransformation
-        )
-        
-        self.image_label.setPixmap(pixmap)
-        self.save_btn.setEnabled(True)
-        
-    def update_progress(self, value):
-        """Cập nhật thanh tiến trình"""
-        self.progress_bar.setValue(value)
-        
-    def save_image(self, parent):
-        """Lưu ảnh kết quả"""
-        if not self.result_image_path:
+    finished_signal = pyqtSignal(bool, str, int, object)  # success, message, thread_id, bytes ảnh
+    progress_signal = pyqtSignal(int, int)  # progress, thread_id
+    submitted_signal = pyqtSignal(int)  # thread_id của job vừa gửi vào pool (chế độ K ảnh tốt đầu tiên)
+    stopped_signal = pyqtSignal(object)  # FirstKBatch đã kết thúc
+    
+    def on_job_done(self, handle):
+        """Được gọi trên luồng của pool khi một job kết thúc"""
+        if handle.cancelled():
             return
-            
-        save_path, _ = QFileDialog.getSaveFileName(
-            parent, 
-            f'Lưu Ảnh Kết Quả {self.id + 1}', 
-            f'thudo_result_{self.id + 1}.png', 
-            'PNG (*.png);;JPEG (*.jpg)'
-        )
-        
-        if save_path:
-            # Sao chép ảnh từ thư mục kết quả sang vị trí mới
-            shutil.copy2(self.result_image_path, save_path)
-            QMessageBox.information(parent, 'Thành công', f'Đã lưu ảnh vào: {save_path}')
+        try:
+            result = handle.result()
+        except Exception as e:
+            self.finished_signal.emit(False, str(e), handle.job.variant_id, None)
+            return
+        # Bytes ảnh được chuyển thẳng cho giao diện, file kết quả vẫn đang được ghi nền
+        self.finished_signal.emit(result.success, result.message, handle.job.variant_id, result.image_data)
+
+class ExportSignals(QObject):
+    """Chuyển tiến độ và kết quả của exporter.ExportJob (chạy ở luồng nền) về luồng giao diện"""
+    progress_signal = pyqtSignal(int, int)  # số ảnh đã xuất, tổng số ảnh
+    finished_signal = pyqtSignal(object)  # ExportJob
+
+class StartupProbe(QObject):
+    """
+    Đo thời gian khởi động (chế độ --startup-time): ghi lại lần vẽ đầu tiên của
+    cửa sổ, in báo cáo rồi thoát ứng dụng.
+    """
+    def __init__(self, app):
+        super().__init__(app)
+        self.app = app
+        self.marks = [("import", _IMPORTED)]
+        self.painted = False
+        app.installEventFilter(self)
+        
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+        
+    def eventFilter(self, obj, event):
+        if not self.painted and event.type() == QEvent.Type.Paint:
+            self.painted = True
+            self.mark("first_paint")
+            QTimer.singleShot(0, self.report)
+        return False
+        
+    def report(self):
+        last = _STARTED
+        parts = []
+        for name, mark in self.marks:
+            parts.append(f"{name} {(mark - last) * 1000:.0f} ms")
+            last = mark
+        print(f"Khởi động: {', '.join(parts)} - cửa sổ hiện sau {(last - _STARTED) * 1000:.0f} ms kể từ khi chạy Main.py")
+        try:
+            import psutil
+            # Gồm cả thời gian khởi động Python và giải nén của bản EXE
+            since_process = time.time() - psutil.Process().create_time()
+            print(f"Kể từ khi tiến trình bắt đầu: {since_process * 1000:.0f} ms")
+        except ImportError:
+            pass
+        self.app.quit()
 
 class DuyThuDoApp(QMainWindow):
-    def __init__(self):
+    def __init__(self, measure_startup=False):
         super().__init__()
         self.person_image_path = None
         self.clothing_image_path = None
-        self.result_widgets = []
-        self.gemini_threads = []
-        self.scheduled_timers = []  # Lưu trữ các QTimer đã đặt lịch
+        # Nhiều key trong api_key.txt (mỗi dòng một key) hoặc GEMINI_API_KEYS: request
+        # được chia cho các key, mỗi key có quota riêng nên chạy được nhiều job hơn
+        api_keys = read_api_keys()
+        # Pool worker dùng lâu dài, các lô chỉ gửi job vào pool thay vì tạo thread mới
+        self.worker_pool = WorkerPool(max_workers=10 * max(1, len(api_keys)))
+        self.job_handles = []
+        self.first_k_batch = None
+        self.batch_signals = None
+        self.pending_jobs = 0
+        self.engine = None
+        self.engine_api_key = None
+        # Limiter dùng chung giữa các lần tạo ảnh để giữ tốc độ đã học được
+        self.rate_limiter = ApiKeyPool(api_keys) if len(api_keys) > 1 else AdaptiveRateLimiter()
+        # Gửi request dự phòng cho biến thể chậm bất thường (tối đa 10% số request), bật/tắt bằng checkbox
+        self.hedge_policy = HedgePolicy(enabled=False)
+        # Thời gian từng bước: TRYON_TRACE=<file.jsonl> ghi trace, TRYON_METRICS_PORT=<cổng> mở /metrics
+        self.telemetry = None
+        if os.environ.get('TRYON_TRACE') or os.environ.get('TRYON_METRICS_PORT'):
+            registry = MetricsRegistry(rate_limiter=self.rate_limiter, hedge_policy=self.hedge_policy)
+            self.telemetry = Telemetry(os.environ.get('TRYON_TRACE'), registry)
+            if os.environ.get('TRYON_METRICS_PORT'):
+                self.telemetry.registry.serve(int(os.environ['TRYON_METRICS_PORT']))
+        # Cache ảnh đầu vào đã chuẩn bị, dùng lại giữa các lần tạo ảnh
+        self.image_preparer = ImagePreparer()
+        # Cache kết quả theo đầu vào, prompt và cấu hình để không trả tiền cho cùng một yêu cầu
+        self.result_cache = ResultCache()
+        # Kho kết quả: thư mục chia shard, chỉ mục theo đầu vào và dọn nền khi vượt
+        # ngân sách dung lượng (TRYON_RESULTS_MAX_GB, mặc định 2 GB)
+        max_gb = os.environ.get('TRYON_RESULTS_MAX_GB')
+        self.result_store = ResultStore(
+            OUTPUT_FOLDER, max_bytes=int(float(max_gb) * 1024 ** 3) if max_gb else RESULTS_MAX_BYTES)
+        self.result_store.start_evictor()
+        # Hàng đợi bền vững: lô đang chạy được ghi lại để chạy tiếp nếu ứng dụng bị tắt giữa chừng
+        self.job_queue = JobQueue()
+        self.batch_id = None
+        self.batch_job_ids = {}  # thread_id -> id của job trong hàng đợi
+        # Thumbnail được giải mã ở luồng nền và cache theo hash file + kích thước.
+        # Lưới kết quả tự giữ pixmap các ô đang hiển thị nên cache QImage ở đây chỉ cần nhỏ
+        self.thumbnail_loader = ThumbnailLoader(self, memory_items=64)
+        self.results_model = ResultsModel(self.thumbnail_loader, self)
+        self.label_images = {}
+        # Việc xuất hàng loạt (ZIP, thư mục, contact sheet) đang chạy ở luồng nền, nếu có
+        self.export_job = None
+        self.export_progress = (0, 0)
         self.init_ui()
         
+        # Hiển thị tốc độ gửi request hiện tại cho người dùng
+        self.rate_timer = QTimer(self)
+        self.rate_timer.timeout.connect(self.update_rate_status)
+        self.rate_timer.start(1000)
+        self.update_rate_status()
+        
+        # Kiểm tra lô chưa xong của lần chạy trước sau khi cửa sổ hiện lên
+        # (không hỏi khi chỉ đo thời gian khởi động)
+        if not measure_startup:
+            QTimer.singleShot(0, self.resume_unfinished_batch)
+        # Khi giao diện rảnh, khởi động trước client API để lô đầu tiên không phải chờ kết nối
+        QTimer.singleShot(0, self.warm_up_engine)
+        
     def init_ui(self):
         # Thiết lập cửa sổ chính
         self.setWindowTitle('nguyên Liệu làm hoạt hình 2D tại hoathinh2d.com')
@@ -334,47 +302,86 @@ class DuyThuDoApp(QMainWindow):
         
         self.prompt_text = QTextEdit()
         self.prompt_text.setPlaceholderText('Nhập hướng dẫn thêm cho AI (ví dụ: Làm cho trông thật hơn, phong cách đô thị, v.v.)')
-        self.prompt_text.setText('Generate a high-quality virtual try-on image showing the person wearing the clothing from the second image. Preserve all facial features, hairstyle, skin tone, body proportions, pose, and background.')
+        self.prompt_text.setText(DEFAULT_PROMPT)
         self.prompt_text.setMaximumHeight(100)
         
+        # Số biến thể cần tạo
+        variants_layout = QHBoxLayout()
+        variants_label = QLabel('Số ảnh cần tạo:')
+        self.variants_spin = QSpinBox()
+        self.variants_spin.setRange(1, MAX_VARIANTS)
+        self.variants_spin.setValue(DEFAULT_VARIANTS)
+        variants_layout.addWidget(variants_label)
+        variants_layout.addWidget(self.variants_spin)
+
+        # Chế độ dừng sớm: chỉ cần K ảnh tốt, "Số ảnh cần tạo" là số lần thử tối đa
+        first_k_layout = QHBoxLayout()
+        self.first_k_checkbox = QCheckBox('Dừng khi đủ số ảnh tốt:')
+        self.first_k_spin = QSpinBox()
+        self.first_k_spin.setRange(1, MAX_VARIANTS)
+        self.first_k_spin.setValue(3)
+        self.first_k_spin.setEnabled(False)
+        self.first_k_checkbox.toggled.connect(self.first_k_spin.setEnabled)
+        first_k_layout.addWidget(self.first_k_checkbox)
+        first_k_layout.addWidget(self.first_k_spin)
+        
         # Nút tạo ảnh
-        self.generate_btn = QPushButton('Tạo 10 Ảnh Thử Đồ')
+        self.generate_btn = QPushButton('Tạo Ảnh Thử Đồ')
         self.generate_btn.setStyleSheet('font-size: 16pt; padding: 15px; background-color: #4CAF50; color: white;')
         self.generate_btn.clicked.connect(self.generate_images)
+
+        # Sweep theo file spec JSON (xem sweep.py) thay cho dải nhiệt độ mặc định
+        self.sweep_btn = QPushButton('Sweep theo spec...')
+        self.sweep_btn.clicked.connect(self.generate_sweep)
+        
+        # Tùy chọn bỏ qua cache kết quả
+        self.force_regenerate_checkbox = QCheckBox('Tạo lại (bỏ qua kết quả đã lưu)')
+
+        # Tùy chọn gửi request dự phòng khi một biến thể chậm hơn thường lệ
+        self.hedge_checkbox = QCheckBox('Gửi dự phòng khi chậm (tốn thêm tối đa 10% request)')
+        self.hedge_checkbox.toggled.connect(self.set_hedging)
         
         # Thêm các widget vào layout bên trái
         left_layout.addWidget(person_frame)
         left_layout.addWidget(clothing_frame)
         left_layout.addWidget(prompt_label)
         left_layout.addWidget(self.prompt_text)
+        left_layout.addLayout(variants_layout)
+        left_layout.addLayout(first_k_layout)
+        left_layout.addWidget(self.force_regenerate_checkbox)
+        left_layout.addWidget(self.hedge_checkbox)
         left_layout.addWidget(self.generate_btn)
+        left_layout.addWidget(self.sweep_btn)
         left_layout.addStretch()
         
         # Panel bên phải - Hiển thị kết quả
         right_panel = QWidget()
         
-        # Tạo scroll area để cuộn
-        scroll_area = QScrollArea()
-        scroll_area.setWidgetResizable(True)
-        
-        results_container = QWidget()
-        self.results_layout = QGridLayout(results_container)
-        
-        # Tạo 10 widget kết quả
-        NUM_RESULTS = 10
-        COLS = 3  # Số cột hiển thị
+        # Lưới kết quả ảo hóa: chỉ các ô đang hiển thị mới được vẽ và giữ ảnh trong bộ nhớ
+        self.results_view = ResultsView()
+        self.results_view.setModel(self.results_model)
+        self.results_view.doubleClicked.connect(lambda index: self.save_result(index.row()))
         
-        for i in range(NUM_RESULTS):
-            result_widget = ResultWidget(i)
-            row = i // COLS
-            col = i % COLS
-            self.results_layout.addWidget(result_widget, row, col)
-            self.result_widgets.append(result_widget)
-            
-            # Kết nối nút lưu
-            result_widget.save_btn.clicked.connect(lambda checked=False, idx=i: self.result_widgets[idx].save_image(self))
-        
-        scroll_area.setWidget(results_container)
+        # Nút lưu các ảnh đang chọn (nhấp đúp vào ảnh để lưu nhanh)
+        self.save_btn = QPushButton('Lưu ảnh đã chọn')
+        self.save_btn.clicked.connect(self.save_selected_results)
+
+        # Xuất cả lô ra ZIP hoặc contact sheet ở luồng nền, có thể nén lại ảnh
+        export_layout = QHBoxLayout()
+        self.export_format_combo = QComboBox()
+        self.export_format_combo.addItem('PNG gốc', None)
+        self.export_format_combo.addItem('JPEG', 'jpeg')
+        self.export_format_combo.addItem('WebP', 'webp')
+        self.export_quality_spin = QSpinBox()
+        self.export_quality_spin.setRange(50, 100)
+        self.export_quality_spin.setValue(EXPORT_QUALITY)
+        self.export_quality_spin.setPrefix('Chất lượng: ')
+        self.export_btn = QPushButton('Xuất cả lô...')
+        self.export_btn.clicked.connect(self.export_batch)
+        export_layout.addWidget(self.save_btn)
+        export_layout.addWidget(self.export_format_combo)
+        export_layout.addWidget(self.export_quality_spin)
+        export_layout.addWidget(self.export_btn)
         
         # Layout cho panel bên phải
         right_layout = QVBoxLayout(right_panel)
@@ -385,7 +392,8 @@ class DuyThuDoApp(QMainWindow):
         result_title.setStyleSheet('font-size: 16pt; font-weight: bold;')
         
         right_layout.addWidget(result_title)
-        right_layout.addWidget(scroll_area)
+        right_layout.addWidget(self.results_view)
+        right_layout.addLayout(export_layout)
         
         # Thêm các panel vào layout chính
         main_layout.addWidget(left_panel)
@@ -415,46 +423,62 @@ class DuyThuDoApp(QMainWindow):
             self.display_image(self.clothing_image_label, file_path)
             
     def display_image(self, label, image_path):
-        """Hiển thị ảnh được chọn trong QLabel"""
-        pixmap = QPixmap(image_path)
-        
-        # Giữ tỷ lệ khung hình khi hiển thị
-        pixmap = pixmap.scaled(
-            label.width(), label.height(),
-            Qt.AspectRatioMode.KeepAspectRatio,
-            Qt.TransformationMode.SmoothTransformation
-        )
+        """Hiển thị ảnh được chọn trong QLabel (giải mã và thu nhỏ ở luồng nền)"""
+        # Ghi nhớ ảnh mới nhất của label để bỏ qua thumbnail đến muộn của ảnh cũ
+        self.label_images[label] = image_path
         
-        label.setPixmap(pixmap)
+        def show(path, image):
+            if self.label_images.get(label) != path:
+                return
+            if image.isNull():
+                label.setText('Không thể hiển thị ảnh')
+                return
+            label.setPixmap(QPixmap.fromImage(image))
+            
+        self.thumbnail_loader.load(image_path, label.width(), label.height(), show)
+
+    def update_rate_status(self):
+        """Cập nhật thanh trạng thái với tốc độ gửi request hiện tại"""
+        stats = self.rate_limiter.stats()
+        message = f"Tốc độ gửi: {stats['rate']:.2f} request/giây"
+        if 'keys' in stats:
+            message += f" - {stats['active_keys']}/{len(stats['keys'])} API key đang hoạt động"
+        if stats['paused_for'] > 0:
+            message += f" - đang chờ quota {stats['paused_for']:.0f} giây"
+        hedge_stats = self.hedge_policy.stats()
+        if hedge_stats['hedges']:
+            message += (f" - dự phòng {hedge_stats['hedges']} request ({hedge_stats['hedge_rate']:.0%}), "
+                        f"{hedge_stats['hedge_wins']} lần xong trước")
+        if self.export_job is not None:
+            message += f" - đang xuất {self.export_progress[0]}/{self.export_progress[1]} ảnh"
+        self.statusBar().showMessage(message)
+
+    def set_hedging(self, enabled):
+        """Bật/tắt request dự phòng; có hiệu lực ngay với các biến thể đang chờ gửi"""
+        self.hedge_policy.enabled = enabled
 
     def cancel_running_threads(self):
-        """Hủy tất cả các thread đang chạy và các timer đã đặt lịch"""
-        # Hủy tất cả các thread đang chạy
-        for thread in self.gemini_threads:
-            if thread.isRunning():
-                print(f"Đang hủy thread {thread.thread_id + 1}...")
-                thread.cancel()
-                thread.wait(1000)  # Đợi tối đa 1 giây cho thread kết thúc
-                
-        # Hủy tất cả các timer đã đặt lịch
-        for timer in self.scheduled_timers:
-            if timer.isActive():
-                timer.stop()
+        """Hủy tất cả các job đang chạy của lô hiện tại (không chặn giao diện)"""
+        for handle in self.job_handles:
+            if handle.cancel():
+                print(f"Đã hủy kết quả {handle.job.variant_id + 1}")
                 
-        self.gemini_threads.clear()
-        self.scheduled_timers.clear()
-            
-    def generate_images(self):
-        """Xử lý tạo nhiều ảnh kết quả"""
-        # Hủy các thread đang chạy (nếu có)
-        self.cancel_running_threads()
-        
-        if not self.person_image_path or not self.clothing_image_path:
-            QMessageBox.warning(self, 'Cảnh báo', 'Vui lòng chọn cả ảnh người và ảnh quần áo!')
-            return
+        self.job_handles.clear()
+        if self.first_k_batch is not None:
+            self.first_k_batch.cancel()
+            self.first_k_batch = None
+        self.batch_signals = None
+        self.pending_jobs = 0
+        
+        # Các job chưa xong của lô cũ không cần chạy lại nữa
+        if self.batch_id:
+            self.job_queue.cancel_batch(self.batch_id)
+            self.batch_id = None
             
-        # Đọc API key từ file
-        api_key = read_api_key_from_file()
+    def get_api_key(self):
+        """Đọc API key từ file, hoặc hỏi người dùng nếu chưa có"""
+        api_keys = read_api_keys()
+        api_key = api_keys[0] if api_keys else None
         
         # Kiểm tra API key
         if not api_key:
@@ -466,7 +490,7 @@ class DuyThuDoApp(QMainWindow):
             )
             if not ok or not api_key:
                 QMessageBox.critical(self, 'Lỗi', 'Không thể tiếp tục mà không có API key!')
-                return
+                return None
             
             # Lưu API key vào file cho lần sau
             try:
@@ -475,78 +499,383 @@ class DuyThuDoApp(QMainWindow):
                 print("Đã lưu API key vào file api_key.txt")
             except Exception as e:
                 print(f"Không thể lưu API key vào file: {str(e)}")
+        return api_key
+            
+    def resume_unfinished_batch(self):
+        """Chạy tiếp lô còn dở của lần trước (ứng dụng bị tắt hoặc lỗi giữa chừng)"""
+        self.job_queue.recover()
+        batch_id = self.job_queue.latest_unfinished_batch('gui-')
+        if not batch_id:
+            return
+            
+        rows = self.job_queue.batch_jobs(batch_id)
+        unfinished = [row for row in rows if row['state'] not in (DONE, FAILED)]
+        answer = QMessageBox.question(
+            self, 'Tiếp tục lô trước',
+            f'Lần trước còn {len(unfinished)} ảnh chưa tạo xong. Bạn có muốn tiếp tục không?'
+        )
+        if answer != QMessageBox.StandardButton.Yes:
+            self.job_queue.cancel_batch(batch_id)
+            return
+            
+        api_key = self.get_api_key()
+        if not api_key:
+            return
+            
+        # Khôi phục ảnh đầu vào, prompt và các kết quả đã xong
+        first = rows[0]
+        self.person_image_path = first['person_image_path']
+        self.clothing_image_path = first['clothing_image_path']
+        self.display_image(self.person_image_label, self.person_image_path)
+        self.display_image(self.clothing_image_label, self.clothing_image_path)
+        self.prompt_text.setText(first['prompt'])
+        count = max(row['variant_id'] for row in rows) + 1
+        self.variants_spin.setValue(min(count, MAX_VARIANTS))
+        self.reset_results(count)
+        
+        for row in rows:
+            if row['state'] == DONE and row['result_path'] and os.path.exists(row['result_path']):
+                self.results_model.set_result(row['variant_id'], row['result_path'])
+            elif row['state'] == FAILED:
+                self.results_model.set_error(row['variant_id'], row['message'])
+                
+        self.batch_id = batch_id
+        jobs = [JobQueue.row_to_job(row) for row in unfinished]
+        self.run_jobs(jobs, api_key)
+            
+    def reset_results(self, count):
+        """Tạo lại lưới kết quả với count ô ở trạng thái đang xử lý"""
+        self.results_model.reset(count)
+        
+    def save_result(self, variant_id):
+        """Lưu ảnh kết quả của một biến thể"""
+        image_path = self.results_model.image_path(variant_id)
+        if not image_path:
+            return
+            
+        save_path, _ = QFileDialog.getSaveFileName(
+            self, 
+            f'Lưu Ảnh Kết Quả {variant_id + 1}', 
+            f'thudo_result_{variant_id + 1}.png', 
+            'PNG (*.png);;JPEG (*.jpg)'
+        )
+        
+        if save_path:
+            image_data = self.results_model.image_data(variant_id)
+            if image_data is not None:
+                # Ghi thẳng bytes ảnh trong bộ nhớ
+                with open(save_path, 'wb') as f:
+                    f.write(image_data)
+            else:
+                # Sao chép ảnh từ thư mục kết quả sang vị trí mới (chờ file đang ghi nền nếu có)
+                if self.engine is not None:
+                    self.engine.flush()
+                shutil.copy2(image_path, save_path)
+            QMessageBox.information(self, 'Thành công', f'Đã lưu ảnh vào: {save_path}')
+            
+    def save_selected_results(self):
+        """Lưu các ảnh đang chọn: một ảnh thì hỏi tên file, nhiều ảnh thì hỏi thư mục"""
+        rows = sorted(index.row() for index in self.results_view.selectedIndexes())
+        rows = [row for row in rows if self.results_model.image_path(row)]
+        if not rows:
+            QMessageBox.warning(self, 'Cảnh báo', 'Vui lòng chọn ít nhất một ảnh đã tạo xong!')
+            return
+        if len(rows) == 1:
+            self.save_result(rows[0])
+            return
+            
+        folder = QFileDialog.getExistingDirectory(self, 'Chọn thư mục lưu ảnh')
+        if not folder:
+            return
+        # Sao chép ở luồng nền, không chặn giao diện
+        self.start_export(export_folder, self.export_items(rows), folder)
+
+    def export_items(self, rows=None):
+        """(tên file khi xuất, đường dẫn kết quả) của các ô đã có ảnh"""
+        if rows is None:
+            rows = range(self.results_model.rowCount())
+        return [(f'thudo_result_{row + 1}.png', self.results_model.image_path(row))
+                for row in rows if self.results_model.image_path(row)]
+
+    def export_batch(self):
+        """Xuất mọi ảnh đã xong của lô hiện tại ra một file ZIP hoặc một ảnh contact sheet"""
+        items = self.export_items()
+        if not items:
+            QMessageBox.warning(self, 'Cảnh báo', 'Chưa có ảnh nào được tạo xong để xuất!')
+            return
+        save_path, _ = QFileDialog.getSaveFileName(
+            self,
+            'Xuất cả lô',
+            'thudo_results.zip',
+            'ZIP (*.zip);;Contact sheet (*.jpg *.png *.webp)'
+        )
+        if not save_path:
+            return
+        quality = self.export_quality_spin.value()
+        if save_path.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
+            self.start_export(render_contact_sheet, items, save_path, quality=quality)
+        else:
+            self.start_export(export_zip, items, save_path,
+                              export_format=self.export_format_combo.currentData(), quality=quality)
+
+    def start_export(self, export, items, target, **options):
+        """Chạy một việc xuất ở luồng nền; tiến độ hiện trên thanh trạng thái"""
+        if self.export_job is not None:
+            QMessageBox.warning(self, 'Cảnh báo', 'Đang xuất ảnh, vui lòng đợi xong!')
+            return
+        signals = ExportSignals(self)
+        signals.progress_signal.connect(self.export_progressed)
+        signals.finished_signal.connect(self.export_finished)
+        self.export_progress = (0, len(items))
+        self.export_btn.setEnabled(False)
+        self.save_btn.setEnabled(False)
+        # Chờ các file kết quả đang ghi nền ngay trên luồng xuất, không chặn giao diện
+        before = self.engine.flush if self.engine is not None else None
+        self.export_job = ExportJob(export, items, target, progress=signals.progress_signal.emit,
+                                    on_finished=signals.finished_signal.emit, before=before, **options).start()
+        self.update_rate_status()
+
+    def export_progressed(self, done, total):
+        self.export_progress = (done, total)
+        self.update_rate_status()
+
+    def export_finished(self, job):
+        self.export_job = None
+        self.export_btn.setEnabled(True)
+        self.save_btn.setEnabled(True)
+        self.update_rate_status()
+        if job.error is not None:
+            QMessageBox.critical(self, 'Lỗi', f'Không thể xuất ảnh: {str(job.error)}')
+        elif not job.cancelled:
+            QMessageBox.information(self, 'Thành công', f'Đã xuất {job.count} ảnh vào: {job.target}')
+            
+    def generate_images(self):
+        """Xử lý tạo nhiều ảnh kết quả"""
+        # Hủy các thread đang chạy (nếu có)
+        self.cancel_running_threads()
+        
+        if not self.person_image_path or not self.clothing_image_path:
+            QMessageBox.warning(self, 'Cảnh báo', 'Vui lòng chọn cả ảnh người và ảnh quần áo!')
+            return
+            
+        # Đọc API key từ file hoặc hỏi người dùng
+        api_key = self.get_api_key()
+        if not api_key:
+            return
                 
         # Lấy prompt từ người dùng
         prompt = self.prompt_text.toPlainText()
         if not prompt:
-            prompt = "Generate a high-quality virtual try-on image showing the person wearing the clothing from the second image. Preserve all facial features, hairstyle, skin tone, body proportions, pose, and background."
+            prompt = DEFAULT_PROMPT
             
-        # Khởi tạo lại các thread và reset widget kết quả
-        self.gemini_threads = []
-        self.scheduled_timers = []
-        
-        # Reset các widget kết quả
-        for widget in self.result_widgets:
-            widget.image_label.setText("Đang xử lý...")
-            widget.image_label.setPixmap(QPixmap())  # Xóa ảnh hiện tại nếu có
-            widget.progress_bar.setValue(0)
-            widget.save_btn.setEnabled(False)
-            widget.result_image_path = None
+        # Ghi lô mới vào hàng đợi trước khi chạy
+        count = self.variants_spin.value()
+        jobs = [TryOnJob(self.person_image_path, self.clothing_image_path, prompt, i) for i in range(count)]
+        self.batch_id = new_batch_id('gui')
+        self.job_queue.enqueue(jobs, self.batch_id)
+        
+        # Reset lưới kết quả
+        self.reset_results(count)
+        want = min(self.first_k_spin.value(), count) if self.first_k_checkbox.isChecked() else None
+        self.run_jobs(jobs, api_key, want)
+        
+    def generate_sweep(self):
+        """
+        Tạo ảnh theo file spec sweep: các tổ hợp đã có kết quả được bỏ qua, phần còn
+        lại chạy theo thứ tự giá trị kỳ vọng (xem sweep.py)
+        """
+        self.cancel_running_threads()
+
+        if not self.person_image_path or not self.clothing_image_path:
+            QMessageBox.warning(self, 'Cảnh báo', 'Vui lòng chọn cả ảnh người và ảnh quần áo!')
+            return
+        spec_path, _ = QFileDialog.getOpenFileName(self, 'Chọn File Spec Sweep', '', 'Spec JSON (*.json)')
+        if not spec_path:
+            return
+        prompt = self.prompt_text.toPlainText() or DEFAULT_PROMPT
+        try:
+            expanded = load_spec(spec_path, prompt)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, 'Cảnh báo', f'Spec không hợp lệ: {str(e)}')
+            return
+
+        api_key = self.get_api_key()
+        if not api_key:
+            return
+        # Bật "Tạo lại" thì chạy cả tổ hợp đã có kết quả
+        plan = plan_sweep(expanded, [(self.person_image_path, self.clothing_image_path)], self.get_engine(api_key),
+                          include_cached=self.force_regenerate_checkbox.isChecked(), limit=MAX_VARIANTS)
+        if not plan.jobs:
+            QMessageBox.information(self, 'Sweep', f'Không có gì cần chạy: {plan.summary()}')
+            return
+        answer = QMessageBox.question(self, 'Sweep', f'{plan.summary()}.\n\nChạy {len(plan.jobs)} biến thể?')
+        if answer != QMessageBox.StandardButton.Yes:
+            return
+
+        jobs = plan.jobs
+        self.batch_id = new_batch_id('gui')
+        self.job_queue.enqueue(jobs, self.batch_id)
+        self.reset_results(len(jobs))
+        want = min(self.first_k_spin.value(), len(jobs)) if self.first_k_checkbox.isChecked() else None
+        self.run_jobs(jobs, api_key, want)
+
+    def warm_up_engine(self):
+        """
+        Import SDK và Pillow ở luồng nền, tạo engine và mở sẵn kết nối tới API nếu
+        đã có API key trong file
+        """
+        threading.Thread(target=preload_heavy_modules, name='tryon-preload', daemon=True).start()
+        api_keys = read_api_keys()
+        if api_keys:
+            self.get_engine(api_keys[0])
+        
+    def get_engine(self, api_key):
+        """Engine dùng chung cho mọi lô; chỉ tạo lại khi API key thay đổi"""
+        if self.engine is None or self.engine_api_key != api_key:
+            # Tốc độ gửi do rate limiter quyết định, không cần giãn cách cố định giữa các request
+            self.engine = TryOnEngine(GeminiBackend(api_key), max_concurrency=self.worker_pool.max_workers,
+                                      rate_limiter=self.rate_limiter,
+                                      preparer=self.image_preparer, result_cache=self.result_cache,
+                                      telemetry=self.telemetry, hedge_policy=self.hedge_policy,
+                                      result_store=self.result_store)
+            self.engine_api_key = api_key
+            # Client của key được dùng chung và khởi động trước trên event loop của pool
+            self.worker_pool.warm_up(self.engine)
+        return self.engine
+        
+    def run_jobs(self, jobs, api_key, want=None):
+        """
+        Gửi các job của lô hiện tại vào pool worker. Nếu có want, chỉ chạy tới khi
+        đủ want ảnh thành công (xem FirstKBatch), các job còn lại được hủy.
+        """
+        self.batch_job_ids = {job.variant_id: job.job_id for job in jobs}
+        self.pending_jobs = len(jobs)
+        
+        if not jobs:
+            self.generate_btn.setEnabled(True)
+            self.sweep_btn.setEnabled(True)
+            return
         
         # Vô hiệu hóa nút tạo ảnh
         self.generate_btn.setEnabled(False)
+        self.sweep_btn.setEnabled(False)
         
         # Kiểm tra và tạo thư mục kết quả nếu chưa tồn tại
         os.makedirs(OUTPUT_FOLDER, exist_ok=True)
         
-        # Tạo nhiều thread cho nhiều kết quả, và khởi động từng thread cách nhau 2 giây
-        for i in range(10):
-            thread = GeminiThread(self.person_image_path, self.clothing_image_path, prompt, i, api_key)
-            thread.progress_signal.connect(self.update_progress)
-            thread.finished_signal.connect(self.process_result)
-            self.gemini_threads.append(thread)
-            
-            # Đặt lịch khởi động thread sau mỗi 2 giây
-            timer = QTimer()
-            timer.setSingleShot(True)
-            timer.timeout.connect(lambda idx=i: self.start_thread(idx))
-            timer.start(i * 2000)
-            self.scheduled_timers.append(timer)
-            
-    def start_thread(self, idx):
-        """Khởi động thread thứ idx"""
-        if idx < len(self.gemini_threads):
-            self.gemini_threads[idx].start()
+        engine = self.get_engine(api_key)
+        force_regenerate = self.force_regenerate_checkbox.isChecked()
+        
+        signals = BatchSignals(self)
+        signals.progress_signal.connect(self.update_progress)
+        signals.finished_signal.connect(self.process_result)
+        self.batch_signals = signals
+        
+        self.job_handles = []
+        if want:
+            self.run_first_k(jobs, engine, signals, want, force_regenerate)
+            return
+        for job in jobs:
+            self.job_queue.mark_running(job.job_id)
+            handle = self.worker_pool.submit(engine, job, signals.progress_signal.emit,
+                                             signals.on_job_done, force_regenerate)
+            self.job_handles.append(handle)
             
+    def run_first_k(self, jobs, engine, signals, want, force_regenerate):
+        """Chế độ K ảnh tốt đầu tiên: tối đa want + FIRST_K_EXTRA request chạy cùng lúc"""
+        signals.submitted_signal.connect(self.job_submitted)
+        signals.stopped_signal.connect(self.first_k_finished)
+        for job in jobs:
+            self.results_model.set_status(job.variant_id, "Đang chờ...")
+        self.first_k_batch = FirstKBatch(
+            self.worker_pool, engine, jobs, want, min(len(jobs), want + FIRST_K_EXTRA),
+            progress=signals.progress_signal.emit, on_done=signals.on_job_done,
+            on_submit=lambda job: signals.submitted_signal.emit(job.variant_id),
+            on_finished=signals.stopped_signal.emit, force_regenerate=force_regenerate)
+        self.first_k_batch.start()
+
+    def job_submitted(self, thread_id):
+        """Job của chế độ K ảnh tốt đầu tiên vừa được gửi vào pool"""
+        if self.sender() is not self.batch_signals:
+            return
+        self.results_model.set_status(thread_id, "Đang xử lý...")
+        job_id = self.batch_job_ids.get(thread_id)
+        if job_id is not None:
+            self.job_queue.mark_running(job_id)
+
+    def first_k_finished(self, batch):
+        """Đã đủ ảnh tốt (hoặc hết lượt thử): đánh dấu các biến thể không cần chạy nữa"""
+        if self.sender() is not self.batch_signals:
+            return
+        for job in batch.cancelled + batch.skipped:
+            self.results_model.set_status(job.variant_id, f"Không cần - đã đủ {batch.want} ảnh")
+        if self.batch_id:
+            self.job_queue.cancel_batch(self.batch_id)
+        if batch.succeeded < batch.want:
+            print(f"Hết lượt thử: chỉ có {batch.succeeded}/{batch.want} ảnh tốt sau {batch.submitted} request")
+        else:
+            print(f"Đủ {batch.want} ảnh sau {batch.submitted} request ({batch.failed} lỗi, "
+                  f"{len(batch.cancelled)} bị hủy, {len(batch.skipped)} không cần gửi)")
+        self.first_k_batch = None
+        self.pending_jobs = 0
+        self.generate_btn.setEnabled(True)
+        self.sweep_btn.setEnabled(True)
+
     def update_progress(self, value, thread_id):
         """Cập nhật giá trị thanh tiến trình cho thread cụ thể"""
-        if thread_id < len(self.result_widgets):
-            self.result_widgets[thread_id].update_progress(value)
+        if self.sender() is not self.batch_signals:
+            return  # Tín hiệu của lô đã hủy
+        self.results_model.set_progress(thread_id, value)
         
-    def process_result(self, success, message, thread_id):
+    def process_result(self, success, message, thread_id, image_data=None):
         """Xử lý kết quả từ API Gemini"""
-        if thread_id >= len(self.result_widgets):
-            return
+        if self.sender() is not self.batch_signals:
+            return  # Kết quả đến muộn của lô đã hủy
+        self.pending_jobs -= 1
+        
+        # Ghi kết quả vào hàng đợi để không phải chạy lại job này
+        job_id = self.batch_job_ids.get(thread_id)
+        if job_id is not None:
+            self.job_queue.complete(job_id, success, message if success else None,
+                                    None if success else message, retry=False)
             
         if success:
-            # Hiển thị ảnh kết quả
-            self.result_widgets[thread_id].display_image(message)
+            # Hiển thị ảnh kết quả (thumbnail chỉ được tạo khi ô hiện trên màn hình)
+            self.results_model.set_result(thread_id, message, image_data)
         else:
             # Hiển thị thông báo lỗi
-            self.result_widgets[thread_id].image_label.setText(f"Lỗi: {message}")
+            self.results_model.set_error(thread_id, message)
             
-        # Nếu tất cả thread đã hoàn thành, kích hoạt lại nút tạo ảnh
-        all_done = True
-        for thread in self.gemini_threads:
-            if thread.isRunning():
-                all_done = False
-                break
-                
-        if all_done:
+        # Nếu tất cả job đã hoàn thành, kích hoạt lại nút tạo ảnh (chế độ K ảnh tốt chờ lô kết thúc)
+        if self.pending_jobs <= 0 and self.first_k_batch is None:
             self.generate_btn.setEnabled(True)
+            self.sweep_btn.setEnabled(True)
+            
+    def closeEvent(self, event):
+        """Hủy các job còn lại và dừng pool khi đóng cửa sổ"""
+        if self.export_job is not None:
+            # Bản xuất dở dang bị hủy (file ZIP tạm được xóa)
+            self.export_job.cancel()
+            self.export_job.wait(2.0)
+        self.worker_pool.shutdown()
+        if self.engine is not None:
+            # Đảm bảo các file kết quả đang ghi nền được ghi xong
+            self.engine.flush()
+        self.result_store.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+        super().closeEvent(event)
 
 def main():
+    measure_startup = '--startup-time' in sys.argv
+    
+    # Biến môi trường (TRYON_TRACE, ...) có thể đặt trong file .env
+    if os.path.exists('.env'):
+        from dotenv import load_dotenv
+        load_dotenv()
+    
     app = QApplication(sys.argv)
+    probe = StartupProbe(app) if measure_startup else None
     
     # Thiết lập font chữ mặc định
     app.setFont(QFont("Arial", 10))
@@ -597,7 +926,11 @@ def main():
         }
     ''')
     
-    window = DuyThuDoApp()
+    if probe:
+        probe.mark("qapplication")
+    window = DuyThuDoApp(measure_startup)
+    if probe:
+        probe.mark("window")
     window.show()
     sys.exit(app.exec())
 
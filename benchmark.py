@@ -0,0 +1,389 @@
+# benchmark.py
+"""
+Benchmark đường sinh ảnh với server Gemini giả lập chạy trên máy.
+
+Ví dụ:
+    python benchmark.py --variants 10 --batches 5 --latency lognormal:1.0,0.35 --label main
+    python benchmark.py --error-rate 0.05 --burst-every 20 --burst-length 3 --compare benchmarks/<file>.json
+    python benchmark.py --variants 40 --key-quota 2 --keys 4
+
+Các lô được chạy giống hệt giao diện: GeminiBackend (qua SDK, trỏ tới mock_gemini)
+trong TryOnEngine, gửi vào WorkerPool, kết quả được chuyển về một "luồng giao diện"
+giả lập. Báo cáo gồm thời gian mỗi lô, độ trễ p50/p95/p99 của từng biến thể,
+thông lượng, RSS cao nhất và thời gian luồng giao diện bị chặn. Mỗi lần chạy được
+lưu thành một file JSON trong benchmarks/ để so sánh giữa các phiên bản (--compare).
+"""
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from tryon_engine import TryOnEngine, TryOnJob, GeminiBackend, StubBackend, make_png_bytes
+from rate_limiter import AdaptiveRateLimiter
+from key_pool import ApiKeyPool
+from hedging import HedgePolicy
+from image_prep import ImagePreparer, PassthroughPreparer
+from worker_pool import WorkerPool
+from telemetry import STAGES
+from mock_gemini import MockGeminiServer, add_mock_arguments, config_from_args, parse_size
+
+BENCHMARK_FOLDER = 'benchmarks'
+SCHEMA_VERSION = 1
+
+# Chỉ số dùng khi so sánh hai lần chạy: (tên, True nếu giá trị nhỏ hơn là tốt hơn)
+COMPARED_METRICS = [
+    ("batch_wall_s", True),
+    ("latency_p50_s", True),
+    ("latency_p95_s", True),
+    ("latency_p99_s", True),
+    ("first_result_s", True),
+    ("throughput_per_s", False),
+    ("success_rate", False),
+    ("peak_rss_mb", True),
+    ("gui_block_max_ms", True),
+    ("gui_block_total_ms", True),
+]
+
+def percentile(values, q):
+    """Phân vị q (0-100) với nội suy tuyến tính, None nếu không có giá trị"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def peak_rss_bytes():
+    """RSS cao nhất của tiến trình, None nếu hệ điều hành không hỗ trợ"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux trả về KB, macOS trả về byte
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+class GuiLoopProbe:
+    """
+    Giả lập vòng lặp sự kiện của luồng giao diện: nhận kết quả từ pool qua hàng
+    đợi và đo mỗi lần vòng lặp bị trễ quá tick giây (do GIL hoặc do xử lý kết quả).
+    """
+    def __init__(self, tick=0.01):
+        self.tick = tick
+        self.events = queue.Queue()
+        self.block_max = 0.0
+        self.block_total = 0.0
+
+    def record_block(self, seconds):
+        if seconds > 0:
+            self.block_max = max(self.block_max, seconds)
+            self.block_total += seconds
+
+    def post(self, item):
+        """Gọi từ luồng của pool, giống việc emit tín hiệu Qt sang luồng giao diện"""
+        self.events.put(item)
+
+    def run(self, expected, handle_event):
+        """Chạy vòng lặp tới khi nhận đủ expected sự kiện"""
+        received = 0
+        last = time.perf_counter()
+        while received < expected:
+            try:
+                item = self.events.get(timeout=self.tick)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                handle_event(item)
+                received += 1
+            now = time.perf_counter()
+            self.record_block(now - last - self.tick)
+            last = now
+
+def make_inputs(folder, size):
+    """Ảnh người và ảnh quần áo tổng hợp cho benchmark"""
+    width, height = size
+    person = os.path.join(folder, 'person.png')
+    garment = os.path.join(folder, 'garment.png')
+    with open(person, 'wb') as f:
+        f.write(make_png_bytes(width, height, (180, 150, 130)))
+    with open(garment, 'wb') as f:
+        f.write(make_png_bytes(width, height, (30, 60, 160)))
+    return person, garment
+
+def build_backend(args, endpoint, api_key="benchmark"):
+    if args.backend == 'stub':
+        return StubBackend(latency=args.stub_latency, image_size=args.image_size)
+    return GeminiBackend(api_key, endpoint=endpoint, request_timeout=args.request_timeout)
+
+def run_batch(pool, engine, probe, jobs):
+    """Chạy một lô như DuyThuDoApp.run_jobs(); trả về (thời gian lô, kết quả mỗi biến thể)"""
+    submitted = {}
+    records = []
+    start = time.perf_counter()
+    for job in jobs:
+        submitted[job.variant_id] = time.perf_counter()
+        pool.submit(engine, job, on_done=lambda handle: probe.post((handle, time.perf_counter())))
+    # Thời gian gửi job cũng chạy trên luồng giao diện
+    probe.record_block(time.perf_counter() - start - probe.tick)
+
+    def handle_event(item):
+        handle, finished = item
+        try:
+            result = handle.result()
+            success, cached, timings = result.success, result.cached, result.timings
+        except Exception:
+            success, cached, timings = False, False, {}
+        records.append({
+            "variant_id": handle.job.variant_id,
+            "latency": finished - submitted[handle.job.variant_id],
+            "since_start": finished - start,
+            "success": success,
+            "cached": cached,
+            # Cùng dict với result.timings: bước "write" được thêm vào khi file ghi xong
+            "stages": timings,
+        })
+
+    probe.run(len(jobs), handle_event)
+    return time.perf_counter() - start, records
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='tryon-bench-')
+    server = None
+    try:
+        endpoint = None
+        if args.backend == 'gemini':
+            server = MockGeminiServer(config_from_args(args))
+            endpoint = server.start()
+            print(f"Server giả lập: {endpoint}")
+
+        if args.person and args.garment:
+            person, garment = args.person, args.garment
+        else:
+            person, garment = make_inputs(workdir, args.input_size)
+
+        if args.keys > 1:
+            # Các key giả; với --key-quota, server giả lập tính quota riêng cho từng key
+            limiter = ApiKeyPool([f"benchmark-{i}" for i in range(args.keys)],
+                                 initial_rate=args.rate, max_rate=args.max_rate)
+        else:
+            limiter = AdaptiveRateLimiter(initial_rate=args.rate, max_rate=args.max_rate)
+        hedge_policy = HedgePolicy(percentile=args.hedge_percentile, max_ratio=args.hedge_max_ratio) \
+            if args.hedge else None
+        preparer = ImagePreparer(max_edge=args.max_edge) if args.max_edge else PassthroughPreparer()
+        api_key = limiter.keys[0] if args.keys > 1 else "benchmark"
+        engine = TryOnEngine(build_backend(args, endpoint, api_key), max_concurrency=args.concurrency,
+                             output_folder=os.path.join(workdir, 'results'), rate_limiter=limiter,
+                             preparer=preparer, hedge_policy=hedge_policy, stream=not args.no_stream)
+        pool = WorkerPool(max_workers=args.concurrency)
+        if not args.cold:
+            # Giống giao diện: client được khởi động trước khi người dùng bấm tạo ảnh
+            pool.warm_up(engine).result()
+        probe = GuiLoopProbe()
+
+        batches = []
+        try:
+            for number in range(args.warmup + args.batches):
+                jobs = [TryOnJob(person, garment, args.prompt, i) for i in range(args.variants)]
+                if number == args.warmup:
+                    # Chỉ đo các lô sau lượt khởi động
+                    probe = GuiLoopProbe()
+                wall, records = run_batch(pool, engine, probe, jobs)
+                engine.flush()
+                if number >= args.warmup:
+                    batches.append({"wall_s": wall, "variants": records})
+                    ok = sum(record["success"] for record in records)
+                    print(f"Lô {len(batches)}/{args.batches}: {wall:.2f} giây, {ok}/{len(records)} thành công")
+        finally:
+            pool.shutdown()
+
+        report = build_report(args, batches, probe, limiter, server, hedge_policy)
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def build_report(args, batches, probe, limiter, server, hedge_policy=None):
+    records = [record for batch in batches for record in batch["variants"]]
+    latencies = [record["latency"] for record in records if record["success"]]
+    walls = [batch["wall_s"] for batch in batches]
+    firsts = [min(record["since_start"] for record in batch["variants"] if record["success"])
+              for batch in batches if any(record["success"] for record in batch["variants"])]
+    rss = peak_rss_bytes()
+    metrics = {
+        "batch_wall_s": sum(walls) / len(walls) if walls else None,
+        "batch_wall_max_s": max(walls) if walls else None,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "latency_p99_s": percentile(latencies, 99),
+        "first_result_s": sum(firsts) / len(firsts) if firsts else None,
+        "throughput_per_s": len(records) / sum(walls) if walls and sum(walls) > 0 else None,
+        "success_rate": len(latencies) / len(records) if records else None,
+        "peak_rss_mb": rss / (1024 * 1024) if rss is not None else None,
+        "gui_block_max_ms": probe.block_max * 1000,
+        "gui_block_total_ms": probe.block_total * 1000,
+        "rate_limited": limiter.throttled_count,
+    }
+    if hedge_policy is not None:
+        hedge = hedge_policy.stats()
+        metrics["hedge_rate"] = hedge["hedge_rate"]
+        metrics["hedge_wins"] = hedge["hedge_wins"]
+    # Thời gian từng bước để biết lô chậm do upload, API hay I/O trên máy
+    stages = {}
+    for stage in STAGES:
+        values = [record["stages"][stage] for record in records if stage in record["stages"]]
+        if values:
+            stages[stage] = {"mean_s": sum(values) / len(values), "p50_s": percentile(values, 50),
+                             "p95_s": percentile(values, 95)}
+    config = {
+        "backend": args.backend,
+        "variants": args.variants,
+        "batches": args.batches,
+        "warmup": args.warmup,
+        "cold": args.cold,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "max_rate": args.max_rate,
+        "keys": args.keys,
+        "stream": not args.no_stream,
+        "hedge": args.hedge,
+        "hedge_percentile": args.hedge_percentile,
+        "hedge_max_ratio": args.hedge_max_ratio,
+        "max_edge": args.max_edge,
+        "input_size": list(args.input_size),
+    }
+    if server is not None:
+        config["mock"] = server.config.as_dict()
+    return {
+        "schema": SCHEMA_VERSION,
+        "label": args.label,
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "metrics": metrics,
+        "stages": stages,
+        "server": server.stats() if server is not None else None,
+        "batches": batches,
+    }
+
+def save_report(report, folder):
+    os.makedirs(folder, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    name = f"{stamp}_{report['label']}" if report['label'] else stamp
+    path = os.path.join(folder, f"{name}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return path
+
+def compare_reports(baseline, current, threshold):
+    """
+    So sánh các chỉ số chính. Trả về danh sách (tên, cũ, mới, thay đổi tương đối,
+    True nếu là suy giảm vượt ngưỡng threshold).
+    """
+    rows = []
+    for name, lower_is_better in COMPARED_METRICS:
+        old = baseline["metrics"].get(name)
+        new = current["metrics"].get(name)
+        if old is None or new is None:
+            rows.append((name, old, new, None, False))
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = change > threshold if lower_is_better else change < -threshold
+        rows.append((name, old, new, change, worse))
+    return rows
+
+def print_report(report):
+    print("Kết quả benchmark:")
+    for name, value in report["metrics"].items():
+        print(f"  {name:22} {'-' if value is None else f'{value:.3f}'}")
+    for stage, values in report["stages"].items():
+        print(f"  stage {stage:16} p50 {values['p50_s'] * 1000:9.1f} ms   p95 {values['p95_s'] * 1000:9.1f} ms")
+    if report["server"]:
+        print(f"  server                 {report['server']}")
+
+def print_comparison(rows, baseline):
+    print(f"So sánh với {baseline.get('label') or '-'} ({baseline.get('git_revision') or '?'}, "
+          f"{baseline.get('created_at')}):")
+    for name, old, new, change, worse in rows:
+        old_text = '-' if old is None else f"{old:.3f}"
+        new_text = '-' if new is None else f"{new:.3f}"
+        change_text = '' if change is None else f"{change:+.1%}"
+        print(f"  {name:22} {old_text:>10} -> {new_text:>10} {change_text:>8}{'  SUY GIẢM' if worse else ''}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark đường sinh ảnh với server Gemini giả lập")
+    parser.add_argument('--variants', type=int, default=10, help="Số biến thể mỗi lô (mặc định 10 như giao diện)")
+    parser.add_argument('--batches', type=int, default=3, help="Số lô được đo")
+    parser.add_argument('--warmup', type=int, default=0, help="Số lô chạy trước để khởi động, không tính vào kết quả")
+    parser.add_argument('--cold', action='store_true',
+                        help="Không khởi động trước client, đo cả chi phí kết nối của lô đầu tiên")
+    parser.add_argument('--concurrency', type=int, default=10, help="Số job chạy đồng thời (giao diện dùng 10)")
+    parser.add_argument('--rate', type=float, default=2.0, help="Tốc độ gửi ban đầu của rate limiter")
+    parser.add_argument('--max-rate', type=float, default=20.0, help="Tốc độ gửi tối đa của rate limiter")
+    parser.add_argument('--keys', type=int, default=1,
+                        help="Số API key giả dùng qua ApiKeyPool (mỗi key có rate limiter riêng)")
+    parser.add_argument('--no-stream', action='store_true',
+                        help="Gọi API không dùng stream (so sánh thời gian có kết quả đầu tiên)")
+    parser.add_argument('--hedge', action='store_true', help="Bật request dự phòng (hedging.HedgePolicy)")
+    parser.add_argument('--hedge-percentile', type=float, default=75.0, help="Phân vị độ trễ kích hoạt dự phòng")
+    parser.add_argument('--hedge-max-ratio', type=float, default=0.1, help="Tỷ lệ request dự phòng tối đa")
+    parser.add_argument('--max-edge', type=int, default=1024,
+                        help="Cạnh dài tối đa của ảnh đầu vào (0 = gửi nguyên ảnh, không cần Pillow)")
+    parser.add_argument('--input-size', type=parse_size, default=(1536, 2048),
+                        help="Kích thước ảnh đầu vào tổng hợp, ví dụ 1536x2048")
+    parser.add_argument('--person', help="Ảnh người thật thay cho ảnh tổng hợp")
+    parser.add_argument('--garment', help="Ảnh quần áo thật thay cho ảnh tổng hợp")
+    parser.add_argument('--prompt', default="benchmark", help="Prompt gửi lên server giả lập")
+    parser.add_argument('--request-timeout', type=float, default=120)
+    add_mock_arguments(parser)
+    parser.add_argument('--backend', choices=['gemini', 'stub'], default='gemini',
+                        help="'gemini' dùng SDK với server giả lập, 'stub' chỉ đo phần xử lý trong tiến trình")
+    parser.add_argument('--stub-latency', type=float, default=0.5, help=argparse.SUPPRESS)
+    parser.add_argument('--label', default='', help="Nhãn của lần chạy (ví dụ tên nhánh)")
+    parser.add_argument('--output-dir', default=BENCHMARK_FOLDER, help="Thư mục lưu file kết quả JSON")
+    parser.add_argument('--no-save', action='store_true', help="Không lưu file kết quả")
+    parser.add_argument('--compare', help="File kết quả của lần chạy trước để so sánh")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Ngưỡng thay đổi tương đối bị coi là suy giảm (mặc định 10%%)")
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help="Trả mã lỗi 1 nếu có chỉ số suy giảm vượt ngưỡng")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = run_benchmark(args)
+    print_report(report)
+    if not args.no_save:
+        print(f"Đã lưu kết quả: {save_report(report, args.output_dir)}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows = compare_reports(baseline, report, args.threshold)
+        print_comparison(rows, baseline)
+        if args.fail_on_regression and any(worse for *_, worse in rows):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
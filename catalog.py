@@ -0,0 +1,368 @@
+# catalog.py
+"""
+Chế độ catalog: chạy thử đồ cho mọi cặp (ảnh người × ảnh quần áo) từ dòng lệnh.
+
+Ví dụ:
+    python catalog.py --persons models/ --garments garments.txt --variants 3 --output catalog_out
+
+Mỗi cặp sinh K biến thể với cùng prompt và cấu hình generation như GeminiThread.
+Kết quả ghi vào thư mục output kèm file chỉ mục (JSONL hoặc CSV) ghi lại cặp đầu
+vào, đường dẫn kết quả và trạng thái của từng biến thể.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import threading
+
+from tryon_engine import DEFAULT_PROMPT, TryOnEngine, TryOnJob, GeminiBackend, StubBackend
+from rate_limiter import AdaptiveRateLimiter
+from key_pool import ApiKeyPool, read_api_keys
+from image_prep import ImagePreparer, PassthroughPreparer
+from result_cache import ResultCache
+from job_queue import JobQueue, JOB_QUEUE_PATH, PENDING, RUNNING, DONE
+from telemetry import Telemetry, MetricsRegistry
+from hedging import HedgePolicy
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+
+def load_image_list(source):
+    """
+    Đọc danh sách ảnh từ một thư mục (mọi file ảnh, sắp xếp theo tên) hoặc từ file
+    manifest: mỗi dòng một đường dẫn (.txt), một object có khóa "path" (.jsonl)
+    hoặc cột "path" (.csv). Đường dẫn tương đối tính từ thư mục chứa manifest.
+    """
+    if os.path.isdir(source):
+        return [os.path.join(source, name) for name in sorted(os.listdir(source))
+                if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, 'r', encoding='utf-8', newline='') as f:
+        if source.lower().endswith('.csv'):
+            rows = (row.get('path') for row in csv.DictReader(f))
+        elif source.lower().endswith(('.jsonl', '.ndjson')):
+            rows = (json.loads(line)['path'] for line in f if line.strip())
+        else:
+            rows = (line.strip() for line in f if line.strip() and not line.lstrip().startswith('#'))
+        for path in rows:
+            if path:
+                paths.append(path if os.path.isabs(path) else os.path.join(base_dir, path))
+    return paths
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def pair_dir_name(person, garment):
+    """
+    Tên thư mục kết quả của một cặp ảnh: tên hai file kèm hash ngắn của đường dẫn
+    tuyệt đối, để a/1.jpg và b/1.jpg (hay x.jpg và x.png) không ghi đè kết quả của nhau
+    """
+    digest = hashlib.sha256(f"{os.path.abspath(person)}\0{os.path.abspath(garment)}".encode('utf-8')).hexdigest()
+    return f"{_stem(person)}__{_stem(garment)}_{digest[:8]}"
+
+def iter_catalog_jobs(persons, garments, variants, output_dir, prompt=DEFAULT_PROMPT):
+    """
+    Sinh lần lượt các job cho tích Descartes persons × garments × variants. Mọi đường
+    dẫn là tuyệt đối để worker ở thư mục làm việc khác (farm.py) vẫn dùng được job.
+    """
+    output_dir = os.path.abspath(output_dir)
+    seen = set()
+    for person in map(os.path.abspath, persons):
+        for garment in map(os.path.abspath, garments):
+            if (person, garment) in seen:
+                # Cùng một ảnh xuất hiện hai lần trong danh sách: các job sẽ ghi cùng file kết quả
+                print(f"Bỏ qua cặp trùng: {person} × {garment}")
+                continue
+            seen.add((person, garment))
+            pair_dir = os.path.join(output_dir, pair_dir_name(person, garment))
+            for variant_id in range(variants):
+                yield TryOnJob(person, garment, prompt, variant_id,
+                               output_path=os.path.join(pair_dir, f"variant_{variant_id}.png"))
+
+class IndexWriter:
+    """
+    Ghi chỉ mục kết quả từng dòng một (JSONL hoặc CSV theo phần mở rộng file),
+    flush ngay để chỉ mục luôn dùng được kể cả khi lần chạy bị dừng giữa chừng.
+    """
+    FIELDS = ["person", "garment", "variant", "status", "result_path", "message", "elapsed", "cached"]
+
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.lower().endswith('.csv')
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', encoding='utf-8', newline='')
+        if self.is_csv:
+            self._csv = csv.DictWriter(self._file, fieldnames=self.FIELDS)
+            if new_file:
+                self._csv.writeheader()
+
+    def write(self, result):
+        row = {
+            "person": result.job.person_image_path,
+            "garment": result.job.clothing_image_path,
+            "variant": result.job.variant_id,
+            "status": "ok" if result.success else "error",
+            "result_path": result.image_path if result.success else None,
+            "message": None if result.success else result.message,
+            "elapsed": round(result.elapsed, 3),
+            "cached": result.cached,
+        }
+        self._write(row)
+
+    def write_job_row(self, row):
+        """Ghi một job đã kết thúc từ hàng đợi (kết quả do tiến trình khác tạo, xem farm.py)"""
+        done = row['state'] == DONE
+        self._write({
+            "person": row['person_image_path'],
+            "garment": row['clothing_image_path'],
+            "variant": row['variant_id'],
+            "status": "ok" if done else "error",
+            "result_path": row['result_path'] if done else None,
+            "message": None if done else row['message'],
+            "elapsed": None,
+            "cached": None,
+        })
+
+    def _write(self, row):
+        with self._lock:
+            if self.is_csv:
+                self._csv.writerow(row)
+            else:
+                self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class CatalogStats:
+    """Đếm số biến thể thành công/thất bại và tính thông lượng"""
+    def __init__(self, total):
+        self.total = total
+        self.ok = 0
+        self.failed = 0
+        self.cached = 0
+        self.coalesced = 0
+        self.start = time.perf_counter()
+
+    @property
+    def done(self):
+        return self.ok + self.failed
+
+    def add(self, result):
+        if result.success:
+            self.ok += 1
+            self.cached += result.cached
+            self.coalesced += result.coalesced
+        else:
+            self.failed += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        return (f"{self.done}/{self.total} biến thể ({self.ok} thành công, {self.failed} lỗi, "
+                f"{self.cached} từ cache, {self.coalesced} dùng chung request đang chạy) trong {elapsed:.1f} giây - {rate:.2f} biến thể/giây")
+
+def build_preparer(args, cache_size):
+    # Backend giả lập không đọc ảnh nên không cần giải mã lại bằng Pillow
+    if args.backend == 'stub' or not args.max_edge:
+        return PassthroughPreparer(cache_size=cache_size)
+    return ImagePreparer(max_edge=args.max_edge, cache_size=cache_size)
+
+def build_hedge_policy(args):
+    if not args.hedge:
+        return None
+    return HedgePolicy(percentile=args.hedge_percentile, max_ratio=args.hedge_max_ratio)
+
+def build_telemetry(args, rate_limiter, hedge_policy=None, always=False):
+    if not (always or args.trace or args.metrics_port or args.metrics_file):
+        return None
+    telemetry = Telemetry(args.trace, MetricsRegistry(rate_limiter=rate_limiter, hedge_policy=hedge_policy))
+    if args.metrics_port:
+        telemetry.registry.serve(args.metrics_port)
+    return telemetry
+
+def build_engine(args, cache_size=32, result_store=None, metrics=False):
+    """
+    Engine theo các tùy chọn của add_engine_arguments() (dùng chung với farm.py,
+    sweep.py và service.py). metrics=True luôn bật telemetry, kể cả khi không có
+    --trace/--metrics-port/--metrics-file.
+    """
+    api_keys = []
+    if args.backend == 'stub':
+        backend = StubBackend(latency=args.stub_latency)
+    else:
+        api_keys = read_api_keys(args.api_key_file)
+        if not api_keys and os.environ.get('GEMINI_API_KEY'):
+            api_keys = [os.environ['GEMINI_API_KEY']]
+        if not api_keys:
+            raise SystemExit("Không tìm thấy API key (đặt GEMINI_API_KEY/GEMINI_API_KEYS hoặc tạo file api_key.txt)")
+        backend = GeminiBackend(api_keys[0])
+    if len(api_keys) > 1:
+        # Mỗi key có quota và rate limiter riêng; request đi tới key còn nhiều quota nhất
+        print(f"Dùng {len(api_keys)} API key")
+        rate_limiter = ApiKeyPool(api_keys, initial_rate=args.rate, max_rate=args.max_rate)
+    else:
+        rate_limiter = AdaptiveRateLimiter(initial_rate=args.rate, max_rate=args.max_rate)
+    hedge_policy = build_hedge_policy(args)
+    return TryOnEngine(
+        backend,
+        max_concurrency=args.concurrency or 8 * max(1, len(api_keys)),
+        output_folder=args.output,
+        rate_limiter=rate_limiter,
+        preparer=build_preparer(args, cache_size),
+        result_cache=None if args.no_cache else ResultCache(),
+        force_regenerate=args.force_regenerate,
+        telemetry=build_telemetry(args, rate_limiter, hedge_policy, always=metrics),
+        hedge_policy=hedge_policy,
+        stream=not args.no_stream,
+        result_store=result_store,
+    )
+
+def run_catalog(args):
+    persons = load_image_list(args.persons)
+    garments = load_image_list(args.garments)
+    total = len(persons) * len(garments) * args.variants
+    if total == 0:
+        print("Không có cặp ảnh nào để xử lý")
+        return 1
+
+    print(f"Catalog: {len(persons)} ảnh người × {len(garments)} ảnh quần áo × {args.variants} biến thể = {total} job")
+    jobs = iter_catalog_jobs(persons, garments, args.variants, args.output, args.prompt)
+
+    queue = None
+    if not args.no_queue:
+        # Lô được xác định theo thư mục output: chạy lại cùng lệnh sẽ tiếp tục lô cũ
+        queue = JobQueue(args.queue)
+        batch_id = 'catalog:' + os.path.abspath(args.output)
+        recovered = queue.recover()
+        queue.enqueue(jobs, batch_id)
+        counts = queue.counts(batch_id)
+        total = counts.get(PENDING, 0)
+        print(f"Hàng đợi {args.queue}: {counts.get('done', 0)} job đã xong từ trước, "
+              f"{total} job cần chạy ({recovered} job chạy dở được khôi phục)")
+
+    # Mỗi ảnh quần áo được dùng lại cho mọi ảnh người, cache phải đủ chứa hết
+    engine = build_engine(args, cache_size=max(32, len(garments) + 1))
+    index = IndexWriter(args.index or os.path.join(args.output, 'index.jsonl'))
+    stats = CatalogStats(total)
+
+    record_lock = threading.Lock()
+
+    def record(result):
+        if result.saved is not None and result.saved.exception() is not None:
+            result.success = False
+            result.message = f"Không ghi được file kết quả: {result.saved.exception()}"
+        with record_lock:
+            if queue is not None and queue.complete_result(result) == PENDING:
+                # Job lỗi được đưa lại hàng đợi để thử lại, chưa tính là kết quả cuối
+                return
+            stats.add(result)
+            index.write(result)
+            if stats.done % args.report_every == 0 or stats.done == total:
+                print(f"[{time.strftime('%H:%M:%S')}] {stats.summary()} - "
+                      f"tốc độ gửi {engine.rate_limiter.current_rate:.2f} request/giây")
+                if args.metrics_file:
+                    engine.telemetry.registry.write(args.metrics_file)
+
+    def on_result(result):
+        # Chỉ ghi nhận job là xong khi file kết quả đã thực sự nằm trên đĩa
+        if result.saved is not None:
+            result.saved.add_done_callback(lambda _: record(result))
+        else:
+            record(result)
+
+    unfinished = 0
+    try:
+        if queue is None:
+            asyncio.run(engine.run_stream(jobs, on_result))
+        else:
+            while True:
+                asyncio.run(engine.run_stream(queue.iter_claims(batch_id), on_result))
+                # Job lỗi chỉ được đưa lại hàng đợi khi kết quả đã ghi xong, sau khi lượt lấy job đã hết
+                engine.flush()
+                counts = queue.counts(batch_id)
+                unfinished = counts.get(PENDING, 0) + counts.get(RUNNING, 0)
+                if not counts.get(PENDING):
+                    break
+    except KeyboardInterrupt:
+        print("Đã dừng theo yêu cầu người dùng")
+        if queue is not None:
+            counts = queue.counts(batch_id)
+            unfinished = counts.get(PENDING, 0) + counts.get(RUNNING, 0)
+    finally:
+        engine.flush()
+        index.close()
+        if engine.telemetry is not None:
+            if args.metrics_file:
+                engine.telemetry.registry.write(args.metrics_file)
+            engine.telemetry.close()
+        if queue is not None:
+            queue.close()
+    print(f"Hoàn tất: {stats.summary()}")
+    if engine.hedge_policy is not None:
+        hedge = engine.hedge_policy.stats()
+        print(f"Request dự phòng: {hedge['hedges']} ({hedge['hedge_rate']:.1%} số request), "
+              f"{hedge['hedge_wins']} lần xong trước request chính")
+    print(f"Chỉ mục kết quả: {index.path}")
+    if unfinished:
+        print(f"Còn {unfinished} job chưa xong; chạy lại lệnh để tiếp tục")
+    return 0 if stats.failed == 0 and not unfinished else 2
+
+def add_catalog_arguments(parser):
+    """Đầu vào và đầu ra của một lần chạy catalog (dùng chung với farm.py)"""
+    parser.add_argument('--persons', required=True, help="Thư mục hoặc file manifest ảnh người")
+    parser.add_argument('--garments', required=True, help="Thư mục hoặc file manifest ảnh quần áo")
+    parser.add_argument('--variants', type=int, default=3, help="Số biến thể cho mỗi cặp (mặc định 3)")
+    parser.add_argument('--output', default='catalog_results', help="Thư mục lưu kết quả")
+    parser.add_argument('--index', help="File chỉ mục .jsonl hoặc .csv (mặc định <output>/index.jsonl)")
+    parser.add_argument('--prompt', default=DEFAULT_PROMPT, help="Prompt cho AI")
+
+def add_engine_arguments(parser):
+    """Tùy chọn của engine: API key, tốc độ, cache, stream, dự phòng, telemetry (dùng chung với farm.py, service.py)"""
+    parser.add_argument('--concurrency', type=int,
+                        help="Số request chạy đồng thời tối đa (mặc định 8 cho mỗi API key)")
+    parser.add_argument('--rate', type=float, default=2.0, help="Tốc độ gửi ban đầu (request/giây, cho mỗi API key)")
+    parser.add_argument('--max-rate', type=float, default=20.0, help="Tốc độ gửi tối đa (request/giây, cho mỗi API key)")
+    parser.add_argument('--max-edge', type=int, default=1024,
+                        help="Cạnh dài tối đa của ảnh gửi lên API (0 = gửi nguyên ảnh gốc)")
+    parser.add_argument('--api-key-file', default='api_key.txt',
+                        help="File API key, mỗi dòng một key (nhiều key được dùng luân phiên theo quota)")
+    parser.add_argument('--no-cache', action='store_true', help="Không dùng cache kết quả")
+    parser.add_argument('--force-regenerate', action='store_true', help="Bỏ qua kết quả đã có trong cache")
+    parser.add_argument('--no-stream', action='store_true', help="Gọi API không dùng phản hồi dạng stream")
+    parser.add_argument('--hedge', action='store_true',
+                        help="Gửi request dự phòng khi một biến thể chạy lâu hơn phân vị --hedge-percentile")
+    parser.add_argument('--hedge-percentile', type=float, default=75.0,
+                        help="Phân vị độ trễ kích hoạt request dự phòng (mặc định 75)")
+    parser.add_argument('--hedge-max-ratio', type=float, default=0.1,
+                        help="Tỷ lệ request dự phòng tối đa so với số request (mặc định 0.1)")
+    parser.add_argument('--trace', help="File JSONL ghi thời gian từng bước của mỗi biến thể")
+    parser.add_argument('--metrics-port', type=int, help="Phục vụ metrics dạng Prometheus tại cổng này (/metrics)")
+    parser.add_argument('--metrics-file', help="Ghi metrics dạng Prometheus ra file text khi báo tiến độ và khi kết thúc")
+    parser.add_argument('--backend', choices=['gemini', 'stub'], default='gemini',
+                        help="'stub' dùng backend giả lập, không gọi API")
+    parser.add_argument('--stub-latency', type=float, default=0.5, help=argparse.SUPPRESS)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Chạy thử đồ hàng loạt cho mọi cặp ảnh người × ảnh quần áo")
+    add_catalog_arguments(parser)
+    parser.add_argument('--queue', default=JOB_QUEUE_PATH,
+                        help="File SQLite lưu hàng đợi job, cho phép chạy tiếp sau khi bị dừng")
+    parser.add_argument('--no-queue', action='store_true', help="Không dùng hàng đợi bền vững")
+    parser.add_argument('--report-every', type=int, default=50, help="In tiến độ sau mỗi N biến thể")
+    add_engine_arguments(parser)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return run_catalog(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
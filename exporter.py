@@ -0,0 +1,315 @@
+# exporter.py
+"""
+Xuất hàng loạt kết quả ở luồng nền: ZIP, thư mục hoặc contact sheet.
+
+Lưu từng ảnh nghĩa là mỗi ảnh một hộp thoại và một lần sao chép trên luồng giao
+diện. ExportJob chạy cả việc xuất trên một luồng riêng và báo tiến độ qua callback,
+nên xuất hàng trăm biến thể không làm đơ cửa sổ. Ảnh có thể được nén lại sang
+JPEG/WebP; việc nén chạy song song trên nhiều luồng (Pillow nhả GIL khi mã hóa),
+còn file ZIP được ghi tuần tự theo đúng thứ tự ảnh.
+
+    python exporter.py results/ --zip lo_anh.zip --format jpeg --quality 85
+    python exporter.py --batch <batch_id> --contact-sheet tong_hop.jpg
+"""
+import os
+import io
+import sys
+import argparse
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Định dạng nén lại được hỗ trợ: tên Pillow và phần mở rộng file
+EXPORT_FORMATS = {"jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}
+DEFAULT_QUALITY = 90
+CONTACT_SHEET_THUMB = 256
+
+class ExportCancelled(Exception):
+    pass
+
+def _flatten(img):
+    """Ảnh RGB (nền trong suốt được đặt lên nền trắng) để lưu JPEG"""
+    from PIL import Image
+
+    if img.mode == "RGB":
+        return img
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+def reencode(path, image_format, quality=DEFAULT_QUALITY):
+    """Đọc ảnh và nén lại sang image_format ("JPEG"/"WEBP"), trả về bytes"""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        img = _flatten(img) if image_format == "JPEG" else img.convert("RGBA" if "A" in img.mode else "RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format, quality=quality, optimize=image_format == "JPEG")
+        return buffer.getvalue()
+
+def export_name(name, export_format=None):
+    """Tên file trong bản xuất, đổi phần mở rộng nếu nén lại"""
+    if export_format is None:
+        return name
+    return os.path.splitext(name)[0] + EXPORT_FORMATS[export_format][1]
+
+def _ordered_map(func, items, workers):
+    """
+    Chạy func(item) song song trên workers luồng, sinh ra (item, kết quả) theo đúng
+    thứ tự items. Tối đa 2 * workers ảnh được xử lý trước để luồng ghi không phải
+    chờ mà bộ nhớ vẫn có giới hạn; dừng sớm (hủy xuất) chỉ phải chờ các ảnh đó.
+    """
+    workers = workers or os.cpu_count() or 4
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tryon-export') as executor:
+        pending = []
+        items = iter(items)
+        while True:
+            while len(pending) < 2 * workers:
+                item = next(items, None)
+                if item is None:
+                    break
+                pending.append((item, executor.submit(func, item)))
+            if not pending:
+                return
+            item, future = pending.pop(0)
+            yield item, future.result()
+
+def _encoded_items(items, export_format, quality, workers):
+    """Sinh ra (tên, bytes) theo đúng thứ tự items, nén lại nếu có export_format"""
+    if export_format is None:
+        for name, path in items:
+            with open(path, 'rb') as f:
+                yield name, f.read()
+        return
+    image_format = EXPORT_FORMATS[export_format][0]
+    encoded = _ordered_map(lambda item: reencode(item[1], image_format, quality), items, workers)
+    for (name, _), data in encoded:
+        yield export_name(name, export_format), data
+
+def export_zip(items, zip_path, export_format=None, quality=DEFAULT_QUALITY, progress=None, is_cancelled=None,
+               workers=None):
+    """
+    Ghi các ảnh (items: danh sách (tên trong ZIP, đường dẫn)) vào zip_path. Ảnh PNG
+    đã nén sẵn nên được lưu không nén lại (ZIP_STORED). File ZIP được ghi ra file
+    tạm rồi đổi tên, không bao giờ để lại bản xuất dở dang. Trả về số ảnh đã ghi.
+    """
+    items = list(items)
+    tmp_path = f"{zip_path}.tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(zip_path)), exist_ok=True)
+    count = 0
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, data in _encoded_items(items, export_format, quality, workers):
+                if is_cancelled is not None and is_cancelled():
+                    raise ExportCancelled()
+                archive.writestr(name, data)
+                count += 1
+                if progress is not None:
+                    progress(count, len(items))
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+def export_folder(items, folder, export_format=None, quality=DEFAULT_QUALITY, progress=None, is_cancelled=None,
+                  workers=None):
+    """Như export_zip() nhưng ghi từng ảnh vào thư mục folder. Trả về số ảnh đã ghi"""
+    from result_writer import write_file_atomic
+
+    items = list(items)
+    count = 0
+    for name, data in _encoded_items(items, export_format, quality, workers):
+        if is_cancelled is not None and is_cancelled():
+            raise ExportCancelled()
+        write_file_atomic(os.path.join(folder, name), data)
+        count += 1
+        if progress is not None:
+            progress(count, len(items))
+    return count
+
+def _thumbnail(path, thumb_size):
+    from PIL import Image
+
+    with Image.open(path) as img:
+        img.draft("RGB", (thumb_size, thumb_size))
+        img = _flatten(img)
+        img.thumbnail((thumb_size, thumb_size), Image.Resampling.LANCZOS)
+        return img
+
+def render_contact_sheet(items, out_path, columns=None, thumb_size=CONTACT_SHEET_THUMB, padding=8, labels=True,
+                         quality=DEFAULT_QUALITY, progress=None, is_cancelled=None, workers=None):
+    """
+    Ghép thumbnail các ảnh thành một ảnh lưới (contact sheet) giống lưới kết quả,
+    kèm tên dưới mỗi ảnh. Định dạng theo phần mở rộng của out_path. Trả về số ảnh.
+    """
+    from PIL import Image, ImageDraw
+
+    items = list(items)
+    if not items:
+        raise ValueError("Không có ảnh nào để ghép")
+    columns = columns or max(1, min(len(items), int(round(len(items) ** 0.5))))
+    rows = (len(items) + columns - 1) // columns
+    label_height = 16 if labels else 0
+    cell_width, cell_height = thumb_size + padding, thumb_size + label_height + padding
+    sheet = Image.new("RGB", (columns * cell_width + padding, rows * cell_height + padding), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+
+    thumbnails = _ordered_map(lambda item: _thumbnail(item[1], thumb_size), items, workers)
+    for index, ((name, _), thumb) in enumerate(thumbnails):
+        if is_cancelled is not None and is_cancelled():
+            raise ExportCancelled()
+        x = padding + (index % columns) * cell_width
+        y = padding + (index // columns) * cell_height
+        # Căn giữa ảnh không vuông trong ô
+        sheet.paste(thumb, (x + (thumb_size - thumb.width) // 2, y + (thumb_size - thumb.height) // 2))
+        if labels:
+            draw.text((x, y + thumb_size + 2), os.path.splitext(name)[0], fill=(60, 60, 60))
+        if progress is not None:
+            progress(index + 1, len(items))
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    sheet.save(out_path, quality=quality)
+    return len(items)
+
+class ExportJob:
+    """
+    Chạy một hàm xuất (export_zip, export_folder, render_contact_sheet) trên luồng
+    nền. progress(done, total) và on_finished(job) được gọi trên luồng đó; sau khi
+    xong, job.count là số ảnh đã xuất và job.error là lỗi (None nếu thành công).
+
+    before (tùy chọn) chạy đầu tiên trên luồng nền, ví dụ chờ các file kết quả
+    đang ghi dở (TryOnEngine.flush) mà không chặn luồng giao diện.
+    """
+    def __init__(self, export, items, target, progress=None, on_finished=None, before=None, **options):
+        self.export = export
+        self.items = list(items)
+        self.target = target
+        self.progress = progress
+        self.on_finished = on_finished
+        self.before = before
+        self.options = options
+        self.count = 0
+        self.error = None
+        self.cancelled = False
+        self._thread = None
+
+    @property
+    def total(self):
+        return len(self.items)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='tryon-export', daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            if self.before is not None:
+                self.before()
+            self.count = self.export(self.items, self.target, progress=self.progress,
+                                     is_cancelled=lambda: self.cancelled, **self.options)
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            import traceback
+            traceback.print_exception(type(e), e, e.__traceback__)
+            self.error = e
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+def collect_items(inputs=(), batch_id=None, person=None, garment=None, results_root='results'):
+    """
+    Danh sách (tên, đường dẫn) cần xuất, từ các file/thư mục ảnh, một lô trong
+    hàng đợi job (biến thể đã xong) hoặc truy vấn kho kết quả theo ảnh đầu vào.
+    """
+    items = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+                    items.append((name, os.path.join(path, name)))
+        else:
+            items.append((os.path.basename(path), path))
+    if batch_id:
+        from job_queue import JobQueue, DONE
+        queue = JobQueue()
+        try:
+            for row in queue.batch_jobs(batch_id):
+                if row['state'] == DONE and row['result_path'] and os.path.exists(row['result_path']):
+                    items.append((f"thudo_result_{row['variant_id'] + 1}.png", row['result_path']))
+        finally:
+            queue.close()
+    if person or garment:
+        from results_store import ResultStore
+        store = ResultStore(results_root)
+        try:
+            for row in store.find_by_input(person, garment):
+                if os.path.exists(row['path']):
+                    items.append((os.path.basename(row['path']), row['path']))
+        finally:
+            store.close()
+    # Tên trùng (từ nhiều thư mục) được thêm hậu tố để không ghi đè nhau trong ZIP
+    seen = {}
+    unique = []
+    for name, path in items:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        if count:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}_{count}{ext}"
+        unique.append((name, path))
+    return unique
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Xuất hàng loạt ảnh kết quả ra ZIP, thư mục hoặc contact sheet")
+    parser.add_argument('inputs', nargs='*', help="File ảnh hoặc thư mục kết quả")
+    parser.add_argument('--batch', help="Xuất các biến thể đã xong của một lô trong hàng đợi job")
+    parser.add_argument('--person', help="Xuất kết quả của ảnh người này trong kho kết quả")
+    parser.add_argument('--garment', help="Xuất kết quả của ảnh quần áo này trong kho kết quả")
+    parser.add_argument('--results-root', default='results', help="Thư mục kho kết quả")
+    parser.add_argument('--zip', help="File ZIP đầu ra")
+    parser.add_argument('--folder', help="Thư mục đầu ra")
+    parser.add_argument('--contact-sheet', help="Ảnh contact sheet đầu ra (.jpg, .png, .webp)")
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), help="Nén lại ảnh sang định dạng này")
+    parser.add_argument('--quality', type=int, default=DEFAULT_QUALITY)
+    parser.add_argument('--columns', type=int, help="Số cột của contact sheet (mặc định gần vuông)")
+    parser.add_argument('--thumb-size', type=int, default=CONTACT_SHEET_THUMB)
+    args = parser.parse_args(argv)
+
+    if not (args.zip or args.folder or args.contact_sheet):
+        parser.error("cần ít nhất một trong --zip, --folder, --contact-sheet")
+    items = collect_items(args.inputs, args.batch, args.person, args.garment, args.results_root)
+    if not items:
+        print("Không có ảnh nào để xuất")
+        return 1
+
+    def progress(done, total):
+        if done == total or done % 50 == 0:
+            print(f"  {done}/{total}")
+
+    if args.zip:
+        count = export_zip(items, args.zip, args.format, args.quality, progress)
+        print(f"Đã xuất {count} ảnh vào {args.zip}")
+    if args.folder:
+        count = export_folder(items, args.folder, args.format, args.quality, progress)
+        print(f"Đã xuất {count} ảnh vào {args.folder}")
+    if args.contact_sheet:
+        count = render_contact_sheet(items, args.contact_sheet, args.columns, args.thumb_size,
+                                     quality=args.quality, progress=progress)
+        print(f"Đã ghép {count} ảnh vào {args.contact_sheet}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# farm.py
+"""
+Chế độ worker farm cho catalog lớn: nhiều tiến trình, có thể trên nhiều máy.
+
+Một tiến trình Python (với GIL) phải tự làm mọi việc tốn CPU của từng biến thể:
+giải mã và thu nhỏ ảnh đầu vào, giải mã phản hồi, ghi PNG. Với catalog lớn phần
+này trở thành nút thắt bên cạnh thời gian chờ mạng. Farm chia lô cho N tiến trình
+worker, mỗi worker có engine riêng và lấy job từ một hàng đợi dùng chung:
+
+- file SQLite (--queue, mặc định như catalog.py) cho các worker trên cùng một máy
+- thư mục spool (--spool, xem spool_queue.py) trên ổ mạng cho worker trên nhiều máy
+
+Tiến trình điều phối thêm job vào hàng đợi, chạy các worker cục bộ, theo dõi tiến
+độ, đưa job của worker đã chết về hàng đợi và ghi chỉ mục kết quả khi lô xong.
+
+    python farm.py run --persons models/ --garments garments/ --workers 8
+    python farm.py run --persons models/ --garments garments/ --spool /mnt/shared/spool --workers 4
+    python farm.py worker --spool /mnt/shared/spool        # trên các máy khác
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import multiprocessing
+
+from job_queue import JobQueue, JOB_QUEUE_PATH, PENDING, RUNNING, DONE, FAILED
+from spool_queue import SpoolQueue
+from catalog import (load_image_list, iter_catalog_jobs, build_engine, IndexWriter, add_catalog_arguments,
+                     add_engine_arguments)
+
+# Job không có nhịp tim trong khoảng này (giây) được coi là của worker đã chết và được chạy lại
+DEFAULT_STALE_AFTER = 300.0
+
+def open_queue(args):
+    if args.spool:
+        return SpoolQueue(args.spool)
+    return JobQueue(args.queue)
+
+def run_worker(args):
+    """
+    Vòng lặp của một worker: lấy job từ hàng đợi, chạy bằng engine riêng và ghi kết
+    quả lại vào hàng đợi. Worker dừng khi lô không còn job chờ hay đang chạy (trừ
+    khi có --wait); job đang chạy dở khi bị dừng (Ctrl+C) được trả lại hàng đợi.
+    """
+    queue = open_queue(args)
+    engine = build_engine(args)
+    name = f"worker {os.getpid()}"
+    claimed = set()
+    claimed_lock = threading.Lock()
+    counts = {DONE: 0, FAILED: 0, PENDING: 0}
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(args.stale_after / 3):
+            with claimed_lock:
+                job_ids = list(claimed)
+            for job_id in job_ids:
+                queue.touch(job_id)
+
+    def record(result):
+        if result.saved is not None and result.saved.exception() is not None:
+            result.success = False
+            result.message = f"Không ghi được file kết quả: {result.saved.exception()}"
+        state = queue.complete_result(result)
+        with claimed_lock:
+            claimed.discard(result.job.job_id)
+            if state in counts:
+                counts[state] += 1
+
+    def on_result(result):
+        # Chỉ báo job là xong khi file kết quả đã thực sự nằm trên đĩa
+        if result.saved is not None:
+            result.saved.add_done_callback(lambda _: record(result))
+        else:
+            record(result)
+
+    def claims():
+        for job in queue.iter_claims(args.batch):
+            with claimed_lock:
+                claimed.add(job.job_id)
+            yield job
+
+    threading.Thread(target=heartbeat, name='tryon-farm-heartbeat', daemon=True).start()
+    print(f"{name}: bắt đầu lấy job")
+    try:
+        while True:
+            asyncio.run(engine.run_stream(claims(), on_result))
+            engine.flush()
+            remaining = queue.counts(args.batch)
+            if not args.wait and not remaining.get(PENDING) and not remaining.get(RUNNING):
+                break
+            # Job của worker khác có thể bị trả lại hàng đợi (lỗi, worker chết): chờ rồi thử lại
+            time.sleep(args.poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        engine.flush()
+        with claimed_lock:
+            unfinished = list(claimed)
+        for job_id in unfinished:
+            queue.release(job_id)
+        if engine.telemetry is not None:
+            engine.telemetry.close()
+        queue.close()
+    print(f"{name}: {counts[DONE]} thành công, {counts[FAILED]} lỗi, {counts[PENDING]} trả lại để thử lại, "
+          f"{len(unfinished)} chạy dở được trả lại hàng đợi")
+    return 0
+
+def _worker_process(args):
+    try:
+        run_worker(args)
+    except KeyboardInterrupt:
+        pass
+
+def worker_args(args, workers):
+    """Tham số cho worker cục bộ: quota API được chia đều cho các worker"""
+    worker = argparse.Namespace(**vars(args))
+    worker.rate = args.rate / workers
+    worker.max_rate = args.max_rate / workers
+    worker.metrics_port = None
+    worker.metrics_file = None
+    worker.trace = None
+    worker.wait = False
+    return worker
+
+def run_farm(args):
+    persons = load_image_list(args.persons)
+    garments = load_image_list(args.garments)
+    jobs = list(iter_catalog_jobs(persons, garments, args.variants, args.output, args.prompt))
+    if not jobs:
+        print("Không có cặp ảnh nào để xử lý")
+        return 1
+
+    queue = open_queue(args)
+    # Lô được xác định theo thư mục output (như catalog.py): chạy lại cùng lệnh sẽ tiếp tục lô cũ
+    args.batch = 'catalog:' + os.path.abspath(args.output)
+    recovered = queue.recover(args.stale_after)
+    queue.enqueue(jobs, args.batch)
+    counts = queue.counts(args.batch)
+    total = len(jobs)
+    already_done = counts.get(DONE, 0)
+    print(f"Farm: {total} job, {already_done} đã xong từ trước, {counts.get(PENDING, 0)} đang chờ "
+          f"({recovered} job chạy dở được khôi phục)")
+    print(f"Hàng đợi: {args.spool or args.queue}, lô {args.batch}")
+
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for _ in range(args.workers):
+        process = context.Process(target=_worker_process, args=(worker_args(args, args.workers),))
+        process.start()
+        processes.append(process)
+    if args.workers:
+        print(f"Đã chạy {args.workers} worker cục bộ")
+    else:
+        print("Không chạy worker cục bộ, chờ worker trên các máy khác (farm.py worker)")
+
+    start = time.perf_counter()
+    last_report = None
+    try:
+        while True:
+            time.sleep(args.poll)
+            queue.recover(args.stale_after)
+            counts = queue.counts(args.batch)
+            finished = counts.get(DONE, 0) + counts.get(FAILED, 0)
+            if finished != last_report:
+                last_report = finished
+                elapsed = time.perf_counter() - start
+                rate = (finished - already_done) / elapsed if elapsed > 0 else 0.0
+                print(f"[{time.strftime('%H:%M:%S')}] {finished}/{total} biến thể xong "
+                      f"({counts.get(FAILED, 0)} lỗi, {counts.get(RUNNING, 0)} đang chạy) - {rate:.2f} biến thể/giây")
+            if not counts.get(PENDING) and not counts.get(RUNNING):
+                break
+            if processes and not any(process.is_alive() for process in processes):
+                print("Mọi worker cục bộ đã dừng nhưng lô chưa xong; chạy lại lệnh để tiếp tục")
+                break
+    except KeyboardInterrupt:
+        # Worker cũng nhận Ctrl+C và tự trả job đang chạy dở về hàng đợi
+        print("Đã dừng theo yêu cầu người dùng")
+    finally:
+        for process in processes:
+            process.join()
+
+    index = IndexWriter(args.index or os.path.join(args.output, 'index.jsonl'))
+    rows = [row for row in queue.batch_jobs(args.batch) if row['state'] in (DONE, FAILED)]
+    for row in rows:
+        index.write_job_row(row)
+    index.close()
+    queue.close()
+
+    counts = {DONE: 0, FAILED: 0}
+    for row in rows:
+        counts[row['state']] += 1
+    elapsed = time.perf_counter() - start
+    print(f"Hoàn tất: {counts[DONE]} thành công, {counts[FAILED]} lỗi, {total - len(rows)} chưa chạy "
+          f"trong {elapsed:.1f} giây - {(len(rows) - already_done) / elapsed if elapsed > 0 else 0.0:.2f} biến thể/giây")
+    print(f"Chỉ mục kết quả: {index.path}")
+    return 0 if counts[FAILED] == 0 and len(rows) == total else 2
+
+def add_queue_arguments(parser):
+    parser.add_argument('--queue', default=JOB_QUEUE_PATH,
+                        help="File SQLite hàng đợi job dùng chung (các worker trên cùng một máy)")
+    parser.add_argument('--spool', help="Thư mục spool dùng chung thay cho file SQLite (worker trên nhiều máy)")
+    parser.add_argument('--stale-after', type=float, default=DEFAULT_STALE_AFTER,
+                        help="Job không có nhịp tim sau số giây này được chạy lại bởi worker khác")
+    parser.add_argument('--poll', type=float, default=2.0, help="Chu kỳ kiểm tra hàng đợi (giây)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Chạy catalog trên nhiều tiến trình worker, có thể trên nhiều máy")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Thêm lô catalog vào hàng đợi, chạy worker cục bộ và theo dõi tiến độ")
+    add_catalog_arguments(run)
+    run.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                     help="Số tiến trình worker cục bộ (mặc định bằng số lõi CPU; 0 = chỉ dùng worker ở máy khác)")
+    add_queue_arguments(run)
+    add_engine_arguments(run)
+
+    worker = commands.add_parser('worker', help="Chạy một worker lấy job từ hàng đợi dùng chung")
+    worker.add_argument('--batch', help="Chỉ lấy job của lô này (mặc định mọi lô)")
+    worker.add_argument('--output', default='catalog_results', help="Thư mục kết quả cho job không có đường dẫn riêng")
+    worker.add_argument('--wait', action='store_true', help="Tiếp tục chờ job mới khi hàng đợi đã hết")
+    add_queue_arguments(worker)
+    add_engine_arguments(worker)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'worker':
+        return run_worker(args)
+    return run_farm(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
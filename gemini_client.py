@@ -0,0 +1,126 @@
+# gemini_client.py
+"""
+Client Gemini dùng chung cho mỗi API key.
+
+Không gọi genai.configure() (thay đổi trạng thái toàn cục của SDK): mỗi API key
+có một GenerativeServiceClient riêng, tạo một lần và dùng chung cho mọi worker.
+Với gRPC, mọi request của key đi chung một kênh HTTP/2 nên kết nối và phiên TLS
+được dùng lại; với REST, session HTTP có pool kết nối đủ lớn cho số worker.
+warm_up()/warm_up_async() tạo client và mở kết nối trước khi có job đầu tiên.
+"""
+import time
+import asyncio
+import weakref
+import threading
+
+DEFAULT_POOL_SIZE = 16
+
+class GeminiClient:
+    """
+    Client (đồng bộ và bất đồng bộ) cùng các GenerativeModel của một API key.
+
+    Client bất đồng bộ của gRPC gắn với event loop đang chạy nên được tạo riêng
+    cho mỗi loop; transport REST (khi có endpoint) chỉ có client đồng bộ.
+    """
+    def __init__(self, api_key, endpoint=None, pool_size=DEFAULT_POOL_SIZE):
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.transport = "rest" if endpoint else "grpc"
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._client = None
+        self._models = {}
+        self._async_models = weakref.WeakKeyDictionary()  # event loop -> {model_name: GenerativeModel}
+
+    def _client_options(self):
+        options = {"api_key": self.api_key}
+        if self.endpoint:
+            options["api_endpoint"] = self.endpoint
+        return options
+
+    def _sync_client(self):
+        """Gọi khi đang giữ self._lock"""
+        if self._client is None:
+            import google.ai.generativelanguage as glm
+            if not self.api_key:
+                raise Exception("Không tìm thấy API key")
+            self._client = glm.GenerativeServiceClient(client_options=self._client_options(),
+                                                       transport=self.transport)
+            if self.transport == "rest":
+                self._size_rest_pool()
+        return self._client
+
+    def _size_rest_pool(self):
+        """Mặc định requests chỉ giữ 10 kết nối mỗi host; nới ra theo số worker"""
+        try:
+            from requests.adapters import HTTPAdapter
+            session = self._client.transport._session
+        except (ImportError, AttributeError):
+            return
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def model(self, model_name, timings=None):
+        """
+        GenerativeModel dùng client của key này (tạo một lần). Nếu truyền dict
+        timings, thời gian "configure" (import SDK và tạo client) và "model_init" được ghi vào đó.
+        """
+        with self._lock:
+            model = self._models.get(model_name)
+            if model is None:
+                start = time.perf_counter()
+                import google.generativeai as genai
+                client = self._sync_client()
+                configured = time.perf_counter()
+                model = genai.GenerativeModel(model_name)
+                # Gắn client riêng của key thay vì client mặc định lấy từ genai.configure()
+                model._client = client
+                self._models[model_name] = model
+                if timings is not None:
+                    timings["configure"] = configured - start
+                    timings["model_init"] = time.perf_counter() - configured
+            return model
+
+    def async_model(self, model_name):
+        """GenerativeModel có client bất đồng bộ gắn với event loop đang chạy"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            models = self._async_models.setdefault(loop, {})
+            model = models.get(model_name)
+        if model is not None:
+            return model
+        import google.ai.generativelanguage as glm
+        import google.generativeai as genai
+        model = genai.GenerativeModel(model_name)
+        model._async_client = glm.GenerativeServiceAsyncClient(client_options=self._client_options(),
+                                                               transport="grpc_asyncio")
+        with self._lock:
+            return models.setdefault(model_name, model)
+
+    def warm_up(self, model_name, timeout=10.0):
+        """Tạo client và (với gRPC) mở sẵn kết nối, gồm cả bắt tay TLS"""
+        self.model(model_name)
+        if self.transport == "grpc":
+            import grpc
+            grpc.channel_ready_future(self._client.transport.grpc_channel).result(timeout)
+
+    async def warm_up_async(self, model_name, timeout=10.0):
+        """Như warm_up() cho client bất đồng bộ của event loop đang chạy"""
+        loop = asyncio.get_running_loop()
+        # Import SDK và tạo client ở thread khác để không chặn event loop
+        await loop.run_in_executor(None, self.model, model_name)
+        if self.transport == "grpc":
+            model = self.async_model(model_name)
+            await asyncio.wait_for(model._async_client.transport.grpc_channel.channel_ready(), timeout)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key, endpoint=None):
+    """GeminiClient dùng chung trong tiến trình cho cặp (api_key, endpoint)"""
+    with _clients_lock:
+        client = _clients.get((api_key, endpoint))
+        if client is None:
+            client = _clients[(api_key, endpoint)] = GeminiClient(api_key, endpoint)
+        return client
@@ -0,0 +1,101 @@
+# hedging.py
+"""
+Gửi request dự phòng (hedged request) để giảm độ trễ đuôi của một lô.
+
+Một lô chỉ xong khi biến thể chậm nhất xong. Khi lời gọi API của một biến thể
+chạy lâu hơn phân vị percentile của các lời gọi gần đây, TryOnEngine gửi thêm
+một request giống hệt; kết quả thành công đến trước được dùng, request còn lại bị hủy.
+
+Số request dự phòng bị giới hạn bằng quỹ tín dụng: mỗi lời gọi chính cộng thêm
+max_ratio tín dụng, mỗi request dự phòng tốn 1, nên tỷ lệ dự phòng về lâu dài
+không vượt quá max_ratio (chi phí thêm tối đa max_ratio số request).
+"""
+import threading
+from collections import deque
+
+class HedgePolicy:
+    """
+    Chính sách gửi request dự phòng, dùng chung cho mọi job của engine.
+
+    percentile: phân vị độ trễ kích hoạt dự phòng (tính trên window lời gọi
+    thành công gần nhất, chỉ khi đã có ít nhất min_samples mẫu).
+    min_delay: không gửi dự phòng sớm hơn mức này (giây).
+    max_ratio: tỷ lệ request dự phòng tối đa so với số lời gọi chính.
+    enabled có thể bật/tắt trong lúc chạy (ví dụ từ giao diện).
+    """
+    def __init__(self, percentile=75.0, min_samples=10, window=200, min_delay=0.5, max_ratio=0.1,
+                 max_burst=2.0, enabled=True):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.max_burst = max(1.0, max_burst)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._credits = 0.0
+        self.primaries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.denied = 0
+
+    def observe(self, latency):
+        """Ghi nhận thời gian của một lời gọi API thành công (chính hoặc dự phòng)"""
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _delay(self):
+        """Gọi khi đang giữ self._lock"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        values = sorted(self._latencies)
+        index = min(len(values) - 1, int(round(self.percentile / 100.0 * (len(values) - 1))))
+        return max(self.min_delay, values[index])
+
+    def start_primary(self):
+        """
+        Bắt đầu một lời gọi chính: cộng tín dụng và trả về số giây chờ trước khi
+        gửi dự phòng, hoặc None nếu không gửi dự phòng cho lời gọi này.
+        """
+        with self._lock:
+            self.primaries += 1
+            self._credits = min(self.max_burst, self._credits + self.max_ratio)
+            return self._delay() if self.enabled else None
+
+    def try_hedge(self):
+        """Dùng một tín dụng để gửi dự phòng; False nếu đã chạm giới hạn tỷ lệ"""
+        with self._lock:
+            if self._credits < 1.0:
+                self.denied += 1
+                return False
+            self._credits -= 1.0
+            self.hedges += 1
+            return True
+
+    def refund_hedge(self):
+        """Trả lại tín dụng khi không gửi được dự phòng (ví dụ limiter hết token)"""
+        with self._lock:
+            self._credits += 1.0
+            self.hedges -= 1
+
+    def on_hedge_won(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    @property
+    def delay(self):
+        """Ngưỡng độ trễ hiện tại (giây), None khi chưa đủ mẫu"""
+        with self._lock:
+            return self._delay()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "primaries": self.primaries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "denied": self.denied,
+                "hedge_rate": self.hedges / self.primaries if self.primaries else 0.0,
+                "delay": self._delay(),
+            }
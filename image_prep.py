@@ -0,0 +1,177 @@
+# image_prep.py
+"""
+Chuẩn bị ảnh đầu vào một lần cho cả lô.
+
+Ảnh được giải mã, xoay đúng theo EXIF, thu nhỏ về cạnh dài tối đa và nén lại
+trước khi gửi lên API. Kết quả được cache theo hash nội dung file nên cùng một
+ảnh quần áo không bị xử lý lại giữa các lô.
+"""
+import os
+import io
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_EDGE = 1024
+DEFAULT_QUALITY = 90
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Tính hash SHA-256 của nội dung file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class PreparedImage:
+    """
+    Ảnh đã chuẩn bị, dùng chung cho mọi biến thể trong lô
+    """
+    def __init__(self, sha256, data, mime_type, size=None):
+        self.sha256 = sha256
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+
+    def as_part(self):
+        """Dạng blob mà google.generativeai chấp nhận trong generate_content"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def __repr__(self):
+        return f"PreparedImage({self.sha256[:12]}, {self.mime_type}, {len(self.data)} bytes, size={self.size})"
+
+class ImagePreparer:
+    """
+    Giải mã, sửa hướng EXIF, thu nhỏ và nén lại ảnh. Thread-safe: nhiều biến thể
+    yêu cầu cùng một ảnh thì chỉ một luồng thực sự xử lý, các luồng khác dùng lại kết quả.
+
+    cache_dir (tùy chọn) lưu kết quả xuống đĩa để dùng lại giữa các lần chạy.
+    """
+    def __init__(self, max_edge=DEFAULT_MAX_EDGE, image_format="JPEG", quality=DEFAULT_QUALITY,
+                 cache_size=32, cache_dir=None):
+        self.max_edge = max_edge
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self._cache = OrderedDict()
+        self._digests = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def mime_type(self):
+        return "image/" + ("jpeg" if self.image_format == "JPEG" else self.image_format.lower())
+
+    def digest(self, path):
+        """Hash SHA-256 của file ảnh gốc (là PreparedImage.sha256), không giải mã ảnh"""
+        return self._digest(path)
+
+    def _digest(self, path):
+        """Hash nội dung file, ghi nhớ theo (đường dẫn, mtime, kích thước) để không đọc lại file"""
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+        if digest is None:
+            digest = file_sha256(path)
+            with self._lock:
+                self._digests[memo_key] = digest
+        return digest
+
+    def _cache_get(self, digest):
+        with self._lock:
+            prepared = self._cache.get(digest)
+            if prepared is not None:
+                self._cache.move_to_end(digest)
+            return prepared
+
+    def _cache_put(self, digest, prepared):
+        with self._lock:
+            self._cache[digest] = prepared
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _disk_path(self, digest):
+        ext = "jpg" if self.image_format == "JPEG" else self.image_format.lower()
+        return os.path.join(self.cache_dir, f"{digest}_{self.max_edge}_{self.quality}.{ext}")
+
+    def prepare(self, path):
+        """Trả về PreparedImage cho file ảnh, dùng cache nếu đã xử lý trước đó"""
+        digest = self._digest(path)
+        prepared = self._cache_get(digest)
+        if prepared is not None:
+            return prepared
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(digest, threading.Lock())
+        with key_lock:
+            # Luồng khác có thể vừa xử lý xong trong lúc chờ khóa
+            prepared = self._cache_get(digest)
+            if prepared is None:
+                prepared = self._load_from_disk(digest) or self._encode(path, digest)
+                self._cache_put(digest, prepared)
+        with self._lock:
+            self._key_locks.pop(digest, None)
+        return prepared
+
+    def prepare_many(self, paths):
+        """Chuẩn bị mỗi file một lần, trả về dict đường dẫn -> PreparedImage"""
+        return {path: self.prepare(path) for path in dict.fromkeys(paths)}
+
+    def _load_from_disk(self, digest):
+        if not self.cache_dir:
+            return None
+        disk_path = self._disk_path(digest)
+        if not os.path.exists(disk_path):
+            return None
+        with open(disk_path, 'rb') as f:
+            return PreparedImage(digest, f.read(), self.mime_type)
+
+    def _encode(self, path, digest):
+        from PIL import Image, ImageOps
+
+        with Image.open(path) as img:
+            if self.max_edge:
+                # draft() cho phép bộ giải mã JPEG đọc thẳng ở độ phân giải thấp hơn
+                img.draft("RGB", (self.max_edge, self.max_edge))
+            img = ImageOps.exif_transpose(img)
+            if self.max_edge:
+                img.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS)
+            if self.image_format == "JPEG" and img.mode != "RGB":
+                if img.mode in ("RGBA", "LA", "P"):
+                    # Ảnh có nền trong suốt (thường là ảnh quần áo) được đặt lên nền trắng
+                    img = img.convert("RGBA")
+                    background = Image.new("RGB", img.size, (255, 255, 255))
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                else:
+                    img = img.convert("RGB")
+
+            buffer = io.BytesIO()
+            img.save(buffer, format=self.image_format, quality=self.quality, optimize=True)
+            size = img.size
+
+        prepared = PreparedImage(digest, buffer.getvalue(), self.mime_type, size)
+        if self.cache_dir:
+            with open(self._disk_path(digest), 'wb') as f:
+                f.write(prepared.data)
+        return prepared
+
+class PassthroughPreparer(ImagePreparer):
+    """
+    Không giải mã lại ảnh: gửi nguyên bytes của file, vẫn có cache theo hash.
+    Dùng khi muốn giữ nguyên ảnh gốc hoặc với backend giả lập không cần Pillow.
+    """
+    def __init__(self, cache_size=32):
+        super().__init__(max_edge=None, cache_size=cache_size)
+
+    def _encode(self, path, digest):
+        with open(path, 'rb') as f:
+            data = f.read()
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        return PreparedImage(digest, data, mime_type)
@@ -0,0 +1,54 @@
+# inflight.py
+"""
+Gộp các request giống hệt nhau đang chạy cùng lúc.
+
+Cache kết quả chỉ giúp khi request trước đã xong. Nếu hai lần bấm liên tiếp
+(hoặc hai client của cùng một engine, hoặc catalog lặp lại cùng một ảnh quần áo)
+gửi cùng ảnh, prompt và cấu hình khi request đầu vẫn đang chạy, mỗi request
+vẫn gọi API riêng. InFlightRequests giữ một Future cho mỗi khóa nội dung (cùng
+khóa với result_cache): request đầu tiên gọi API, các request trùng chờ và dùng
+chung bytes ảnh của nó.
+"""
+import threading
+from concurrent.futures import Future, InvalidStateError
+
+class InFlightRequests:
+    """
+    Các request đang chạy theo khóa nội dung, an toàn khi dùng từ nhiều luồng và
+    nhiều event loop. Future của mỗi khóa nhận bytes ảnh kết quả, hoặc None nếu
+    request đầu tiên lỗi hay bị hủy (khi đó các request trùng tự gọi API).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """Trả về (future, True nếu đây là request đầu tiên của khóa và phải tự gọi API)"""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._flights[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def finish(self, key, future, data=None):
+        """Request đầu tiên kết thúc: chuyển bytes ảnh (None nếu lỗi) cho các request đang chờ"""
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+        try:
+            future.set_result(data)
+        except InvalidStateError:
+            pass
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
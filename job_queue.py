@@ -0,0 +1,233 @@
+# job_queue.py
+"""
+Hàng đợi job bền vững lưu trong SQLite.
+
+Mỗi job được ghi lại (đầu vào, prompt, cấu hình, số lần thử, trạng thái, đường dẫn
+kết quả) trước khi chạy. Khi ứng dụng bị tắt đột ngột hoặc khởi động lại, các job
+đang chạy dở được đưa về trạng thái chờ và chạy tiếp; job đã xong không bao giờ bị
+chạy lại (không mất tiền API lần nữa).
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from tryon_engine import TryOnJob
+
+JOB_QUEUE_PATH = os.path.join('cache', 'jobs.sqlite3')
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_key TEXT NOT NULL UNIQUE,
+    batch_id TEXT NOT NULL,
+    person_image_path TEXT NOT NULL,
+    clothing_image_path TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    variant_id INTEGER NOT NULL,
+    generation_config TEXT NOT NULL,
+    output_path TEXT,
+    sample INTEGER,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result_path TEXT,
+    message TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_batch_state ON jobs (batch_id, state);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+def new_batch_id(prefix='batch'):
+    return f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+
+def job_key(batch_id, job):
+    """Khóa duy nhất của job trong một lô, để thêm lại cùng job không tạo bản ghi trùng"""
+    fields = [batch_id, job.person_image_path, job.clothing_image_path, job.prompt,
+              job.variant_id, job.generation_config, job.output_path]
+    if job.sample is not None:
+        # Chỉ thêm khi có, để khóa của job cũ (không có sample) không đổi
+        fields.append(job.sample)
+    payload = json.dumps(fields, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class JobQueue:
+    """
+    Hàng đợi job trong một file SQLite (chế độ WAL), dùng chung được giữa các luồng.
+    """
+    def __init__(self, db_path=JOB_QUEUE_PATH, max_attempts=3):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if 'sample' not in columns:
+            # File hàng đợi tạo trước khi có cột sample (sweep.py)
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN sample INTEGER")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def enqueue(self, jobs, batch_id):
+        """Thêm các job vào lô batch_id (bỏ qua job đã có). Trả về danh sách id theo thứ tự jobs"""
+        now = time.time()
+        ids = []
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for job in jobs:
+                    key = job_key(batch_id, job)
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO jobs (job_key, batch_id, person_image_path, clothing_image_path, "
+                        "prompt, variant_id, generation_config, output_path, sample, created_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, batch_id, job.person_image_path, job.clothing_image_path, job.prompt,
+                         job.variant_id, json.dumps(job.generation_config), job.output_path, job.sample,
+                         now, now))
+                    row = self._conn.execute("SELECT id FROM jobs WHERE job_key = ?", (key,)).fetchone()
+                    job.job_id = row['id']
+                    ids.append(row['id'])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return ids
+
+    def recover(self, stale_after=None):
+        """
+        Gọi khi khởi động: job đang 'running' của lần chạy trước (bị tắt giữa chừng)
+        được đưa về 'pending'. Khi nhiều tiến trình dùng chung hàng đợi, stale_after
+        chỉ khôi phục job không có nhịp tim (touch()) trong stale_after giây.
+        Trả về số job được khôi phục.
+        """
+        now = time.time()
+        if stale_after is None:
+            cursor = self._execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE state = ?", (PENDING, now, RUNNING))
+        else:
+            cursor = self._execute(
+                "UPDATE jobs SET state = ?, updated_at = ? WHERE state = ? AND updated_at < ?",
+                (PENDING, now, RUNNING, now - stale_after))
+        return cursor.rowcount
+
+    def touch(self, job_id):
+        """Nhịp tim của job đang chạy, để recover(stale_after) không coi nó là bị bỏ dở"""
+        self._execute("UPDATE jobs SET updated_at = ? WHERE id = ? AND state = ?", (time.time(), job_id, RUNNING))
+
+    def release(self, job_id):
+        """Trả job đang chạy về hàng đợi mà không tính là một lần thử (worker dừng giữa chừng)"""
+        self._execute("UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), updated_at = ? "
+                      "WHERE id = ? AND state = ?", (PENDING, time.time(), job_id, RUNNING))
+
+    def claim(self, batch_id=None):
+        """Lấy một job đang chờ và đánh dấu đang chạy. Trả về TryOnJob hoặc None nếu hết job"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if batch_id is None:
+                    row = self._conn.execute(
+                        "SELECT * FROM jobs WHERE state = ? ORDER BY id LIMIT 1", (PENDING,)).fetchone()
+                else:
+                    row = self._conn.execute(
+                        "SELECT * FROM jobs WHERE state = ? AND batch_id = ? ORDER BY id LIMIT 1",
+                        (PENDING, batch_id)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET state = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (RUNNING, time.time(), row['id']))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.row_to_job(row) if row is not None else None
+
+    def iter_claims(self, batch_id=None):
+        """Generator lấy lần lượt các job đang chờ, dùng được trực tiếp với TryOnEngine.run_stream"""
+        while True:
+            job = self.claim(batch_id)
+            if job is None:
+                return
+            yield job
+
+    def mark_running(self, job_id):
+        self._execute("UPDATE jobs SET state = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                      (RUNNING, time.time(), job_id))
+
+    def complete(self, job_id, success, result_path=None, message=None, retry=True):
+        """
+        Ghi kết quả của job. Job lỗi được đưa lại hàng đợi nếu retry=True và chưa quá
+        max_attempts lần thử.
+        """
+        if success:
+            state = DONE
+        elif not retry:
+            state = FAILED
+        else:
+            rows = self._query("SELECT attempts FROM jobs WHERE id = ?", (job_id,))
+            state = PENDING if rows and rows[0]['attempts'] < self.max_attempts else FAILED
+        self._execute("UPDATE jobs SET state = ?, result_path = ?, message = ?, updated_at = ? WHERE id = ?",
+                      (state, result_path if success else None, message, time.time(), job_id))
+        return state
+
+    def complete_result(self, result):
+        """Ghi một TryOnResult của engine vào hàng đợi"""
+        return self.complete(result.job.job_id, result.success,
+                             result.image_path if result.success else None,
+                             None if result.success else result.message)
+
+    def cancel_batch(self, batch_id):
+        """Hủy các job chưa xong của lô (job đã xong được giữ nguyên)"""
+        cursor = self._execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE batch_id = ? AND state IN (?, ?)",
+            (CANCELLED, time.time(), batch_id, PENDING, RUNNING))
+        return cursor.rowcount
+
+    def counts(self, batch_id=None):
+        """Số job theo trạng thái"""
+        if batch_id is None:
+            rows = self._query("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")
+        else:
+            rows = self._query("SELECT state, COUNT(*) AS n FROM jobs WHERE batch_id = ? GROUP BY state",
+                               (batch_id,))
+        return {row['state']: row['n'] for row in rows}
+
+    def batch_jobs(self, batch_id):
+        """Mọi job của lô kèm trạng thái, theo thứ tự variant"""
+        return self._query("SELECT * FROM jobs WHERE batch_id = ? ORDER BY variant_id, id", (batch_id,))
+
+    def latest_unfinished_batch(self, prefix):
+        """Lô gần nhất có tiền tố prefix còn job chưa xong, hoặc None"""
+        rows = self._query(
+            "SELECT batch_id FROM jobs WHERE batch_id LIKE ? AND state IN (?, ?) ORDER BY id DESC LIMIT 1",
+            (prefix + '%', PENDING, RUNNING))
+        return rows[0]['batch_id'] if rows else None
+
+    @staticmethod
+    def row_to_job(row):
+        return TryOnJob(row['person_image_path'], row['clothing_image_path'], row['prompt'],
+                        row['variant_id'], json.loads(row['generation_config']),
+                        output_path=row['output_path'], job_id=row['id'],
+                        sample=row['sample'] if 'sample' in row.keys() else None)
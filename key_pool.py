@@ -0,0 +1,205 @@
+# key_pool.py
+"""
+Nhóm nhiều API key để tăng thông lượng vượt quota của một key.
+
+Mỗi key có AdaptiveRateLimiter riêng (token bucket + AIMD), nên quota được tính
+riêng cho từng key. Mỗi request được gán cho key còn nhiều token nhất; key trả
+lỗi quota (429) bị tạm loại khỏi nhóm một thời gian, tăng gấp đôi nếu lỗi lặp
+lại liên tiếp. Tổng thông lượng vì vậy tăng gần tuyến tính theo số key.
+
+ApiKeyPool dùng được ở mọi chỗ nhận AdaptiveRateLimiter (TryOnEngine, telemetry,
+thanh trạng thái): acquire_key() trả về key được chọn để engine gọi API bằng key đó.
+"""
+import re
+import os
+import time
+import asyncio
+import threading
+
+from rate_limiter import AdaptiveRateLimiter
+
+# Biến môi trường chứa danh sách key, cách nhau bởi dấu phẩy, khoảng trắng hoặc xuống dòng
+KEYS_ENV = "GEMINI_API_KEYS"
+
+def parse_api_keys(text):
+    """Tách danh sách key; bỏ dòng trống, dòng chú thích (#) và key trùng"""
+    keys = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0]
+        for key in re.split(r"[\s,;]+", line):
+            if key and key not in keys:
+                keys.append(key)
+    return keys
+
+def read_api_keys(file_path='api_key.txt'):
+    """
+    Đọc danh sách API key: từ biến môi trường GEMINI_API_KEYS nếu có, ngược lại
+    từ file (mỗi dòng một key). Trả về list, rỗng nếu không có key nào.
+    """
+    env_keys = parse_api_keys(os.environ.get(KEYS_ENV, ""))
+    if env_keys:
+        return env_keys
+    try:
+        with open(file_path, 'r') as file:
+            return parse_api_keys(file.read())
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"Lỗi khi đọc file API key: {str(e)}")
+        return []
+
+def mask_key(api_key):
+    """Chỉ hiện 4 ký tự cuối của key khi in ra log/metrics"""
+    return f"…{api_key[-4:]}"
+
+class _KeyState:
+    def __init__(self, api_key, limiter):
+        self.api_key = api_key
+        self.limiter = limiter
+        self.benched_until = 0.0
+        self.consecutive_limited = 0
+        self.successes = 0
+        self.rate_limited = 0
+
+class ApiKeyPool:
+    """
+    Nhóm API key với limiter riêng cho mỗi key.
+
+    initial_rate/max_rate áp dụng cho từng key. Key gặp lỗi quota bị tạm loại
+    bench_seconds giây (hoặc theo Retry-After nếu lâu hơn), nhân đôi sau mỗi lần
+    lỗi liên tiếp, tối đa max_bench_seconds.
+    """
+    def __init__(self, keys, initial_rate=2.0, max_rate=20.0, bench_seconds=5.0, max_bench_seconds=300.0):
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            raise ValueError("Cần ít nhất một API key")
+        self.bench_seconds = bench_seconds
+        self.max_bench_seconds = max_bench_seconds
+        self._lock = threading.Lock()
+        self._states = {key: _KeyState(key, AdaptiveRateLimiter(initial_rate, max_rate=max_rate))
+                        for key in keys}
+
+    @property
+    def keys(self):
+        return list(self._states)
+
+    def __len__(self):
+        return len(self._states)
+
+    @property
+    def current_rate(self):
+        """Tổng tốc độ gửi của các key đang hoạt động (request/giây)"""
+        now = time.monotonic()
+        with self._lock:
+            states = [state for state in self._states.values() if state.benched_until <= now]
+        return sum(state.limiter.current_rate for state in states)
+
+    @property
+    def throttled_count(self):
+        return sum(state.limiter.throttled_count for state in self._states.values())
+
+    def stats(self):
+        """Trạng thái tổng hợp (cùng dạng AdaptiveRateLimiter.stats()) kèm trạng thái từng key"""
+        now = time.monotonic()
+        keys = []
+        tokens = 0.0
+        with self._lock:
+            states = list(self._states.values())
+            benched = {state.api_key: max(0.0, state.benched_until - now) for state in states}
+        for state in states:
+            limiter_stats = state.limiter.stats()
+            tokens += limiter_stats["tokens"]
+            keys.append({
+                "key": mask_key(state.api_key),
+                "rate": limiter_stats["rate"],
+                "benched_for": max(benched[state.api_key], limiter_stats["paused_for"]),
+                "successes": state.successes,
+                "throttled": limiter_stats["throttled"],
+            })
+        active = [key for key in keys if key["benched_for"] <= 0]
+        return {
+            "rate": sum(key["rate"] for key in active),
+            "tokens": tokens,
+            # Chỉ coi là tạm dừng khi mọi key đều đang bị loại
+            "paused_for": 0.0 if active else min(key["benched_for"] for key in keys),
+            "throttled": sum(key["throttled"] for key in keys),
+            "active_keys": len(active),
+            "keys": keys,
+        }
+
+    def _try_acquire(self):
+        """Trả về (api_key, 0) nếu lấy được token của một key, ngược lại (None, số giây nên chờ)"""
+        now = time.monotonic()
+        with self._lock:
+            states = list(self._states.values())
+        available = [state for state in states if state.benched_until <= now]
+        if not available:
+            return None, min(state.benched_until for state in states) - now
+        # Key còn nhiều token nhất trước; bằng nhau thì key có tốc độ cao hơn
+        available.sort(key=lambda state: (state.limiter.headroom(), state.limiter.current_rate), reverse=True)
+        best_wait = float('inf')
+        for state in available:
+            wait = state.limiter._try_acquire()
+            if wait <= 0:
+                return state.api_key, 0.0
+            best_wait = min(best_wait, wait)
+        return None, best_wait
+
+    def acquire_key(self, is_cancelled=None, poll_interval=0.1):
+        """
+        Chờ tới khi một key được phép gửi request. Trả về (api_key, số giây đã chờ),
+        hoặc None nếu is_cancelled() trả về True trong lúc chờ.
+        """
+        start = time.monotonic()
+        while True:
+            if is_cancelled is not None and is_cancelled():
+                return None
+            api_key, wait = self._try_acquire()
+            if api_key is not None:
+                return api_key, time.monotonic() - start
+            time.sleep(min(wait, poll_interval) if is_cancelled is not None else wait)
+
+    async def acquire_key_async(self):
+        """Phiên bản asyncio của acquire_key()"""
+        start = time.monotonic()
+        while True:
+            api_key, wait = self._try_acquire()
+            if api_key is not None:
+                return api_key, time.monotonic() - start
+            await asyncio.sleep(wait)
+
+    def try_acquire_key(self):
+        """Lấy token của một key nếu có ngay (không chờ): (api_key, 0.0) hoặc None"""
+        api_key, _ = self._try_acquire()
+        return None if api_key is None else (api_key, 0.0)
+
+    def acquire(self, is_cancelled=None, poll_interval=0.1):
+        """Như AdaptiveRateLimiter.acquire(): chỉ trả về số giây đã chờ"""
+        acquired = self.acquire_key(is_cancelled, poll_interval)
+        return None if acquired is None else acquired[1]
+
+    async def acquire_async(self):
+        return (await self.acquire_key_async())[1]
+
+    def on_success(self, api_key=None):
+        state = self._states.get(api_key)
+        if state is None:
+            return
+        with self._lock:
+            state.successes += 1
+            state.consecutive_limited = 0
+        state.limiter.on_success()
+
+    def on_rate_limited(self, retry_after=None, api_key=None):
+        """Key gặp lỗi quota: giảm tốc độ của riêng key đó và tạm loại nó khỏi nhóm"""
+        state = self._states.get(api_key)
+        if state is None:
+            return
+        with self._lock:
+            state.rate_limited += 1
+            state.consecutive_limited += 1
+            bench = self.bench_seconds * 2 ** (state.consecutive_limited - 1)
+            bench = min(self.max_bench_seconds, max(bench, retry_after or 0.0))
+            state.benched_until = max(state.benched_until, time.monotonic() + bench)
+        state.limiter.on_rate_limited(retry_after)
+        print(f"API key {mask_key(api_key)} bị giới hạn quota, tạm ngưng dùng trong {bench:.1f} giây")
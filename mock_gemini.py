@@ -0,0 +1,297 @@
+# mock_gemini.py
+"""
+Server giả lập API Gemini (REST generateContent) chạy trên máy cho benchmark.
+
+Trả lời POST /v1beta/models/<model>:generateContent với ảnh PNG sau một độ trễ
+lấy từ phân phối cấu hình được (:streamGenerateContent trả chunk text trước, chunk
+ảnh khi hết độ trễ), kèm tỷ lệ lỗi 500 và các đợt 429 định kỳ (có
+header Retry-After). Có thể giới hạn quota theo từng API key (--key-quota) để đo
+thông lượng khi dùng nhiều key. GeminiBackend trỏ tới server này qua tham số endpoint.
+
+Chạy riêng:
+    python mock_gemini.py --port 8089 --latency lognormal:1.5,0.4 --error-rate 0.02
+"""
+import sys
+import json
+import math
+import time
+import base64
+import random
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from tryon_engine import make_png_bytes
+
+def parse_latency(spec, rng=random):
+    """
+    Đọc phân phối độ trễ dạng "fixed:S", "uniform:A,B", "normal:MEAN,SD" hoặc
+    "lognormal:MEDIAN,SIGMA" (giây). Trả về hàm không tham số sinh một độ trễ.
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',') if value]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Phân phối độ trễ không hợp lệ: {spec!r}")
+
+class MockConfig:
+    """
+    Hành vi của server giả lập. Đợt 429 kéo dài burst_length giây, lặp lại sau
+    mỗi burst_every giây (0 = không có đợt 429). key_quota > 0 giới hạn số
+    request/giây của mỗi API key, vượt quá thì trả 429.
+    """
+    def __init__(self, latency="fixed:0.5", error_rate=0.0, burst_every=0.0, burst_length=0.0,
+                 retry_after=1.0, image_size=(512, 512), seed=None, key_quota=0.0, first_chunk=0.3):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.retry_after = retry_after
+        self.image_size = image_size
+        self.seed = seed
+        self.key_quota = key_quota
+        # Với stream: chunk text đầu tiên được gửi sau first_chunk × độ trễ
+        self.first_chunk = first_chunk
+
+    def as_dict(self):
+        return {
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "burst_every": self.burst_every,
+            "burst_length": self.burst_length,
+            "retry_after": self.retry_after,
+            "image_size": list(self.image_size),
+            "key_quota": self.key_quota,
+            "first_chunk": self.first_chunk,
+        }
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # Không in mỗi request ra console
+
+    def do_POST(self):
+        server = self.server.mock
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        url = urlsplit(self.path)
+        stream = url.path.endswith(':streamGenerateContent')
+        if not stream and not url.path.endswith(':generateContent'):
+            self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+        query = parse_qs(url.query)
+        api_key = self.headers.get('x-goog-api-key') or query.get('key', [''])[0]
+        if stream:
+            status, body, headers = server.respond_stream(api_key)
+            if status == 200:
+                self._send_stream(body, sse=query.get('alt') == ['sse'])
+                return
+        else:
+            status, body, headers = server.respond(api_key)
+        self._send_json(status, body, headers)
+
+    def _send_stream(self, chunks, sse=False):
+        """Gửi từng chunk ngay khi có: mảng JSON (mặc định của SDK) hoặc server-sent events"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream' if sse else 'application/json; charset=UTF-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        first = True
+        for chunk in chunks:
+            if sse:
+                self._write_chunk(b"data: " + chunk + b"\r\n\r\n")
+            else:
+                self._write_chunk((b"[" if first else b",\r\n") + chunk)
+            first = False
+        if not sse:
+            self._write_chunk(b"[]" if first else b"]")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_json(self, status, body, headers=None):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+class MockGeminiServer:
+    """
+    Server giả lập chạy trên luồng nền. start() trả về endpoint dạng
+    http://127.0.0.1:<port> để truyền cho GeminiBackend(endpoint=...).
+    """
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or MockConfig()
+        self._random = random.Random(self.config.seed)
+        self._latency = parse_latency(self.config.latency, self._random)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+        self._started = time.monotonic()
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        # Quota theo key: api_key -> [số token, thời điểm nạp lần cuối]
+        self._key_buckets = {}
+        self.requests_by_key = {}
+        # Ảnh trả về được tạo sẵn một lần, không tốn CPU của server trong lúc đo
+        width, height = self.config.image_size
+        image = base64.b64encode(make_png_bytes(width, height)).decode('ascii')
+        text_part = {"text": "mock"}
+        image_part = {"inlineData": {"mimeType": "image/png", "data": image}}
+        self._ok_body = _response_json([text_part, image_part], "STOP")
+        self._stream_chunks = (_response_json([text_part]), _response_json([image_part], "STOP"))
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-gemini', daemon=True)
+        self._thread.start()
+        return self.endpoint
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            stats = {"requests": self.requests, "rate_limited": self.rate_limited, "errors": self.errors}
+            if self.config.key_quota:
+                stats["requests_by_key"] = dict(self.requests_by_key)
+            return stats
+
+    def _in_burst(self):
+        config = self.config
+        if not config.burst_every or not config.burst_length:
+            return False
+        return (time.monotonic() - self._started) % config.burst_every < config.burst_length
+
+    def _over_key_quota(self, api_key):
+        """Token bucket của từng key (gọi khi đang giữ self._lock)"""
+        quota = self.config.key_quota
+        if not quota:
+            return False
+        now = time.monotonic()
+        bucket = self._key_buckets.setdefault(api_key, [quota, now])
+        bucket[0] = min(quota, bucket[0] + (now - bucket[1]) * quota)
+        bucket[1] = now
+        if bucket[0] < 1.0:
+            return True
+        bucket[0] -= 1.0
+        return False
+
+    def _admit(self, api_key):
+        """Trả về (phản hồi 429 hoặc None, độ trễ, True nếu request sẽ lỗi 500)"""
+        with self._lock:
+            self.requests += 1
+            if self._in_burst() or self._over_key_quota(api_key):
+                self.rate_limited += 1
+                return (429, {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).",
+                                        "status": "RESOURCE_EXHAUSTED"}},
+                        {"Retry-After": f"{self.config.retry_after:g}"}), 0.0, False
+            self.requests_by_key[api_key] = self.requests_by_key.get(api_key, 0) + 1
+            failed = self._random.random() < self.config.error_rate
+            if failed:
+                self.errors += 1
+            return None, self._latency(), failed
+
+    def respond(self, api_key=''):
+        """Chạy trên luồng của request: trả về (status, body, headers)"""
+        limited, latency, failed = self._admit(api_key)
+        if limited:
+            return limited
+        time.sleep(latency)
+        if failed:
+            return _INTERNAL_ERROR
+        return 200, self._ok_body, None
+
+    def respond_stream(self, api_key=''):
+        """Như respond() nhưng body là iterator các chunk JSON, mỗi chunk được trả khi tới hạn"""
+        limited, latency, failed = self._admit(api_key)
+        if limited:
+            return limited
+        if failed:
+            time.sleep(latency)
+            return _INTERNAL_ERROR
+        return 200, self._stream(latency), None
+
+    def _stream(self, latency):
+        text_chunk, image_chunk = self._stream_chunks
+        first = latency * self.config.first_chunk
+        time.sleep(first)
+        yield text_chunk
+        time.sleep(latency - first)
+        yield image_chunk
+
+_INTERNAL_ERROR = (500, {"error": {"code": 500, "message": "Internal error encountered.", "status": "INTERNAL"}}, None)
+
+def _response_json(parts, finish_reason=None):
+    candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return json.dumps({"candidates": [candidate]}).encode('utf-8')
+
+def parse_size(text):
+    width, _, height = text.lower().partition('x')
+    return int(width), int(height or width)
+
+def add_mock_arguments(parser):
+    """Các tham số dòng lệnh của server giả lập, dùng chung với benchmark.py"""
+    parser.add_argument('--latency', default='lognormal:1.0,0.35',
+                        help="Phân phối độ trễ: fixed:S, uniform:A,B, normal:MEAN,SD, lognormal:MEDIAN,SIGMA")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Tỷ lệ request trả lỗi 500")
+    parser.add_argument('--burst-every', type=float, default=0.0, help="Chu kỳ các đợt 429 (giây, 0 = tắt)")
+    parser.add_argument('--burst-length', type=float, default=0.0, help="Độ dài mỗi đợt 429 (giây)")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Giá trị Retry-After của phản hồi 429")
+    parser.add_argument('--image-size', type=parse_size, default=(512, 512), help="Kích thước ảnh trả về, ví dụ 1024x1024")
+    parser.add_argument('--seed', type=int, help="Seed cho tỷ lệ lỗi để các lần chạy so sánh được")
+    parser.add_argument('--first-chunk', type=float, default=0.3,
+                        help="Với stream: chunk đầu tiên được gửi sau tỷ lệ này của độ trễ")
+    parser.add_argument('--key-quota', type=float, default=0.0,
+                        help="Số request/giây tối đa của mỗi API key, vượt quá trả 429 (0 = không giới hạn)")
+
+def config_from_args(args):
+    return MockConfig(latency=args.latency, error_rate=args.error_rate, burst_every=args.burst_every,
+                      burst_length=args.burst_length, retry_after=args.retry_after,
+                      image_size=args.image_size, seed=args.seed, key_quota=args.key_quota,
+                      first_chunk=args.first_chunk)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Server giả lập API Gemini cho benchmark")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    add_mock_arguments(parser)
+    args = parser.parse_args(argv)
+    server = MockGeminiServer(config_from_args(args), args.host, args.port)
+    print(f"Server giả lập Gemini đang chạy tại {server.endpoint}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        print(f"Đã dừng: {server.stats()}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# rate_limiter.py
+"""
+Bộ giới hạn tốc độ dùng chung cho mọi request tới API.
+
+Kết hợp token bucket (gửi nhanh nhất quota cho phép) với AIMD: tăng tốc độ dần
+khi request thành công, giảm một nửa khi gặp lỗi 429/ResourceExhausted và tôn
+trọng gợi ý Retry-After của server.
+"""
+import re
+import time
+import asyncio
+import threading
+
+# Chỉ nhận "429" khi đi kèm từ khóa trạng thái HTTP, không phải số 429 bất kỳ trong
+# thông báo lỗi (đường dẫn file, số byte, request id)
+_RATE_LIMIT_TEXT = re.compile(
+    r"RESOURCE_EXHAUSTED|Resource has been exhausted|\b429\s+Too Many Requests"
+    r"|\b(?:status|status_code|code|HTTP(?:/\d(?:\.\d)?)?)\W{0,3}429\b", re.IGNORECASE)
+
+def is_rate_limit_error(error):
+    """Kiểm tra lỗi có phải do vượt quota (429 / ResourceExhausted) hay không"""
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests", "RateLimitError"):
+        return True
+    code = getattr(error, "code", None)
+    if code == 429 or getattr(code, "value", None) == 429:
+        return True
+    return _RATE_LIMIT_TEXT.search(str(error)) is not None
+
+def retry_after_from_error(error):
+    """Lấy số giây cần chờ từ header Retry-After hoặc retry_delay trong lỗi, nếu có"""
+    value = getattr(error, "retry_after", None)
+    if value is not None:
+        return float(value)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        header = headers.get("Retry-After") or headers.get("retry-after")
+    except AttributeError:
+        header = None
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(error))
+    if match:
+        return float(match.group(1))
+    match = re.search(r"retry (?:in|after) ([\d.]+)\s*s", str(error), re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket với tốc độ điều chỉnh kiểu AIMD.
+
+    rate là số request/giây hiện tại; acquire() chặn cho tới khi có token.
+    on_success() tăng rate thêm increase_step (tối đa max_rate), on_rate_limited()
+    nhân rate với decrease_factor và tạm dừng mọi request theo Retry-After.
+    """
+    def __init__(self, initial_rate=2.0, min_rate=0.1, max_rate=20.0, burst=None,
+                 increase_step=0.25, decrease_factor=0.5, default_backoff=5.0):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst if burst is not None else max(1.0, initial_rate)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.default_backoff = default_backoff
+        self._rate = min(max(initial_rate, min_rate), max_rate)
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.throttled_count = 0
+
+    @property
+    def current_rate(self):
+        """Tốc độ gửi hiện tại (request/giây)"""
+        with self._lock:
+            return self._rate
+
+    def stats(self):
+        """Trạng thái hiện tại của limiter để hiển thị cho người vận hành"""
+        with self._lock:
+            return {
+                "rate": self._rate,
+                "tokens": self._tokens,
+                "paused_for": max(0.0, self._paused_until - time.monotonic()),
+                "throttled": self.throttled_count,
+            }
+
+    def headroom(self):
+        """Số token đang có (0 khi đang tạm dừng vì quota)"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return 0.0 if now < self._paused_until else self._tokens
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self._rate)
+
+    def _try_acquire(self):
+        """Lấy một token nếu có. Trả về 0 nếu lấy được, ngược lại số giây nên chờ trước khi thử lại"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self._paused_until and self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            if now < self._paused_until:
+                return self._paused_until - now
+            return (1.0 - self._tokens) / self._rate
+
+    def acquire(self, is_cancelled=None, poll_interval=0.1):
+        """
+        Chờ tới khi được phép gửi một request. Trả về số giây đã chờ.
+        is_cancelled() được kiểm tra định kỳ; nếu trả về True thì dừng chờ và trả về None.
+        """
+        start = time.monotonic()
+        while True:
+            if is_cancelled is not None and is_cancelled():
+                return None
+            wait = self._try_acquire()
+            if wait <= 0:
+                return time.monotonic() - start
+            time.sleep(min(wait, poll_interval) if is_cancelled is not None else wait)
+
+    async def acquire_async(self):
+        """Phiên bản asyncio của acquire(); hủy task đang chờ sẽ dừng chờ ngay"""
+        start = time.monotonic()
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return time.monotonic() - start
+            await asyncio.sleep(wait)
+
+    def acquire_key(self, is_cancelled=None):
+        """
+        Giao diện chung với key_pool.ApiKeyPool: trả về (api_key, số giây đã chờ),
+        hoặc None nếu bị hủy. Limiter một key luôn trả về api_key=None (dùng key của backend).
+        """
+        waited = self.acquire(is_cancelled)
+        return None if waited is None else (None, waited)
+
+    async def acquire_key_async(self):
+        return None, await self.acquire_async()
+
+    def try_acquire_key(self):
+        """Lấy token nếu có ngay (không chờ): (api_key, 0.0) hoặc None"""
+        return (None, 0.0) if self._try_acquire() <= 0 else None
+
+    def on_success(self, api_key=None):
+        """Request thành công: tăng tốc độ thêm một bước (additive increase)"""
+        with self._lock:
+            self._rate = min(self.max_rate, self._rate + self.increase_step)
+
+    def on_rate_limited(self, retry_after=None, api_key=None):
+        """Gặp lỗi quota: giảm tốc độ (multiplicative decrease) và tạm dừng gửi"""
+        with self._lock:
+            self.throttled_count += 1
+            self._rate = max(self.min_rate, self._rate * self.decrease_factor)
+            backoff = retry_after if retry_after is not None else self.default_backoff
+            self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+            self._tokens = 0.0
+            rate = self._rate
+        print(f"Bị giới hạn quota, giảm tốc độ xuống {rate:.2f} request/giây, chờ {backoff:.1f} giây")
@@ -0,0 +1,127 @@
+# result_cache.py
+"""
+Cache kết quả trên đĩa, đánh địa chỉ theo nội dung.
+
+Khóa là hash của ảnh người, ảnh quần áo, prompt, tên mô hình, toàn bộ
+generation_config (kể cả nhiệt độ riêng của từng biến thể) và số thứ tự biến thể. Bấm tạo lại với cùng
+đầu vào sẽ lấy ngay ảnh từ cache thay vì gọi API. Dung lượng cache bị giới hạn,
+ảnh ít được dùng nhất (LRU) bị xóa trước.
+"""
+import os
+import json
+import hashlib
+import threading
+
+RESULT_CACHE_FOLDER = os.path.join('cache', 'results')
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Khi vượt giới hạn, cache được dọn xuống tỷ lệ này của max_bytes
+EVICT_TARGET = 0.9
+
+def make_cache_key(person_sha256, clothing_sha256, prompt, model_name, generation_config, variant=None):
+    """
+    Hash ổn định của mọi thứ ảnh hưởng tới kết quả sinh ảnh. variant phân biệt các
+    biến thể có cùng cấu hình (lô lớn lặp lại các mức nhiệt độ) để mỗi biến thể có ảnh riêng.
+    """
+    payload = json.dumps({
+        "person": person_sha256,
+        "clothing": clothing_sha256,
+        "prompt": prompt,
+        "model": model_name,
+        "generation_config": generation_config,
+        "variant": variant,
+    }, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    Lưu ảnh kết quả thành file <key>.png trong cache_dir. Thời điểm truy cập gần
+    nhất được ghi vào mtime của file để xác định thứ tự LRU khi dọn cache.
+    """
+    def __init__(self, cache_dir=RESULT_CACHE_FOLDER, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        # Dung lượng hiện tại được tính ở lần ghi đầu tiên (trên luồng ghi), không
+        # quét thư mục cache lúc khởi động
+        self._total_bytes = None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".png"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _ensure_total(self):
+        """Gọi khi đang giữ self._lock"""
+        if self._total_bytes is None:
+            self._total_bytes = sum(size for _, _, size in self._entries())
+        return self._total_bytes
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return self._ensure_total()
+
+    def get(self, key):
+        """Trả về đường dẫn file trong cache, hoặc None nếu chưa có"""
+        path = self._path(key)
+        with self._lock:
+            try:
+                # Đánh dấu vừa được dùng cho LRU
+                os.utime(path, None)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return path
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, data):
+        """Lưu bytes ảnh vào cache và dọn bớt nếu vượt dung lượng cho phép"""
+        path = self._path(key)
+        # Tên file tạm riêng cho mỗi lần ghi: nhiều tiến trình (farm.py) dùng chung thư mục cache
+        tmp_path = f"{path}.{os.getpid()}.{os.urandom(4).hex()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            self._ensure_total()
+            os.replace(tmp_path, path)
+            self._total_bytes += len(data) - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return path
+
+    def _evict(self):
+        """
+        Xóa các file ít được dùng nhất cho tới khi dưới EVICT_TARGET dung lượng cho
+        phép, để các lần ghi tiếp theo không phải quét lại cả thư mục cache
+        """
+        entries = sorted(self._entries())
+        self._total_bytes = sum(size for _, _, size in entries)
+        target = self.max_bytes * EVICT_TARGET
+        for _, path, size in entries:
+            if self._total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._total_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            for _, path, _ in self._entries():
+                os.remove(path)
+            self._total_bytes = 0
@@ -0,0 +1,64 @@
+# result_writer.py
+"""
+Ghi file kết quả ở luồng nền.
+
+Worker không phải chờ ghi đĩa trước khi trả ảnh cho giao diện: bytes ảnh được
+chuyển thẳng cho phần hiển thị, còn việc ghi file được xếp vào hàng đợi của
+ResultWriter và chạy tuần tự trên một luồng riêng.
+"""
+import os
+import queue
+import threading
+import concurrent.futures
+
+class ResultWriter:
+    """
+    Hàng đợi ghi file chạy trên một luồng nền. write() và call() trả về Future
+    để ai cần chắc chắn file đã có trên đĩa có thể chờ.
+    """
+    def __init__(self, name='tryon-result-writer'):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            future, func, args = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except Exception as e:
+                    print(f"Lỗi khi ghi kết quả: {str(e)}")
+                    future.set_exception(e)
+            self._queue.task_done()
+
+    def call(self, func, *args):
+        """Chạy func(*args) trên luồng ghi"""
+        future = concurrent.futures.Future()
+        self._queue.put((future, func, args))
+        return future
+
+    def write(self, path, data):
+        """Ghi bytes vào path (ghi file tạm rồi đổi tên để không bao giờ có file dở dang)"""
+        return self.call(write_file_atomic, path, data)
+
+    def flush(self):
+        """Chờ tới khi mọi thao tác đã xếp hàng được ghi xong"""
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+def write_file_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
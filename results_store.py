@@ -0,0 +1,309 @@
+# results_store.py
+"""
+Kho kết quả có quản lý: thư mục chia shard, chỉ mục SQLite và dọn theo dung lượng.
+
+Trước đây mọi biến thể được ghi phẳng vào results/ mà không ghi lại đầu vào nào
+tạo ra nó; thư mục lớn dần mãi và việc liệt kê hay dọn dẹp ngày càng chậm.
+ResultStore đặt mỗi file vào results/<năm-tháng>/<2 ký tự hex>/ (mỗi thư mục chỉ
+có ít file) và ghi vào chỉ mục: hash ảnh người, hash ảnh quần áo, prompt, mô hình,
+cấu hình, biến thể, kích thước và thời điểm tạo. Tìm kết quả theo đầu vào là một
+truy vấn chỉ mục, không cần quét thư mục; luồng dọn nền xóa kết quả cũ nhất khi
+tổng dung lượng vượt ngân sách.
+
+    python results_store.py --person models/a.jpg --garment shirt.png
+    python results_store.py --evict --max-gb 2
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+from image_prep import file_sha256
+
+RESULTS_INDEX_NAME = 'index.sqlite3'
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Kết quả mới hơn mức này (giây) không bị dọn, kể cả khi vượt ngân sách: giao diện
+# hoặc client của dịch vụ có thể vẫn đang dùng file
+DEFAULT_MIN_AGE = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    path TEXT PRIMARY KEY,
+    person_sha256 TEXT,
+    clothing_sha256 TEXT,
+    person_image_path TEXT,
+    clothing_image_path TEXT,
+    prompt TEXT,
+    model TEXT,
+    generation_config TEXT,
+    variant_id INTEGER,
+    cache_key TEXT,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_inputs ON results (person_sha256, clothing_sha256);
+CREATE INDEX IF NOT EXISTS results_clothing ON results (clothing_sha256);
+CREATE INDEX IF NOT EXISTS results_cache_key ON results (cache_key);
+CREATE INDEX IF NOT EXISTS results_created ON results (created_at);
+"""
+
+class ResultStore:
+    """
+    Kho file kết quả trong root kèm chỉ mục SQLite (chế độ WAL), dùng chung được
+    giữa các luồng. Chỉ mục lưu đường dẫn tuyệt đối.
+
+    new_path() trả về đường dẫn trong thư mục shard cho một kết quả mới; add()
+    ghi nó vào chỉ mục sau khi file đã có trên đĩa (TryOnEngine gọi trên luồng ghi).
+    max_bytes là ngân sách dung lượng; start_evictor() chạy luồng dọn nền.
+    """
+    def __init__(self, root='results', index_path=None, max_bytes=DEFAULT_MAX_BYTES, min_age=DEFAULT_MIN_AGE):
+        self.root = root
+        self.index_path = index_path or os.path.join(root, RESULTS_INDEX_NAME)
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.evicted = 0
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._total_bytes = self._query("SELECT COALESCE(SUM(size), 0) AS total FROM results")[0]['total']
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._evictor = None
+
+    def close(self):
+        self.stop_evictor()
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def new_path(self, variant_id):
+        """Đường dẫn cho một kết quả mới: root/<năm-tháng>/<shard>/result_<biến thể>_<thời điểm>_<hex>.png"""
+        suffix = os.urandom(4).hex()
+        return os.path.join(self.root, time.strftime('%Y-%m'), suffix[:2],
+                            f"result_{variant_id}_{int(time.time())}_{suffix}.png")
+
+    def add(self, path, size, entry=None):
+        """
+        Ghi một file kết quả vào chỉ mục. entry là dict các trường đầu vào (xem
+        TryOnEngine.result_entry), None với file không rõ đầu vào.
+        """
+        path = os.path.abspath(path)
+        entry = entry or {}
+        config = entry.get('generation_config')
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM results WHERE path = ?", (path,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (path, person_sha256, clothing_sha256, person_image_path, "
+                "clothing_image_path, prompt, model, generation_config, variant_id, cache_key, size, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, entry.get('person_sha256'), entry.get('clothing_sha256'), entry.get('person_image_path'),
+                 entry.get('clothing_image_path'), entry.get('prompt'), entry.get('model'),
+                 None if config is None else json.dumps(config, sort_keys=True), entry.get('variant_id'),
+                 entry.get('cache_key'), size, entry.get('created_at') or time.time()))
+            self._total_bytes += size - (row['size'] if row is not None else 0)
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self._wake.set()
+        return path
+
+    def remove(self, path):
+        """Xóa file và bản ghi của nó. Trả về True nếu có bản ghi"""
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM results WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return False
+            self._conn.execute("DELETE FROM results WHERE path = ?", (path,))
+            self._total_bytes -= row['size']
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def get(self, path):
+        rows = self._query("SELECT * FROM results WHERE path = ?", (os.path.abspath(path),))
+        return _row_dict(rows[0]) if rows else None
+
+    def query(self, person_sha256=None, clothing_sha256=None, prompt=None, variant_id=None, cache_key=None,
+              limit=None):
+        """Các kết quả khớp mọi điều kiện được cho, mới nhất trước"""
+        conditions, params = [], []
+        for column, value in (('person_sha256', person_sha256), ('clothing_sha256', clothing_sha256),
+                              ('prompt', prompt), ('variant_id', variant_id), ('cache_key', cache_key)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        sql = "SELECT * FROM results"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY created_at DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [_row_dict(row) for row in self._query(sql, params)]
+
+    def find_by_input(self, person_image_path=None, clothing_image_path=None, prompt=None, limit=None):
+        """Như query() nhưng nhận đường dẫn ảnh đầu vào (so khớp theo nội dung file, không theo tên)"""
+        return self.query(
+            person_sha256=file_sha256(person_image_path) if person_image_path else None,
+            clothing_sha256=file_sha256(clothing_image_path) if clothing_image_path else None,
+            prompt=prompt, limit=limit)
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return self._total_bytes
+
+    def stats(self):
+        rows = self._query("SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM results")
+        return {"files": rows[0]['files'], "bytes": rows[0]['bytes'], "max_bytes": self.max_bytes,
+                "evicted": self.evicted}
+
+    def adopt_untracked(self):
+        """
+        Ghi vào chỉ mục các file kết quả cũ nằm phẳng trong root (từ trước khi có
+        kho này), không rõ đầu vào, để chúng được tính vào ngân sách và được dọn
+        như các kết quả khác. Chỉ chạy khi người dùng yêu cầu (results_store.py
+        --adopt): file trong root có thể là file của người dùng hoặc được git quản lý.
+        Trả về số file được thêm.
+        """
+        tracked = {row['path'] for row in self._query("SELECT path FROM results WHERE person_sha256 IS NULL")}
+        added = 0
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.png') and os.path.abspath(entry.path) not in tracked:
+                    stat = entry.stat()
+                    self.add(entry.path, stat.st_size, {'created_at': stat.st_mtime})
+                    added += 1
+        return added
+
+    def evict(self, max_bytes=None, batch_size=200):
+        """
+        Xóa kết quả cũ nhất (bỏ qua các kết quả mới hơn min_age giây) cho tới khi
+        tổng dung lượng không vượt max_bytes. Trả về số file đã xóa.
+        """
+        budget = self.max_bytes if max_bytes is None else max_bytes
+        removed = 0
+        emptied = set()
+        cutoff = time.time() - self.min_age
+        while self.total_bytes > budget:
+            rows = self._query("SELECT path, size FROM results WHERE created_at < ? ORDER BY created_at LIMIT ?",
+                               (cutoff, batch_size))
+            if not rows:
+                break
+            for row in rows:
+                if self.total_bytes <= budget:
+                    break
+                if self.remove(row['path']):
+                    removed += 1
+                    emptied.add(os.path.dirname(row['path']))
+        if removed:
+            self._prune_empty_shards(emptied)
+            self.evicted += removed
+            print(f"Đã dọn {removed} kết quả cũ, kho kết quả còn {self.total_bytes / 1024 / 1024:.1f} MB")
+        return removed
+
+    def _prune_empty_shards(self, dirs):
+        """
+        Xóa các thư mục shard vừa có file bị dọn (và thư mục tháng chứa chúng) nếu
+        đã rỗng; không duyệt cả cây thư mục và không đụng tới thư mục khác trong root
+        """
+        root = os.path.abspath(self.root)
+        for dirpath in sorted(dirs, key=len, reverse=True):
+            while dirpath != root and os.path.commonpath([dirpath, root]) == root:
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    break  # Còn file hoặc đã bị xóa
+                dirpath = os.path.dirname(dirpath)
+
+    def start_evictor(self, interval=300.0):
+        """
+        Chạy luồng dọn nền: kiểm tra ngân sách mỗi interval giây và ngay khi add()
+        làm tổng dung lượng vượt ngân sách (trừ khi lượt dọn trước không xóa được gì
+        vì mọi kết quả đều mới hơn min_age: khi đó chờ tới lượt kế tiếp). Chỉ dọn
+        file có trong chỉ mục.
+        """
+        if self._evictor is not None:
+            return
+        self._stop.clear()
+        self._evictor = threading.Thread(target=self._run_evictor, args=(interval,),
+                                         name='tryon-result-evictor', daemon=True)
+        self._evictor.start()
+
+    def stop_evictor(self, timeout=1.0):
+        if self._evictor is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._evictor.join(timeout)
+        self._evictor = None
+
+    def _run_evictor(self, interval):
+        while not self._stop.is_set():
+            stuck = False
+            try:
+                if self.total_bytes > self.max_bytes:
+                    # Vẫn vượt ngân sách sau khi dọn: mọi kết quả còn lại đều mới hơn min_age
+                    stuck = self.evict() == 0 or self.total_bytes > self.max_bytes
+            except Exception as e:
+                print(f"Lỗi khi dọn kho kết quả: {str(e)}")
+            if stuck:
+                # Không để mỗi lần add() đánh thức lại một lượt dọn chắc chắn không xóa được gì
+                self._stop.wait(interval)
+            else:
+                self._wake.wait(interval)
+            self._wake.clear()
+
+def _row_dict(row):
+    result = dict(row)
+    if result.get('generation_config'):
+        result['generation_config'] = json.loads(result['generation_config'])
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tìm và dọn kết quả trong kho kết quả")
+    parser.add_argument('--root', default='results', help="Thư mục kho kết quả")
+    parser.add_argument('--person', help="Chỉ lấy kết quả của ảnh người này")
+    parser.add_argument('--garment', help="Chỉ lấy kết quả của ảnh quần áo này")
+    parser.add_argument('--prompt')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--adopt', action='store_true',
+                        help="Đưa các file .png cũ nằm phẳng trong --root vào chỉ mục (chúng có thể bị dọn sau đó)")
+    parser.add_argument('--evict', action='store_true', help="Dọn kết quả cũ nhất cho tới khi dưới --max-gb")
+    parser.add_argument('--max-gb', type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3)
+    parser.add_argument('--min-age', type=float, default=DEFAULT_MIN_AGE,
+                        help="Không dọn kết quả mới hơn số giây này")
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.root, max_bytes=int(args.max_gb * 1024 ** 3), min_age=args.min_age)
+    try:
+        if args.adopt:
+            print(f"Đã đưa {store.adopt_untracked()} file cũ vào chỉ mục")
+        if args.evict:
+            store.evict()
+        elif not args.adopt:
+            for row in store.find_by_input(args.person, args.garment, args.prompt, args.limit):
+                created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['created_at']))
+                print(f"{created}  biến thể {row['variant_id']}  {row['size'] / 1024:.0f} KB  {row['path']}")
+        stats = store.stats()
+        print(f"Kho kết quả: {stats['files']} file, {stats['bytes'] / 1024 / 1024:.1f} MB "
+              f"/ {stats['max_bytes'] / 1024 / 1024:.0f} MB")
+    finally:
+        store.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
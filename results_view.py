@@ -0,0 +1,247 @@
+# results_view.py
+"""
+Lưới kết quả ảo hóa cho hàng trăm biến thể.
+
+ResultsModel (QAbstractListModel) giữ trạng thái từng biến thể; QListView ở chế độ
+icon chỉ hỏi dữ liệu của các ô đang hiển thị, nên thumbnail chỉ được tải khi ô
+cuộn vào màn hình. Pixmap đã tải nằm trong một cache LRU có giới hạn bộ nhớ; ảnh
+bị loại khỏi cache sẽ được tải lại khi cần.
+"""
+from collections import OrderedDict
+
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, QRect
+from PyQt6.QtGui import QPixmap, QColor
+from PyQt6.QtWidgets import (QListView, QStyledItemDelegate, QStyle, QStyleOptionProgressBar,
+                             QApplication, QAbstractItemView)
+
+CELL_SIZE = QSize(250, 370)
+IMAGE_SIZE = QSize(230, 300)
+DEFAULT_PIXMAP_BUDGET = 64 * 1024 * 1024
+
+ProgressRole = Qt.ItemDataRole.UserRole + 1
+StatusRole = Qt.ItemDataRole.UserRole + 2
+PathRole = Qt.ItemDataRole.UserRole + 3
+
+class _Entry:
+    def __init__(self, variant_id):
+        self.variant_id = variant_id
+        self.progress = 0
+        self.status = "Đang xử lý..."
+        self.image_path = None
+        self.image_data = None
+        self.error = None
+        self.loading = False
+
+class ResultsModel(QAbstractListModel):
+    """
+    Model các biến thể kết quả. Thumbnail được tải lười qua ThumbnailLoader khi
+    view hỏi DecorationRole, và bị loại khỏi bộ nhớ khi vượt pixmap_budget byte.
+    """
+    def __init__(self, thumbnail_loader, parent=None, pixmap_budget=DEFAULT_PIXMAP_BUDGET,
+                 image_size=IMAGE_SIZE):
+        super().__init__(parent)
+        self.thumbnail_loader = thumbnail_loader
+        self.pixmap_budget = pixmap_budget
+        self.image_size = image_size
+        self._entries = []
+        self._pixmaps = OrderedDict()  # variant_id -> QPixmap, theo thứ tự dùng gần nhất
+        self._pixmap_bytes = 0
+        self._generation = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._entries)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._entries):
+            return None
+        entry = self._entries[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"Phiên bản {entry.variant_id + 1}"
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self._pixmap(entry)
+        if role == ProgressRole:
+            return entry.progress
+        if role == StatusRole:
+            return entry.error and f"Lỗi: {entry.error}" or entry.status
+        if role == PathRole:
+            return entry.image_path
+        return None
+
+    def reset(self, count):
+        """Tạo lại model với count biến thể ở trạng thái đang xử lý"""
+        self.beginResetModel()
+        self._generation += 1
+        self._entries = [_Entry(i) for i in range(count)]
+        self._pixmaps.clear()
+        self._pixmap_bytes = 0
+        self.endResetModel()
+
+    def _changed(self, row):
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def set_progress(self, variant_id, value):
+        if 0 <= variant_id < len(self._entries):
+            self._entries[variant_id].progress = value
+            self._changed(variant_id)
+
+    def set_result(self, variant_id, image_path, image_data=None):
+        if not 0 <= variant_id < len(self._entries):
+            return
+        entry = self._entries[variant_id]
+        entry.image_path = image_path
+        # Giữ bytes ảnh tới khi thumbnail đầu tiên được tạo, sau đó đọc lại từ file nếu cần
+        entry.image_data = image_data
+        entry.progress = 100
+        entry.status = ""
+        entry.error = None
+        self._drop_pixmap(variant_id)
+        self._changed(variant_id)
+
+    def set_status(self, variant_id, status):
+        """Trạng thái hiển thị của một biến thể chưa có kết quả (ví dụ đang chờ, đã bỏ qua)"""
+        if 0 <= variant_id < len(self._entries):
+            self._entries[variant_id].status = status
+            self._changed(variant_id)
+
+    def set_error(self, variant_id, message):
+        if 0 <= variant_id < len(self._entries):
+            self._entries[variant_id].error = message
+            self._changed(variant_id)
+
+    def image_path(self, variant_id):
+        if 0 <= variant_id < len(self._entries):
+            return self._entries[variant_id].image_path
+        return None
+
+    def image_data(self, variant_id):
+        if 0 <= variant_id < len(self._entries):
+            return self._entries[variant_id].image_data
+        return None
+
+    def finished_paths(self):
+        """Đường dẫn các biến thể đã có ảnh, theo thứ tự"""
+        return [entry.image_path for entry in self._entries if entry.image_path]
+
+    @property
+    def pixmap_bytes(self):
+        return self._pixmap_bytes
+
+    def _pixmap(self, entry):
+        pixmap = self._pixmaps.get(entry.variant_id)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(entry.variant_id)
+            return pixmap
+        if entry.image_path and not entry.loading:
+            # Ô vừa hiện lên màn hình: tải thumbnail ở luồng nền
+            entry.loading = True
+            generation = self._generation
+            self.thumbnail_loader.load(
+                entry.image_path, self.image_size.width(), self.image_size.height(),
+                lambda path, image, entry=entry, generation=generation: self._loaded(entry, generation, path, image),
+                entry.image_data)
+            # ThumbnailLoader gọi callback ngay nếu thumbnail đã có trong bộ nhớ
+            return self._pixmaps.get(entry.variant_id)
+        return None
+
+    def _loaded(self, entry, generation, path, image):
+        entry.loading = False
+        if generation != self._generation or path != entry.image_path:
+            return  # Model đã được tạo lại hoặc ô đã chuyển sang ảnh khác
+        if image.isNull():
+            entry.error = "Không thể hiển thị ảnh"
+            self._changed(entry.variant_id)
+            return
+        entry.image_data = None
+        pixmap = QPixmap.fromImage(image)
+        self._pixmaps[entry.variant_id] = pixmap
+        self._pixmap_bytes += self._size_of(pixmap)
+        self._evict()
+        self._changed(entry.variant_id)
+
+    @staticmethod
+    def _size_of(pixmap):
+        return pixmap.width() * pixmap.height() * max(1, pixmap.depth() // 8)
+
+    def _drop_pixmap(self, variant_id):
+        pixmap = self._pixmaps.pop(variant_id, None)
+        if pixmap is not None:
+            self._pixmap_bytes -= self._size_of(pixmap)
+
+    def _evict(self):
+        """Loại pixmap dùng lâu nhất cho tới khi dưới ngân sách bộ nhớ"""
+        while self._pixmap_bytes > self.pixmap_budget and len(self._pixmaps) > 1:
+            variant_id, pixmap = self._pixmaps.popitem(last=False)
+            self._pixmap_bytes -= self._size_of(pixmap)
+
+class ResultDelegate(QStyledItemDelegate):
+    """
+    Vẽ một ô kết quả: tiêu đề, ảnh (hoặc trạng thái) và thanh tiến trình
+    """
+    def sizeHint(self, option, index):
+        return CELL_SIZE
+
+    def paint(self, painter, option, index):
+        painter.save()
+        rect = option.rect.adjusted(5, 5, -5, -5)
+
+        # Khung ô
+        selected = option.state & QStyle.StateFlag.State_Selected
+        painter.setPen(QColor("#4a86e8") if selected else QColor("#cccccc"))
+        painter.setBrush(QColor("#f5f5f5"))
+        painter.drawRoundedRect(rect, 8, 8)
+
+        # Tiêu đề
+        title_rect = QRect(rect.left(), rect.top() + 5, rect.width(), 25)
+        font = painter.font()
+        font.setBold(True)
+        painter.setFont(font)
+        painter.setPen(QColor("black"))
+        painter.drawText(title_rect, Qt.AlignmentFlag.AlignCenter, index.data(Qt.ItemDataRole.DisplayRole))
+
+        # Ảnh hoặc trạng thái
+        image_rect = QRect(rect.left() + 5, title_rect.bottom() + 5, rect.width() - 10,
+                           rect.height() - title_rect.height() - 50)
+        pixmap = index.data(Qt.ItemDataRole.DecorationRole)
+        if pixmap is not None and not pixmap.isNull():
+            target = pixmap.size().scaled(image_rect.size(), Qt.AspectRatioMode.KeepAspectRatio)
+            x = image_rect.left() + (image_rect.width() - target.width()) // 2
+            y = image_rect.top() + (image_rect.height() - target.height()) // 2
+            painter.drawPixmap(QRect(x, y, target.width(), target.height()), pixmap)
+        else:
+            font.setBold(False)
+            painter.setFont(font)
+            painter.drawText(image_rect, Qt.AlignmentFlag.AlignCenter | Qt.TextFlag.TextWordWrap,
+                             index.data(StatusRole) or "Đang tải ảnh...")
+
+        # Thanh tiến trình
+        progress = QStyleOptionProgressBar()
+        progress.rect = QRect(rect.left() + 10, rect.bottom() - 35, rect.width() - 20, 25)
+        progress.minimum = 0
+        progress.maximum = 100
+        progress.progress = index.data(ProgressRole) or 0
+        progress.text = f"{progress.progress}%"
+        progress.textVisible = True
+        progress.state = QStyle.StateFlag.State_Enabled
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawControl(QStyle.ControlElement.CE_ProgressBar, progress, painter)
+
+        painter.restore()
+
+class ResultsView(QListView):
+    """
+    QListView chế độ icon, tự chia cột theo chiều rộng và chỉ vẽ các ô đang hiển thị
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setViewMode(QListView.ViewMode.IconMode)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setMovement(QListView.Movement.Static)
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QListView.LayoutMode.Batched)
+        self.setBatchSize(50)
+        self.setGridSize(CELL_SIZE)
+        self.setSpacing(5)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setItemDelegate(ResultDelegate(self))
@@ -0,0 +1,556 @@
+# service.py
+"""
+Dịch vụ HTTP chạy trên máy (không cần giao diện/màn hình) cho backend cửa hàng.
+
+Nhận ảnh người và ảnh quần áo (upload multipart hoặc đường dẫn trên máy) cùng
+prompt, đưa các biến thể vào cùng pipeline với giao diện (TryOnEngine chạy trên
+WorkerPool) và trả về job_id. Kết quả từng biến thể được lấy bằng cách hỏi định
+kỳ hoặc nghe server-sent events.
+
+    python service.py --port 8090 --concurrency 8
+
+API:
+    POST   /jobs                          tạo job (multipart: person, garment, prompt, variants, want
+                                          hoặc JSON: person_path, garment_path, prompt, variants, want)
+    GET    /jobs/<id>                     trạng thái job và từng biến thể
+    GET    /jobs/<id>/events              server-sent events: "variant" khi một biến thể xong, "done" khi hết
+    GET    /jobs/<id>/variants/<n>/image  ảnh kết quả của biến thể n
+    DELETE /jobs/<id>                     hủy job
+    GET    /health, /metrics              tình trạng dịch vụ, metrics dạng Prometheus
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+from tryon_engine import UPLOAD_FOLDER, OUTPUT_FOLDER, DEFAULT_PROMPT, TryOnJob
+from results_store import ResultStore
+from job_queue import new_batch_id
+from worker_pool import WorkerPool, FirstKBatch
+from catalog import IMAGE_EXTENSIONS, add_engine_arguments, build_engine as catalog_build_engine
+
+DEFAULT_VARIANTS = 1
+# Các job đã xong được giữ lại để hỏi trạng thái trong khoảng thời gian này (giây)
+JOB_TTL = 3600
+# Gửi dòng chú thích SSE định kỳ để proxy không cắt kết nối đang chờ
+SSE_HEARTBEAT = 15.0
+
+class ServiceError(Exception):
+    """Lỗi trả về cho client với mã HTTP tương ứng"""
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Không xóa được {path}: {str(e)}")
+
+class ServiceJob:
+    """
+    Một yêu cầu thử đồ gồm nhiều biến thể. Trạng thái được cập nhật từ luồng của
+    pool; các luồng HTTP đọc bản chụp (snapshot) hoặc chờ sự kiện mới.
+    """
+    def __init__(self, job_id, jobs, want=None, uploads=()):
+        self.job_id = job_id
+        self.jobs = jobs
+        self.want = want
+        # Ảnh upload của job, được xóa khi job kết thúc
+        self.uploads = list(uploads)
+        self.created_at = time.time()
+        self.finished_at = None
+        self.state = "running"
+        self.variants = {job.variant_id: {"variant_id": job.variant_id, "status": "queued", "progress": 0}
+                         for job in jobs}
+        self.events = []
+        self.handles = []
+        self.batch = None
+        self._remaining = len(jobs)
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def set_progress(self, value, variant_id):
+        with self._cond:
+            variant = self.variants.get(variant_id)
+            if variant is not None and variant["status"] in ("queued", "running"):
+                variant["status"] = "running"
+                variant["progress"] = value
+
+    def record(self, variant_id, **fields):
+        """Biến thể kết thúc (thành công, lỗi, bị hủy hoặc bỏ qua): cập nhật và phát sự kiện"""
+        with self._cond:
+            variant = self.variants[variant_id]
+            if variant["status"] not in ("queued", "running"):
+                return
+            variant.update(fields)
+            self.events.append(("variant", dict(variant)))
+            self._remaining -= 1
+            finished = self._remaining <= 0 and self.batch is None and self._finish_locked("done")
+            self._cond.notify_all()
+        if finished:
+            remove_files(self.uploads)
+
+    def mark_cancelled(self):
+        """Đánh dấu bị hủy trước khi hủy các biến thể, để job kết thúc với trạng thái cancelled"""
+        with self._cond:
+            if self.state == "running":
+                self.state = "cancelled"
+
+    def finish(self, state):
+        with self._cond:
+            finished = self._finish_locked(state)
+            self._cond.notify_all()
+        if finished:
+            remove_files(self.uploads)
+
+    def _finish_locked(self, state):
+        """Kết thúc job; trả về False nếu job đã kết thúc từ trước"""
+        if self.finished_at is not None:
+            return False
+        if self.state == "running":
+            self.state = state
+        self.finished_at = time.time()
+        self.events.append(("done", self.snapshot_locked()))
+        return True
+
+    def snapshot(self):
+        with self._cond:
+            return self.snapshot_locked()
+
+    def snapshot_locked(self):
+        variants = [dict(self.variants[key]) for key in sorted(self.variants)]
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "want": self.want,
+            "succeeded": sum(variant["status"] == "done" for variant in variants),
+            "variants": variants,
+        }
+
+    def wait_events(self, index, timeout):
+        """Các sự kiện từ vị trí index (chờ tối đa timeout giây nếu chưa có)"""
+        with self._cond:
+            if index >= len(self.events) and not self.finished:
+                self._cond.wait(timeout)
+            return self.events[index:]
+
+class TryOnService:
+    """
+    Quản lý các ServiceJob trên một TryOnEngine và WorkerPool dùng chung.
+
+    Số job chạy đồng thời do WorkerPool giới hạn; tổng số biến thể đang chờ/chạy
+    không vượt quá max_pending (vượt quá thì từ chối với 503 và Retry-After).
+    """
+    def __init__(self, engine, pool, max_pending=200, max_variants=50, upload_folder=None,
+                 path_root=None, job_ttl=JOB_TTL, allow_any_path=False):
+        self.engine = engine
+        self.pool = pool
+        self.max_pending = max_pending
+        self.max_variants = max_variants
+        self.upload_folder = upload_folder or os.path.join(UPLOAD_FOLDER, 'service')
+        # Ảnh theo đường dẫn chỉ được lấy trong path_root (mặc định thư mục làm việc), để client
+        # không gửi được file bất kỳ trên máy lên API; allow_any_path=True bỏ giới hạn này
+        self.path_root = None if allow_any_path else os.path.realpath(path_root or os.getcwd())
+        self.job_ttl = job_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.upload_folder, exist_ok=True)
+        self._prune_uploads()
+
+    def pending_count(self):
+        """Số biến thể chưa xong của mọi job"""
+        with self._lock:
+            return self._pending_locked()
+
+    def _pending_locked(self):
+        return sum(job._remaining for job in self._jobs.values() if not job.finished)
+
+    def _prune_uploads(self):
+        """Xóa ảnh upload cũ hơn job_ttl còn sót lại (dịch vụ bị tắt khi job đang chạy)"""
+        cutoff = time.time() - self.job_ttl
+        with os.scandir(self.upload_folder) as it:
+            stale = [entry.path for entry in it if entry.is_file() and entry.stat().st_mtime < cutoff]
+        remove_files(stale)
+
+    def save_upload(self, job_id, name, filename, data):
+        """Lưu ảnh upload vào thư mục của dịch vụ, trả về đường dẫn"""
+        if not data:
+            raise ServiceError(400, f"Ảnh {name} rỗng")
+        ext = os.path.splitext(filename or '')[1].lower()
+        if ext not in IMAGE_EXTENSIONS:
+            ext = '.png'
+        path = os.path.join(self.upload_folder, f"{job_id}_{name}{ext}")
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def check_path(self, path, name):
+        """Ảnh theo đường dẫn phải tồn tại và nằm trong path_root (trừ khi allow_any_path)"""
+        if not path:
+            raise ServiceError(400, f"Thiếu ảnh {name}")
+        real = os.path.realpath(path)
+        if self.path_root and os.path.commonpath([real, self.path_root]) != self.path_root:
+            raise ServiceError(403, f"Đường dẫn {name} nằm ngoài thư mục cho phép")
+        if not os.path.isfile(real):
+            raise ServiceError(400, f"Không tìm thấy ảnh {name}: {path}")
+        return real
+
+    def submit(self, job_id, person_path, garment_path, prompt=None, variants=DEFAULT_VARIANTS, want=None,
+               uploads=()):
+        """
+        Tạo ServiceJob và gửi các biến thể vào pool. uploads là các ảnh upload của
+        job, bị xóa khi job kết thúc (hoặc ngay nếu job bị từ chối).
+        """
+        try:
+            return self._submit(job_id, person_path, garment_path, prompt, variants, want, uploads)
+        except BaseException:
+            remove_files(uploads)
+            raise
+
+    def _submit(self, job_id, person_path, garment_path, prompt, variants, want, uploads):
+        if not 1 <= variants <= self.max_variants:
+            raise ServiceError(400, f"variants phải trong khoảng 1-{self.max_variants}")
+        if want is not None and not 1 <= want <= variants:
+            raise ServiceError(400, "want phải trong khoảng 1-variants")
+        self._prune()
+        jobs = [TryOnJob(person_path, garment_path, prompt or DEFAULT_PROMPT, i) for i in range(variants)]
+        service_job = ServiceJob(job_id, jobs, want, uploads)
+        # Kiểm tra và thêm job trong cùng một lần giữ khóa: các POST đồng thời không vượt max_pending
+        with self._lock:
+            pending = self._pending_locked()
+            if pending + variants > self.max_pending:
+                raise ServiceError(503, f"Dịch vụ đang bận ({pending} biến thể đang chờ)", {"Retry-After": "5"})
+            self._jobs[job_id] = service_job
+
+        if want:
+            # Chỉ cần want ảnh tốt: thay biến thể lỗi, hủy phần còn lại khi đủ
+            service_job.batch = FirstKBatch(
+                self.pool, self.engine, jobs, want, min(variants, want + 1),
+                progress=service_job.set_progress,
+                on_done=lambda handle: self._job_done(service_job, handle),
+                on_finished=lambda batch: self._batch_finished(service_job, batch))
+            service_job.batch.start()
+        else:
+            for job in jobs:
+                service_job.handles.append(self.pool.submit(
+                    self.engine, job, service_job.set_progress, lambda handle: self._job_done(service_job, handle)))
+        print(f"Job {job_id}: {variants} biến thể" + (f", cần {want} ảnh tốt" if want else ""))
+        return service_job
+
+    def _job_done(self, service_job, handle):
+        """Được gọi trên luồng của pool khi một biến thể kết thúc"""
+        variant_id = handle.job.variant_id
+        if handle.cancelled():
+            service_job.record(variant_id, status="cancelled")
+            return
+        try:
+            result = handle.result()
+        except Exception as e:
+            service_job.record(variant_id, status="error", error=str(e))
+            return
+        if not result.success:
+            service_job.record(variant_id, status="error", error=result.message, elapsed=round(result.elapsed, 3))
+            return
+        # Chỉ báo xong khi file kết quả đã nằm trên đĩa, client có thể tải ảnh ngay
+        def saved(_):
+            service_job.record(variant_id, status="done", progress=100, result_path=result.image_path,
+                               cached=result.cached, coalesced=result.coalesced,
+                               elapsed=round(result.elapsed, 3))
+        if result.saved is not None:
+            result.saved.add_done_callback(saved)
+        else:
+            saved(None)
+
+    def _batch_finished(self, service_job, batch):
+        for job in batch.skipped:
+            service_job.record(job.variant_id, status="skipped")
+        # Biến thể bị hủy vì đã đủ ảnh được ghi bởi _job_done; chờ các file kết quả ghi xong
+        self.engine.writer.call(service_job.finish, "done")
+
+    def get(self, job_id):
+        with self._lock:
+            service_job = self._jobs.get(job_id)
+        if service_job is None:
+            raise ServiceError(404, f"Không tìm thấy job {job_id}")
+        return service_job
+
+    def cancel(self, job_id):
+        service_job = self.get(job_id)
+        service_job.mark_cancelled()
+        if service_job.batch is not None:
+            service_job.batch.cancel()
+        for handle in service_job.handles:
+            handle.cancel()
+        service_job.finish("cancelled")
+        return service_job
+
+    def _prune(self):
+        """Bỏ các job đã xong quá job_ttl giây"""
+        cutoff = time.time() - self.job_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def health(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            "status": "ok",
+            "jobs": len(jobs),
+            "running_jobs": sum(not job.finished for job in jobs),
+            "pending_variants": sum(job._remaining for job in jobs if not job.finished),
+            "max_pending": self.max_pending,
+            "workers": self.pool.max_workers,
+            "active": self.pool.active_count,
+            "results": self.engine.result_store.stats() if self.engine.result_store is not None else None,
+        }
+
+def parse_multipart(content_type, body):
+    """Tách form multipart/form-data thành (trường text, file {tên: (filename, bytes)})"""
+    from email.parser import BytesParser
+    from email import policy
+    header = f"Content-Type: {content_type}\r\nMIME-Version: 1.0\r\n\r\n".encode('latin-1')
+    message = BytesParser(policy=policy.HTTP).parsebytes(header + body)
+    if not message.is_multipart():
+        raise ServiceError(400, "Body multipart không hợp lệ")
+    fields, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if not name:
+            continue
+        payload = part.get_payload(decode=True) or b""
+        filename = part.get_filename()
+        if filename is not None:
+            files[name] = (filename, payload)
+        else:
+            fields[name] = payload.decode(part.get_content_charset() or 'utf-8')
+    return fields, files
+
+def _int_field(value, name, default=None):
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ServiceError(400, f"{name} phải là số nguyên")
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "TryOnService/1.0"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def _route(self, method):
+        path = urlsplit(self.path).path.rstrip('/') or '/'
+        try:
+            if method == 'GET' and path == '/health':
+                return self._send_json(200, self.service.health())
+            if method == 'GET' and path == '/metrics':
+                return self._send_metrics()
+            if method == 'POST' and path == '/jobs':
+                return self._create_job()
+            match = re.fullmatch(r"/jobs/([\w.-]+)(/events|/variants/(\d+)/image)?", path)
+            if match is None:
+                raise ServiceError(404, "Không tìm thấy")
+            job_id, suffix, variant = match.groups()
+            if method == 'DELETE' and suffix is None:
+                return self._send_json(200, self.service.cancel(job_id).snapshot())
+            if method == 'GET' and suffix is None:
+                return self._send_json(200, self.service.get(job_id).snapshot())
+            if method == 'GET' and suffix == '/events':
+                return self._send_events(self.service.get(job_id))
+            if method == 'GET' and variant is not None:
+                return self._send_image(self.service.get(job_id), int(variant))
+            raise ServiceError(405, "Phương thức không được hỗ trợ")
+        except ServiceError as e:
+            self._send_json(e.status, {"error": str(e)}, e.headers)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.server.max_body:
+            raise ServiceError(413, f"Body vượt quá {self.server.max_body} byte")
+        return self.rfile.read(length)
+
+    def _create_job(self):
+        body = self._read_body()
+        content_type = self.headers.get('Content-Type', '')
+        job_id = new_batch_id('svc')
+        uploads = []
+        if content_type.startswith('multipart/form-data'):
+            fields, files = parse_multipart(content_type, body)
+            paths = {}
+            try:
+                for name in ('person', 'garment'):
+                    if name in files:
+                        paths[name] = self.service.save_upload(job_id, name, *files[name])
+                        uploads.append(paths[name])
+                    else:
+                        paths[name] = self.service.check_path(fields.get(f"{name}_path"), name)
+                variants = _int_field(fields.get('variants'), 'variants', DEFAULT_VARIANTS)
+                want = _int_field(fields.get('want'), 'want')
+            except BaseException:
+                remove_files(uploads)
+                raise
+        else:
+            try:
+                fields = json.loads(body or b"{}")
+            except ValueError:
+                raise ServiceError(400, "Body JSON không hợp lệ")
+            paths = {name: self.service.check_path(fields.get(f"{name}_path"), name)
+                     for name in ('person', 'garment')}
+            variants = _int_field(fields.get('variants'), 'variants', DEFAULT_VARIANTS)
+            want = _int_field(fields.get('want'), 'want')
+        service_job = self.service.submit(job_id, paths['person'], paths['garment'], fields.get('prompt'),
+                                          variants, want, uploads)
+        self._send_json(202, {
+            "job_id": service_job.job_id,
+            "variants": variants,
+            "status_url": f"/jobs/{service_job.job_id}",
+            "events_url": f"/jobs/{service_job.job_id}/events",
+        })
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_metrics(self):
+        telemetry = self.service.engine.telemetry
+        if telemetry is None:
+            raise ServiceError(404, "Metrics không được bật")
+        payload = telemetry.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_image(self, service_job, variant_id):
+        variant = service_job.snapshot()["variants"]
+        if not 0 <= variant_id < len(variant) or variant[variant_id]["status"] != "done":
+            raise ServiceError(404, f"Biến thể {variant_id} chưa có ảnh")
+        with open(variant[variant_id]["result_path"], 'rb') as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, service_job):
+        """Server-sent events: gửi lại các sự kiện đã có rồi chờ sự kiện mới tới khi job xong"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        index = 0
+        try:
+            while True:
+                events = service_job.wait_events(index, SSE_HEARTBEAT)
+                if not events:
+                    self.wfile.write(b": ping\n\n")
+                for name, data in events:
+                    payload = json.dumps(data, ensure_ascii=False)
+                    self.wfile.write(f"event: {name}\ndata: {payload}\n\n".encode('utf-8'))
+                    if name == "done":
+                        self.wfile.flush()
+                        return
+                index += len(events)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client đã đóng kết nối
+
+def build_engine(args):
+    # Kết quả vào kho có giới hạn dung lượng; telemetry luôn bật để phục vụ GET /metrics
+    store = ResultStore(args.output, max_bytes=int(args.results_max_gb * 1024 ** 3))
+    return catalog_build_engine(args, cache_size=64, result_store=store, metrics=True)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Dịch vụ HTTP thử đồ chạy trên máy (không cần giao diện)")
+    parser.add_argument('--host', default='127.0.0.1', help="Địa chỉ lắng nghe (mặc định chỉ trên máy)")
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--max-pending', type=int, default=200,
+                        help="Tổng số biến thể đang chờ/chạy tối đa, vượt quá trả 503")
+    parser.add_argument('--max-variants', type=int, default=50, help="Số biến thể tối đa của một job")
+    parser.add_argument('--max-upload-mb', type=float, default=25, help="Kích thước body tối đa của một request (MB)")
+    parser.add_argument('--path-root',
+                        help="Chỉ nhận ảnh theo đường dẫn nằm trong thư mục này (mặc định thư mục làm việc)")
+    parser.add_argument('--allow-any-path', action='store_true',
+                        help="Nhận ảnh theo đường dẫn bất kỳ trên máy (bỏ giới hạn --path-root)")
+    parser.add_argument('--output', default=os.path.join(OUTPUT_FOLDER, 'service'), help="Thư mục lưu kết quả")
+    parser.add_argument('--results-max-gb', type=float, default=2.0,
+                        help="Ngân sách dung lượng của kho kết quả, kết quả cũ nhất bị dọn khi vượt")
+    add_engine_arguments(parser)
+    return parser
+
+def make_server(args):
+    """Tạo engine, pool và HTTP server (chưa chạy); trả về (server, service)"""
+    engine = build_engine(args)
+    pool = WorkerPool(max_workers=engine.max_concurrency, name='tryon-service-pool')
+    pool.warm_up(engine)
+    engine.result_store.start_evictor()
+    service = TryOnService(engine, pool, max_pending=args.max_pending, max_variants=args.max_variants,
+                           path_root=args.path_root, allow_any_path=args.allow_any_path)
+    server = ThreadingHTTPServer((args.host, args.port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    server.max_body = int(args.max_upload_mb * 1024 * 1024)
+    return server, service
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    server, service = make_server(args)
+    host, port = server.server_address[:2]
+    print(f"Dịch vụ thử đồ đang chạy tại http://{host}:{port} ({service.engine.max_concurrency} biến thể đồng thời)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown()
+        service.engine.flush()
+        service.engine.result_store.close()
+        service.engine.telemetry.close()
+        print("Đã dừng dịch vụ")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
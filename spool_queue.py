@@ -0,0 +1,261 @@
+# spool_queue.py
+"""
+Hàng đợi job trong một thư mục spool dùng chung, cho worker chạy trên nhiều máy.
+
+File SQLite không an toàn khi nhiều máy cùng ghi qua ổ mạng, nhưng đổi tên file
+trong cùng một thư mục thì có tính nguyên tử (kể cả trên NFS/SMB). Mỗi job là một
+file JSON nằm trong thư mục theo trạng thái của nó:
+
+    <spool>/<lô>/pending/<khóa job>.json
+    <spool>/<lô>/running/<khóa job>.json
+    <spool>/<lô>/done/<khóa job>.json
+    <spool>/<lô>/failed/<khóa job>.json
+
+Worker nhận job bằng cách đổi tên file từ pending/ sang running/: chỉ một worker
+đổi tên thành công. mtime của file trong running/ là nhịp tim (touch()); job của
+worker đã chết (quá stale_after giây không có nhịp tim) được recover() đưa về pending/.
+
+SpoolQueue có cùng các phương thức với job_queue.JobQueue mà farm.py dùng.
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+
+from job_queue import JobQueue, job_key, PENDING, RUNNING, DONE, FAILED
+
+_STATES = (PENDING, RUNNING, DONE, FAILED)
+
+def _write_json(path, record):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+class SpoolQueue:
+    """
+    Hàng đợi job trong thư mục spool_dir. id của job là khóa job (chuỗi hex), dùng
+    làm tên file. Dùng được từ nhiều luồng, nhiều tiến trình và nhiều máy cùng lúc.
+    """
+    def __init__(self, spool_dir, max_attempts=3):
+        self.spool_dir = spool_dir
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        # Danh sách file pending đã đọc, để mỗi lần nhận job không phải liệt kê lại thư mục
+        self._candidates = {}
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def close(self):
+        pass
+
+    def _batch_dir(self, batch_id):
+        digest = hashlib.sha256(batch_id.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.spool_dir, digest)
+
+    def _batch_dirs(self, batch_id=None):
+        if batch_id is not None:
+            return [self._batch_dir(batch_id)]
+        return [entry.path for entry in os.scandir(self.spool_dir) if entry.is_dir()]
+
+    def _path(self, batch_dir, state, key):
+        return os.path.join(batch_dir, state, f"{key}.json")
+
+    def _find(self, key):
+        """(thư mục lô, trạng thái) hiện tại của job key, hoặc (None, None)"""
+        for batch_dir in self._batch_dirs():
+            for state in (RUNNING, PENDING, DONE, FAILED):
+                if os.path.exists(self._path(batch_dir, state, key)):
+                    return batch_dir, state
+        return None, None
+
+    def enqueue(self, jobs, batch_id):
+        """Thêm các job vào lô batch_id (bỏ qua job đã có). Trả về danh sách id theo thứ tự jobs"""
+        batch_dir = self._batch_dir(batch_id)
+        for state in _STATES:
+            os.makedirs(os.path.join(batch_dir, state), exist_ok=True)
+        _write_json(os.path.join(batch_dir, 'batch.json'), {"batch_id": batch_id})
+        existing = set()
+        for state in _STATES:
+            existing.update(name[:-5] for name in os.listdir(os.path.join(batch_dir, state)) if name.endswith('.json'))
+        ids = []
+        now = time.time()
+        for job in jobs:
+            key = job_key(batch_id, job)
+            job.job_id = key
+            ids.append(key)
+            if key in existing:
+                continue
+            _write_json(self._path(batch_dir, PENDING, key), {
+                "id": key,
+                "batch_id": batch_id,
+                "person_image_path": job.person_image_path,
+                "clothing_image_path": job.clothing_image_path,
+                "prompt": job.prompt,
+                "variant_id": job.variant_id,
+                "generation_config": json.dumps(job.generation_config),
+                "output_path": job.output_path,
+                "sample": job.sample,
+                "state": PENDING,
+                "attempts": 0,
+                "result_path": None,
+                "message": None,
+                "worker": None,
+                "created_at": now,
+                "updated_at": now,
+            })
+            existing.add(key)
+        return ids
+
+    def recover(self, stale_after=None):
+        """
+        Đưa job đang chạy về pending/: mọi job nếu stale_after là None (không còn
+        worker nào chạy), ngược lại chỉ job không có nhịp tim trong stale_after giây.
+        Trả về số job được khôi phục.
+        """
+        cutoff = None if stale_after is None else time.time() - stale_after
+        recovered = 0
+        for batch_dir in self._batch_dirs():
+            running_dir = os.path.join(batch_dir, RUNNING)
+            if not os.path.isdir(running_dir):
+                continue
+            for entry in os.scandir(running_dir):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    if cutoff is not None and entry.stat().st_mtime >= cutoff:
+                        continue
+                    os.rename(entry.path, os.path.join(batch_dir, PENDING, entry.name))
+                    recovered += 1
+                except FileNotFoundError:
+                    pass  # Job vừa xong hoặc vừa được khôi phục bởi tiến trình khác
+        return recovered
+
+    def claim(self, batch_id=None):
+        """Lấy một job đang chờ và chuyển nó sang running/. Trả về TryOnJob hoặc None nếu hết job"""
+        with self._lock:
+            for batch_dir in self._batch_dirs(batch_id):
+                pending_dir = os.path.join(batch_dir, PENDING)
+                if not os.path.isdir(pending_dir):
+                    continue
+                for _ in range(2):
+                    candidates = self._candidates.get(batch_dir)
+                    if not candidates:
+                        # Đọc lại thư mục một lần khi danh sách cũ đã dùng hết
+                        candidates = self._candidates[batch_dir] = sorted(
+                            name for name in os.listdir(pending_dir) if name.endswith('.json'))
+                    while candidates:
+                        name = candidates.pop(0)
+                        running_path = os.path.join(batch_dir, RUNNING, name)
+                        try:
+                            os.rename(os.path.join(pending_dir, name), running_path)
+                        except FileNotFoundError:
+                            continue  # Worker khác đã nhận job này
+                        record = _read_json(running_path)
+                        record.update(state=RUNNING, attempts=record['attempts'] + 1, worker=self.worker_id,
+                                      updated_at=time.time())
+                        _write_json(running_path, record)
+                        return JobQueue.row_to_job(record)
+        return None
+
+    def iter_claims(self, batch_id=None):
+        """Generator lấy lần lượt các job đang chờ, dùng được trực tiếp với TryOnEngine.run_stream"""
+        while True:
+            job = self.claim(batch_id)
+            if job is None:
+                return
+            yield job
+
+    def touch(self, job_id):
+        """Nhịp tim của job đang chạy, để recover(stale_after) không coi nó là bị bỏ dở"""
+        batch_dir, state = self._find(job_id)
+        if state == RUNNING:
+            try:
+                os.utime(self._path(batch_dir, RUNNING, job_id), None)
+            except FileNotFoundError:
+                pass
+
+    def release(self, job_id):
+        """Trả job đang chạy về pending/ mà không tính là một lần thử (worker dừng giữa chừng)"""
+        batch_dir, state = self._find(job_id)
+        if state != RUNNING:
+            return
+        running_path = self._path(batch_dir, RUNNING, job_id)
+        try:
+            record = _read_json(running_path)
+            record.update(state=PENDING, attempts=max(record['attempts'] - 1, 0), worker=None,
+                          updated_at=time.time())
+            _write_json(running_path, record)
+            os.rename(running_path, self._path(batch_dir, PENDING, job_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, job_id, success, result_path=None, message=None, retry=True):
+        """
+        Ghi kết quả của job. Job lỗi được đưa lại pending/ nếu retry=True và chưa quá
+        max_attempts lần thử.
+        """
+        batch_dir, current = self._find(job_id)
+        if batch_dir is None:
+            return None
+        source = self._path(batch_dir, current, job_id)
+        try:
+            record = _read_json(source)
+        except FileNotFoundError:
+            return None
+        if success:
+            state = DONE
+        elif retry and record['attempts'] < self.max_attempts:
+            state = PENDING
+        else:
+            state = FAILED
+        record.update(state=state, result_path=result_path if success else None, message=message,
+                      updated_at=time.time())
+        _write_json(self._path(batch_dir, state, job_id), record)
+        if state != current:
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+        return state
+
+    def complete_result(self, result):
+        """Ghi một TryOnResult của engine vào hàng đợi"""
+        return self.complete(result.job.job_id, result.success,
+                             result.image_path if result.success else None,
+                             None if result.success else result.message)
+
+    def counts(self, batch_id=None):
+        """Số job theo trạng thái"""
+        counts = {}
+        for batch_dir in self._batch_dirs(batch_id):
+            for state in _STATES:
+                state_dir = os.path.join(batch_dir, state)
+                if os.path.isdir(state_dir):
+                    n = sum(1 for name in os.listdir(state_dir) if name.endswith('.json'))
+                    if n:
+                        counts[state] = counts.get(state, 0) + n
+        return counts
+
+    def batch_jobs(self, batch_id):
+        """Mọi job của lô kèm trạng thái, theo thứ tự variant"""
+        batch_dir = self._batch_dir(batch_id)
+        rows = []
+        for state in _STATES:
+            state_dir = os.path.join(batch_dir, state)
+            if not os.path.isdir(state_dir):
+                continue
+            for name in os.listdir(state_dir):
+                if name.endswith('.json'):
+                    try:
+                        rows.append(_read_json(os.path.join(state_dir, name)))
+                    except (FileNotFoundError, ValueError):
+                        pass  # Job vừa chuyển trạng thái
+        rows.sort(key=lambda row: (row['variant_id'], row['created_at'], row['id']))
+        return rows
@@ -0,0 +1,423 @@
+# sweep.py
+"""
+Sweep biến thể khai báo bằng file spec, thay cho dải nhiệt độ cố định của
+build_generation_config().
+
+Spec là file JSON gồm một hoặc nhiều lưới tham số. Mỗi tham số nhận một giá trị,
+một danh sách giá trị hoặc một khoảng {"start", "stop", "step"} (gồm cả stop):
+
+    {
+        "repeats": 1,
+        "grids": [
+            {"prompt": ["Mặc áo vào người, giữ nguyên nền"],
+             "temperature": {"start": 0.4, "stop": 1.0, "step": 0.2},
+             "top_k": [32, 64], "priority": 1},
+            {"temperature": 0.7, "top_p": [0.9, 1.0], "repeats": 3}
+        ]
+    }
+
+Spec chỉ có một lưới có thể ghi thẳng các khóa của lưới ở cấp ngoài cùng. Lưới
+không có "prompt" dùng prompt mặc định. "repeats" là số mẫu cho mỗi cấu hình.
+
+Bộ lập kế hoạch trải các lưới thành danh sách cấu hình, gộp cấu hình trùng giữa
+các lưới, bỏ qua tổ hợp đã có kết quả trong cache/kho kết quả và sắp xếp phần còn
+lại theo giá trị kỳ vọng: lưới có priority cao trước, mẫu đầu tiên của mọi cấu hình
+trước các mẫu lặp lại, và trong cùng nhóm thì cấu hình nào xa các cấu hình đã chọn
+nhất trong không gian tham số được chạy trước. Nhờ vậy dừng lô ở bất kỳ đâu (hoặc
+--limit) vẫn phủ đều không gian tham số.
+
+    python sweep.py sweep.json --persons models/ --garments garments/ --output sweep_results
+    python sweep.py sweep.json --persons models/ --garments garments/ --dry-run
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import hashlib
+import argparse
+import threading
+
+from tryon_engine import DEFAULT_PROMPT, TryOnJob, build_generation_config
+from catalog import load_image_list, pair_dir_name, build_engine, IndexWriter, CatalogStats, add_engine_arguments
+
+# Tham số generation được phép quét: (kiểu, giá trị nhỏ nhất, giá trị lớn nhất)
+SWEEP_PARAMS = {
+    "temperature": (float, 0.0, 2.0),
+    "top_k": (int, 1, None),
+    "top_p": (float, 0.0, 1.0),
+    "max_output_tokens": (int, 1, None),
+}
+_GRID_KEYS = set(SWEEP_PARAMS) | {"prompt", "priority", "repeats"}
+_SPEC_KEYS = _GRID_KEYS | {"grids"}
+
+# Số mẫu tối đa cho một cấu hình và số cấu hình tối đa của một spec, tránh spec gõ nhầm tạo hàng triệu job
+MAX_REPEATS = 100
+MAX_CONFIGS = 10000
+
+def _normalize(name, value):
+    """Giá trị theo đúng kiểu khai báo trong SWEEP_PARAMS, để 1 và 1.0 là cùng một cấu hình"""
+    kind = SWEEP_PARAMS[name][0]
+    # Làm tròn để 0.1 + 0.2 và 0.3 là cùng một cấu hình (và cùng khóa cache)
+    return int(value) if kind is int else round(float(value), 6)
+
+class SweepConfig:
+    """
+    Một tổ hợp prompt và tham số generation sau khi gộp các lưới. params luôn có đủ
+    mọi tham số của SWEEP_PARAMS (tham số spec không ghi lấy giá trị mặc định của
+    build_generation_config), nên hai lưới cho ra cùng cấu hình thực tế có cùng khóa.
+    """
+    def __init__(self, prompt, params, priority=0, repeats=1):
+        base = build_generation_config(0)
+        self.prompt = prompt
+        self.params = {name: _normalize(name, params.get(name, base[name])) for name in SWEEP_PARAMS}
+        self.priority = priority
+        self.repeats = repeats
+
+    @property
+    def key(self):
+        return (self.prompt, tuple(sorted(self.params.items())))
+
+    def generation_config(self):
+        config = build_generation_config(0)
+        for name, value in self.params.items():
+            # Giữ nguyên giá trị mặc định (vd. top_p = 1) để khóa cache trùng với lần tạo ảnh thường
+            if value != _normalize(name, config[name]):
+                config[name] = value
+        return config
+
+    def label(self, sample):
+        """Tên file ổn định cho một mẫu của cấu hình, không đổi khi spec thêm bớt cấu hình khác"""
+        payload = json.dumps([self.prompt, self.params], sort_keys=True)
+        return f"{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]}_s{sample}"
+
+    def __repr__(self):
+        return f"SweepConfig({self.prompt[:20]!r}, {self.params}, priority={self.priority}, repeats={self.repeats})"
+
+class SweepPlan:
+    """Kết quả lập kế hoạch: các job cần chạy theo thứ tự và số liệu của từng bước lọc"""
+    def __init__(self, jobs, skipped, configs, expanded, duplicates, deferred=0):
+        self.jobs = jobs
+        # Số job cần chạy bị bỏ lại do giới hạn limit
+        self.deferred = deferred
+        # (job, khóa cache) của các tổ hợp đã có kết quả, không chạy lại
+        self.skipped = skipped
+        self.configs = configs
+        self.expanded = expanded
+        self.duplicates = duplicates
+
+    @property
+    def cached(self):
+        return len(self.skipped)
+
+    def summary(self):
+        return (f"{self.expanded} mẫu từ spec, {self.duplicates} trùng, {len(self.configs)} cấu hình; "
+                f"{self.cached} đã có kết quả, {len(self.jobs)} cần chạy"
+                + (f" ({self.deferred} để lần sau do giới hạn)" if self.deferred else ""))
+
+def _check_value(name, value):
+    kind, low, high = SWEEP_PARAMS[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name}: giá trị phải là số, nhận {value!r}")
+    if kind is int and value != int(value):
+        raise ValueError(f"{name}: giá trị phải là số nguyên, nhận {value!r}")
+    value = _normalize(name, value)
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise ValueError(f"{name}: {value} nằm ngoài khoảng [{low}, {high if high is not None else '∞'}]")
+    return value
+
+def _axis_values(name, spec):
+    """Các giá trị của một trục: số, danh sách hoặc khoảng {start, stop, step}"""
+    if isinstance(spec, dict):
+        unknown = set(spec) - {"start", "stop", "step"}
+        if unknown or not {"start", "stop", "step"} <= set(spec):
+            raise ValueError(f"{name}: khoảng phải có đúng các khóa start, stop, step")
+        start, stop, step = _check_value(name, spec["start"]), _check_value(name, spec["stop"]), spec["step"]
+        if isinstance(step, bool) or not isinstance(step, (int, float)) or step <= 0:
+            raise ValueError(f"{name}: step phải là số dương")
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        if count < 1:
+            raise ValueError(f"{name}: stop nhỏ hơn start")
+        if count > MAX_CONFIGS:
+            raise ValueError(f"{name}: khoảng có quá nhiều giá trị ({count})")
+        return [_check_value(name, start + i * step) for i in range(count)]
+    values = spec if isinstance(spec, list) else [spec]
+    if not values:
+        raise ValueError(f"{name}: danh sách giá trị rỗng")
+    return [_check_value(name, value) for value in values]
+
+def _int_option(grid, name, default, low, high):
+    value = grid.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+        raise ValueError(f"{name} phải là số nguyên trong khoảng [{low}, {high}]")
+    return value
+
+def parse_spec(spec, default_prompt=DEFAULT_PROMPT):
+    """
+    Kiểm tra spec (dict đã đọc từ JSON) và trải các lưới thành danh sách
+    SweepConfig theo thứ tự khai báo (có thể trùng nhau). Spec sai báo ValueError.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("Spec phải là một object JSON")
+    unknown = set(spec) - _SPEC_KEYS
+    if unknown:
+        raise ValueError(f"Khóa không hợp lệ trong spec: {', '.join(sorted(unknown))}")
+    default_repeats = _int_option(spec, "repeats", 1, 1, MAX_REPEATS)
+    if "grids" in spec:
+        grids = spec["grids"]
+        if set(spec) - {"grids", "repeats"}:
+            raise ValueError("Spec có 'grids' chỉ được có thêm khóa 'repeats'")
+        if not isinstance(grids, list) or not grids:
+            raise ValueError("'grids' phải là danh sách lưới không rỗng")
+    else:
+        grids = [{k: v for k, v in spec.items() if k != "repeats"}]
+
+    expanded = []
+    for number, grid in enumerate(grids, 1):
+        if not isinstance(grid, dict):
+            raise ValueError(f"Lưới {number} phải là một object JSON")
+        unknown = set(grid) - _GRID_KEYS
+        if unknown:
+            raise ValueError(f"Lưới {number}: khóa không hợp lệ {', '.join(sorted(unknown))}")
+        priority = _int_option(grid, "priority", 0, -1000, 1000)
+        repeats = _int_option(grid, "repeats", default_repeats, 1, MAX_REPEATS)
+        prompts = grid.get("prompt", default_prompt)
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        if not prompts or not all(isinstance(p, str) and p.strip() for p in prompts):
+            raise ValueError(f"Lưới {number}: prompt phải là chuỗi không rỗng hoặc danh sách chuỗi")
+        try:
+            axes = [(name, _axis_values(name, grid[name])) for name in SWEEP_PARAMS if name in grid]
+        except ValueError as e:
+            raise ValueError(f"Lưới {number}: {e}") from None
+        combos = [{}]
+        for name, values in axes:
+            combos = [dict(combo, **{name: value}) for combo in combos for value in values]
+            if len(combos) * len(prompts) > MAX_CONFIGS:
+                raise ValueError(f"Lưới {number} có quá {MAX_CONFIGS} cấu hình")
+        for prompt in prompts:
+            for params in combos:
+                expanded.append(SweepConfig(prompt, params, priority, repeats))
+    return expanded
+
+def load_spec(path, default_prompt=DEFAULT_PROMPT):
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_spec(json.load(f), default_prompt)
+
+def merge_configs(expanded):
+    """
+    Gộp cấu hình trùng giữa các lưới theo cấu hình thực tế gửi lên API (giữ priority
+    và số mẫu lớn nhất). Trả về (danh sách cấu hình theo thứ tự xuất hiện đầu tiên,
+    số mẫu bị gộp)
+    """
+    merged = {}
+    for config in expanded:
+        existing = merged.get(config.key)
+        if existing is None:
+            merged[config.key] = SweepConfig(config.prompt, config.params, config.priority, config.repeats)
+        else:
+            existing.priority = max(existing.priority, config.priority)
+            existing.repeats = max(existing.repeats, config.repeats)
+    configs = list(merged.values())
+    duplicates = sum(c.repeats for c in expanded) - sum(c.repeats for c in configs)
+    return configs, duplicates
+
+def _coordinates(configs):
+    """Tọa độ chuẩn hóa về [0, 1] của từng cấu hình; prompt là một trục phân loại"""
+    names = sorted(SWEEP_PARAMS)
+    ranges = {}
+    for name in names:
+        values = [config.params[name] for config in configs]
+        ranges[name] = (min(values), max(values) - min(values))
+    coordinates = []
+    for config in configs:
+        point = [(config.params[name] - ranges[name][0]) / ranges[name][1]
+                 if ranges[name][1] else 0.0 for name in names]
+        coordinates.append((config.prompt, point))
+    return coordinates
+
+def _distance(a, b):
+    distance = 0.0 if a[0] == b[0] else 1.0
+    return distance + sum((x - y) ** 2 for x, y in zip(a[1], b[1]))
+
+def coverage_order(configs):
+    """
+    Sắp xếp tham lam theo điểm xa nhất: cấu hình đầu tiên trong spec đi trước, mỗi
+    cấu hình tiếp theo là cấu hình xa nhất so với các cấu hình đã chọn. k cấu hình
+    đầu tiên vì vậy phủ không gian tham số đều nhất có thể.
+    """
+    if len(configs) <= 2:
+        return list(configs)
+    points = _coordinates(configs)
+    remaining = list(range(1, len(configs)))
+    nearest = {i: _distance(points[i], points[0]) for i in remaining}
+    order = [0]
+    while remaining:
+        # Hòa thì giữ thứ tự khai báo
+        best = max(remaining, key=lambda i: (nearest[i], -i))
+        remaining.remove(best)
+        order.append(best)
+        for i in remaining:
+            nearest[i] = min(nearest[i], _distance(points[i], points[best]))
+    return [configs[i] for i in order]
+
+def ordered_samples(configs):
+    """(cấu hình, số thứ tự mẫu) theo giá trị kỳ vọng giảm dần"""
+    ordered = []
+    for priority in sorted({config.priority for config in configs}, reverse=True):
+        group = coverage_order([config for config in configs if config.priority == priority])
+        for sample in range(max(config.repeats for config in group)):
+            ordered.extend((config, sample) for config in group if sample < config.repeats)
+    return ordered
+
+def is_cached(engine, job):
+    """(đã có kết quả?, khóa cache) của job theo cache kết quả và kho kết quả của engine"""
+    if engine.result_cache is None and engine.result_store is None:
+        return False, None
+    key = engine.plan_cache_key(job)
+    if engine.result_cache is not None and engine.result_cache.contains(key):
+        return True, key
+    if engine.result_store is not None:
+        for row in engine.result_store.query(cache_key=key, limit=5):
+            if os.path.exists(row['path']):
+                return True, key
+    return False, key
+
+def plan_sweep(expanded, pairs, engine=None, include_cached=False, output_dir=None, limit=None):
+    """
+    Lập kế hoạch sweep cho các cặp (ảnh người, ảnh quần áo). Mỗi cấu hình được
+    chạy cho mọi cặp trước khi sang cấu hình kế tiếp. variant_id của job là vị trí
+    của nó trong các job cần chạy của cùng cặp; job.sample giữ số thứ tự mẫu để khóa
+    cache không phụ thuộc vào vị trí đó. Có engine thì bỏ qua tổ hợp đã có kết quả
+    (trừ khi include_cached). Có output_dir thì mỗi job có đường dẫn kết quả riêng
+    <output_dir>/<thư mục cặp>/<nhãn cấu hình>.png (xem catalog.pair_dir_name);
+    hai job trùng đường dẫn kết quả báo ValueError.
+    """
+    configs, duplicates = merge_configs(expanded)
+    jobs, skipped = [], []
+    deferred = 0
+    next_variant = {pair: 0 for pair in pairs}
+    output_paths = set()
+    for config, sample in ordered_samples(configs):
+        for person, garment in pairs:
+            output_path = None
+            if output_dir is not None:
+                output_path = os.path.join(output_dir, pair_dir_name(person, garment), f"{config.label(sample)}.png")
+                if output_path in output_paths:
+                    raise ValueError(f"Hai job cùng ghi vào {output_path} (cặp ảnh bị lặp?)")
+                output_paths.add(output_path)
+            job = TryOnJob(person, garment, config.prompt, next_variant[(person, garment)],
+                           config.generation_config(), output_path=output_path, sample=sample)
+            if engine is not None and not include_cached:
+                cached, key = is_cached(engine, job)
+                if cached:
+                    skipped.append((job, key))
+                    continue
+            if limit is not None and len(jobs) >= limit:
+                deferred += 1
+                continue
+            next_variant[(person, garment)] += 1
+            jobs.append(job)
+    expanded_count = sum(config.repeats for config in expanded) * len(pairs)
+    return SweepPlan(jobs, skipped, configs, expanded_count, duplicates * len(pairs), deferred)
+
+def write_manifest(path, plan):
+    """Ghi kế hoạch (JSONL): mỗi dòng một tổ hợp, cần chạy hoặc đã có kết quả"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        rows = [(job, "planned", None) for job in plan.jobs] + [(job, "cached", key) for job, key in plan.skipped]
+        for job, status, key in rows:
+            f.write(json.dumps({
+                "person": job.person_image_path,
+                "garment": job.clothing_image_path,
+                "variant": job.variant_id if status == "planned" else None,
+                "sample": job.sample,
+                "prompt": job.prompt,
+                "generation_config": job.generation_config,
+                "output_path": job.output_path,
+                "status": status,
+                "cache_key": key,
+            }, ensure_ascii=False) + "\n")
+
+def run_sweep(args):
+    try:
+        expanded = load_spec(args.spec, args.prompt)
+    except (OSError, ValueError) as e:
+        print(f"Spec không hợp lệ: {e}")
+        return 1
+    persons = load_image_list(args.persons)
+    garments = load_image_list(args.garments)
+    # Bỏ cặp trùng (cùng ảnh xuất hiện hai lần trong danh sách), chúng sẽ ghi cùng file kết quả
+    pairs = list(dict.fromkeys((os.path.abspath(person), os.path.abspath(garment))
+                               for person in persons for garment in garments))
+    if not pairs:
+        print("Không có cặp ảnh nào để xử lý")
+        return 1
+
+    engine = build_engine(args, cache_size=max(32, len(garments) + 1))
+    plan = plan_sweep(expanded, pairs, engine, include_cached=args.include_cached, output_dir=args.output,
+                      limit=args.limit)
+    manifest = os.path.join(args.output, 'plan.jsonl')
+    write_manifest(manifest, plan)
+    print(f"Sweep: {len(pairs)} cặp ảnh - {plan.summary()}")
+    print(f"Kế hoạch: {manifest}")
+    if args.dry_run or not plan.jobs:
+        engine.flush()
+        return 0
+
+    index = IndexWriter(args.index or os.path.join(args.output, 'index.jsonl'))
+    stats = CatalogStats(len(plan.jobs))
+    record_lock = threading.Lock()
+
+    def record(result):
+        if result.saved is not None and result.saved.exception() is not None:
+            result.success = False
+            result.message = f"Không ghi được file kết quả: {result.saved.exception()}"
+        with record_lock:
+            stats.add(result)
+            index.write(result)
+            if stats.done % args.report_every == 0 or stats.done == stats.total:
+                print(f"[{time.strftime('%H:%M:%S')}] {stats.summary()}")
+
+    def on_result(result):
+        if result.saved is not None:
+            result.saved.add_done_callback(lambda _: record(result))
+        else:
+            record(result)
+
+    try:
+        # Không cần hàng đợi bền vững: chạy lại cùng lệnh bỏ qua các tổ hợp đã có trong cache
+        asyncio.run(engine.run_stream(iter(plan.jobs), on_result))
+    except KeyboardInterrupt:
+        print("Đã dừng theo yêu cầu người dùng")
+    finally:
+        engine.flush()
+        index.close()
+        if engine.telemetry is not None:
+            engine.telemetry.close()
+    print(f"Hoàn tất: {stats.summary()}")
+    print(f"Chỉ mục kết quả: {index.path}")
+    return 0 if stats.failed == 0 else 2
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Chạy sweep biến thể theo file spec JSON")
+    parser.add_argument('spec', help="File spec JSON mô tả các lưới prompt và tham số generation")
+    parser.add_argument('--persons', required=True, help="Thư mục hoặc file manifest ảnh người")
+    parser.add_argument('--garments', required=True, help="Thư mục hoặc file manifest ảnh quần áo")
+    parser.add_argument('--output', default='sweep_results', help="Thư mục lưu kết quả và kế hoạch")
+    parser.add_argument('--index', help="File chỉ mục .jsonl hoặc .csv (mặc định <output>/index.jsonl)")
+    parser.add_argument('--prompt', default=DEFAULT_PROMPT, help="Prompt cho lưới không có khóa 'prompt'")
+    parser.add_argument('--limit', type=int, help="Chỉ chạy N job có giá trị kỳ vọng cao nhất")
+    parser.add_argument('--include-cached', action='store_true',
+                        help="Chạy cả tổ hợp đã có kết quả (lấy lại từ cache, ghi vào thư mục output)")
+    parser.add_argument('--dry-run', action='store_true', help="Chỉ lập và ghi kế hoạch, không chạy")
+    parser.add_argument('--report-every', type=int, default=50, help="In tiến độ sau mỗi N biến thể")
+    add_engine_arguments(parser)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return run_sweep(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
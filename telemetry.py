@@ -0,0 +1,244 @@
+# telemetry.py
+"""
+Đo thời gian từng bước của mỗi biến thể và xuất ra trace/metrics.
+
+TryOnEngine ghi thời gian các bước (chuẩn bị ảnh, tra cache, cấu hình SDK, tạo
+mô hình, chờ rate limiter, gọi API, xử lý phản hồi, ghi file) vào
+TryOnResult.timings. Telemetry nhận mỗi kết quả đã xong, ghi một dòng vào file
+trace JSONL và cộng vào các histogram dạng Prometheus, có thể xuất ra file text
+hoặc phục vụ qua HTTP tại /metrics.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Các bước theo thứ tự chạy
+STAGES = ("prepare", "cache_lookup", "configure", "model_init", "limiter_wait", "generate", "parse", "write")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class StageTimer:
+    """Cộng dồn thời gian theo tên bước cho một job (một bước có thể chạy nhiều lần, ví dụ khi thử lại)"""
+    def __init__(self):
+        self.timings = {}
+        self.upload_bytes = 0
+        # True nếu đã gửi request dự phòng (hedging.HedgePolicy) cho job này
+        self.hedged = False
+
+    def add(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+class TraceWriter:
+    """Ghi mỗi kết quả thành một dòng JSON, an toàn khi gọi từ nhiều luồng"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    Histogram thời gian từng bước và bộ đếm kết quả, xuất theo định dạng text của Prometheus
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, rate_limiter=None, hedge_policy=None):
+        self.buckets = buckets
+        self.rate_limiter = rate_limiter
+        self.hedge_policy = hedge_policy
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._latency = _Histogram(buckets)
+        self._results = {"ok": 0, "cached": 0, "coalesced": 0, "error": 0}
+        self._upload_bytes = 0
+        self._output_bytes = 0
+
+    def observe(self, result):
+        status = ("error" if not result.success else "cached" if result.cached
+                  else "coalesced" if result.coalesced else "ok")
+        with self._lock:
+            self._results[status] += 1
+            self._latency.observe(result.elapsed)
+            for stage, seconds in result.timings.items():
+                histogram = self._stages.get(stage)
+                if histogram is None:
+                    histogram = self._stages[stage] = _Histogram(self.buckets)
+                histogram.observe(seconds)
+            self._upload_bytes += result.upload_bytes
+            self._output_bytes += len(result.image_data or b"")
+
+    def _render_histogram(self, lines, name, histogram, labels=""):
+        prefix = labels + "," if labels else ""
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {count}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {histogram.total:.6f}")
+        lines.append(f"{name}_count{suffix} {histogram.count}")
+
+    def render(self):
+        """Toàn bộ metrics dạng text exposition của Prometheus"""
+        lines = []
+        with self._lock:
+            lines.append("# HELP tryon_stage_seconds Thời gian từng bước của một biến thể")
+            lines.append("# TYPE tryon_stage_seconds histogram")
+            ordered = sorted(self._stages, key=lambda stage: (STAGES.index(stage) if stage in STAGES else len(STAGES), stage))
+            for stage in ordered:
+                self._render_histogram(lines, "tryon_stage_seconds", self._stages[stage], f'stage="{stage}"')
+            lines.append("# HELP tryon_variant_seconds Tổng thời gian của một biến thể")
+            lines.append("# TYPE tryon_variant_seconds histogram")
+            self._render_histogram(lines, "tryon_variant_seconds", self._latency)
+            lines.append("# HELP tryon_results_total Số biến thể đã xong theo trạng thái")
+            lines.append("# TYPE tryon_results_total counter")
+            for status, count in self._results.items():
+                lines.append(f'tryon_results_total{{status="{status}"}} {count}')
+            lines.append("# HELP tryon_upload_bytes_total Tổng số byte ảnh đầu vào gửi lên API")
+            lines.append("# TYPE tryon_upload_bytes_total counter")
+            lines.append(f"tryon_upload_bytes_total {self._upload_bytes}")
+            lines.append("# HELP tryon_output_bytes_total Tổng số byte ảnh kết quả nhận về")
+            lines.append("# TYPE tryon_output_bytes_total counter")
+            lines.append(f"tryon_output_bytes_total {self._output_bytes}")
+        if self.rate_limiter is not None:
+            stats = self.rate_limiter.stats()
+            lines.append("# HELP tryon_send_rate Tốc độ gửi hiện tại của rate limiter (request/giây)")
+            lines.append("# TYPE tryon_send_rate gauge")
+            lines.append(f"tryon_send_rate {stats['rate']:.4f}")
+            lines.append("# HELP tryon_rate_limited_total Số lần gặp lỗi quota (429)")
+            lines.append("# TYPE tryon_rate_limited_total counter")
+            lines.append(f"tryon_rate_limited_total {stats['throttled']}")
+            if 'keys' in stats:
+                # Trạng thái từng API key của key_pool.ApiKeyPool (chỉ hiện 4 ký tự cuối)
+                lines.append("# HELP tryon_key_send_rate Tốc độ gửi của từng API key (request/giây)")
+                lines.append("# TYPE tryon_key_send_rate gauge")
+                for key in stats['keys']:
+                    lines.append(f'tryon_key_send_rate{{key="{key["key"]}"}} {key["rate"]:.4f}')
+                lines.append("# HELP tryon_key_benched_seconds Số giây còn lại API key bị tạm ngưng vì quota")
+                lines.append("# TYPE tryon_key_benched_seconds gauge")
+                for key in stats['keys']:
+                    lines.append(f'tryon_key_benched_seconds{{key="{key["key"]}"}} {key["benched_for"]:.1f}')
+                lines.append("# HELP tryon_key_rate_limited_total Số lần từng API key gặp lỗi quota")
+                lines.append("# TYPE tryon_key_rate_limited_total counter")
+                for key in stats['keys']:
+                    lines.append(f'tryon_key_rate_limited_total{{key="{key["key"]}"}} {key["throttled"]}')
+        if self.hedge_policy is not None:
+            stats = self.hedge_policy.stats()
+            lines.append("# HELP tryon_hedge_requests_total Số request dự phòng đã gửi và số lần request dự phòng xong trước")
+            lines.append("# TYPE tryon_hedge_requests_total counter")
+            lines.append(f'tryon_hedge_requests_total{{outcome="sent"}} {stats["hedges"]}')
+            lines.append(f'tryon_hedge_requests_total{{outcome="won"}} {stats["hedge_wins"]}')
+            lines.append(f'tryon_hedge_requests_total{{outcome="denied"}} {stats["denied"]}')
+            lines.append("# HELP tryon_hedge_ratio Tỷ lệ request dự phòng so với số lời gọi chính")
+            lines.append("# TYPE tryon_hedge_ratio gauge")
+            lines.append(f"tryon_hedge_ratio {stats['hedge_rate']:.4f}")
+            if stats["delay"] is not None:
+                lines.append("# HELP tryon_hedge_delay_seconds Ngưỡng độ trễ hiện tại để gửi request dự phòng")
+                lines.append("# TYPE tryon_hedge_delay_seconds gauge")
+                lines.append(f"tryon_hedge_delay_seconds {stats['delay']:.4f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Ghi metrics ra file text (ví dụ cho node_exporter textfile collector)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Phục vụ metrics tại http://host:port/metrics trên luồng nền, trả về server"""
+        # http.server chỉ được import khi cần, không làm chậm lúc khởi động
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='tryon-metrics', daemon=True).start()
+        print(f"Metrics tại http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+class Telemetry:
+    """
+    Điểm nhận kết quả của TryOnEngine: ghi trace JSONL (nếu có trace_path) và cập
+    nhật MetricsRegistry. observe() được gọi khi file kết quả đã ghi xong.
+    """
+    def __init__(self, trace_path=None, registry=None):
+        self.trace = TraceWriter(trace_path) if trace_path else None
+        self.registry = registry or MetricsRegistry()
+
+    def observe(self, result):
+        self.registry.observe(result)
+        if self.trace is not None:
+            self.trace.write(trace_record(result))
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+
+def trace_record(result):
+    job = result.job
+    record = {
+        "ts": time.time(),
+        "job_id": job.job_id,
+        "variant_id": job.variant_id,
+        "person": job.person_image_path,
+        "clothing": job.clothing_image_path,
+        "success": result.success,
+        "cached": result.cached,
+        "coalesced": result.coalesced,
+        "elapsed": round(result.elapsed, 6),
+        "stages": {stage: round(seconds, 6) for stage, seconds in result.timings.items()},
+        "upload_bytes": result.upload_bytes,
+        "hedged": result.hedged,
+        "output_bytes": len(result.image_data or b""),
+    }
+    if result.success:
+        record["result_path"] = result.image_path
+    else:
+        record["error"] = result.message
+    return record
@@ -0,0 +1,44 @@
+# tests/conftest.py
+"""
+Fixture dùng chung cho các test. Mọi test chạy với StubBackend (không gọi mạng)
+và PassthroughPreparer (không cần Pillow), trong thư mục tạm của pytest.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tryon_engine import TryOnEngine, TryOnJob, StubBackend, make_png_bytes
+from image_prep import PassthroughPreparer
+
+def write_png(path, color=(200, 120, 80), size=8):
+    """Ghi một ảnh PNG đơn sắc, tạo thư mục cha nếu cần. Trả về đường dẫn"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(make_png_bytes(size, size, color))
+    return path
+
+@pytest.fixture
+def inputs(tmp_path):
+    """(ảnh người, ảnh quần áo) dùng cho job"""
+    return (write_png(str(tmp_path / "inputs" / "person.png"), (255, 0, 0)),
+            write_png(str(tmp_path / "inputs" / "garment.png"), (0, 0, 255)))
+
+@pytest.fixture
+def make_engine(tmp_path):
+    """Tạo TryOnEngine với StubBackend, kết quả ghi vào thư mục tạm"""
+    def factory(backend=None, **kwargs):
+        kwargs.setdefault('output_folder', str(tmp_path / "results"))
+        kwargs.setdefault('preparer', PassthroughPreparer())
+        return TryOnEngine(backend or StubBackend(), **kwargs)
+    return factory
+
+@pytest.fixture
+def make_jobs(inputs):
+    """Tạo count job biến thể cho cặp ảnh của fixture inputs"""
+    def factory(count):
+        person, garment = inputs
+        return [TryOnJob(person, garment, "test", variant_id=i) for i in range(count)]
+    return factory
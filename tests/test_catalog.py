@@ -0,0 +1,47 @@
+# tests/test_catalog.py
+import os
+
+from catalog import iter_catalog_jobs, pair_dir_name
+from conftest import write_png
+
+def test_jobs_cover_every_pair_and_variant(tmp_path):
+    persons = [write_png(str(tmp_path / "persons" / f"p{i}.png")) for i in range(2)]
+    garments = [write_png(str(tmp_path / "garments" / f"g{i}.png")) for i in range(3)]
+
+    jobs = list(iter_catalog_jobs(persons, garments, 2, str(tmp_path / "out")))
+
+    assert len(jobs) == 2 * 3 * 2
+    assert {(job.person_image_path, job.clothing_image_path, job.variant_id) for job in jobs} == {
+        (p, g, v) for p in persons for g in garments for v in range(2)}
+
+def test_output_paths_unique_for_same_file_names(tmp_path):
+    # Cùng tên file ở hai thư mục khác nhau, và cùng tên gốc khác đuôi
+    persons = [write_png(str(tmp_path / "a" / "1.png")), write_png(str(tmp_path / "b" / "1.png"))]
+    garments = [write_png(str(tmp_path / "g" / "x.png")), write_png(str(tmp_path / "g" / "x.jpg"))]
+
+    jobs = list(iter_catalog_jobs(persons, garments, 2, str(tmp_path / "out")))
+
+    paths = [job.output_path for job in jobs]
+    assert len(jobs) == 8
+    assert len(set(paths)) == len(paths)
+
+def test_paths_are_absolute(tmp_path, monkeypatch):
+    write_png(str(tmp_path / "p.png"))
+    write_png(str(tmp_path / "g.png"))
+    monkeypatch.chdir(tmp_path)
+
+    job, = iter_catalog_jobs(["p.png"], ["g.png"], 1, "out")
+
+    assert job.person_image_path == str(tmp_path / "p.png")
+    assert job.clothing_image_path == str(tmp_path / "g.png")
+    assert job.output_path == os.path.join(str(tmp_path / "out"), pair_dir_name("p.png", "g.png"), "variant_0.png")
+
+def test_duplicate_pairs_are_skipped(tmp_path, monkeypatch):
+    person = write_png(str(tmp_path / "p.png"))
+    garment = write_png(str(tmp_path / "g.png"))
+    monkeypatch.chdir(tmp_path)
+
+    jobs = list(iter_catalog_jobs([person, "p.png"], [garment], 3, "out"))
+
+    assert len(jobs) == 3
+    assert len({job.output_path for job in jobs}) == 3
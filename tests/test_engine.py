@@ -0,0 +1,102 @@
+# tests/test_engine.py
+import os
+import asyncio
+import threading
+
+from tryon_engine import StubBackend
+from result_cache import ResultCache
+
+def test_run_batch_returns_results_in_job_order(make_engine, make_jobs):
+    engine = make_engine(StubBackend(latency=0.01), max_concurrency=3)
+    jobs = make_jobs(6)
+
+    results = engine.run_batch_sync(jobs)
+
+    assert [result.job for result in results] == jobs
+    assert all(result.success for result in results)
+    paths = [result.image_path for result in results]
+    assert len(set(paths)) == len(paths)
+    assert all(os.path.getsize(path) > 0 for path in paths)
+
+def test_run_batch_reports_each_result(make_engine, make_jobs):
+    engine = make_engine()
+    received = []
+
+    engine.run_batch_sync(make_jobs(4), on_result=received.append)
+
+    assert sorted(result.job.variant_id for result in received) == [0, 1, 2, 3]
+
+def test_run_batch_uses_result_cache(tmp_path, make_engine, make_jobs):
+    backend = StubBackend()
+    engine = make_engine(backend, result_cache=ResultCache(str(tmp_path / "cache")))
+
+    engine.run_batch_sync(make_jobs(3))
+    results = engine.run_batch_sync(make_jobs(3))
+
+    assert backend.calls == 3
+    assert all(result.success and result.cached for result in results)
+
+def test_run_batch_cancelled_before_start(make_engine, make_jobs):
+    backend = StubBackend()
+    engine = make_engine(backend)
+    cancel_event = threading.Event()
+    cancel_event.set()
+
+    results = engine.run_batch_sync(make_jobs(3), cancel_event=cancel_event)
+
+    assert results == [None, None, None]
+    assert backend.calls == 0
+
+def test_run_batch_cancelled_midway(make_engine, make_jobs):
+    engine = make_engine(max_concurrency=1)
+    cancel_event = threading.Event()
+
+    results = engine.run_batch_sync(make_jobs(4), on_result=lambda result: cancel_event.set(),
+                                    cancel_event=cancel_event)
+
+    assert results[0].success
+    assert results[1:] == [None, None, None]
+
+def test_run_stream_stops_when_cancelled(make_engine, make_jobs):
+    engine = make_engine(max_concurrency=1)
+    cancel_event = threading.Event()
+    received = []
+
+    def on_result(result):
+        received.append(result)
+        cancel_event.set()
+
+    completed = asyncio.run(engine.run_stream(iter(make_jobs(5)), on_result, cancel_event=cancel_event))
+    engine.flush()
+
+    assert completed == 1
+    assert len(received) == 1
+
+class SlowWarmUpBackend(StubBackend):
+    """Backend có bước khởi động kết nối lâu hơn cả lô"""
+    def __init__(self):
+        super().__init__()
+        self.warm_up_cancelled = False
+
+    async def warm_up_async(self):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            self.warm_up_cancelled = True
+            raise
+
+def test_run_batch_cancels_unfinished_warm_up(make_engine, make_jobs):
+    backend = SlowWarmUpBackend()
+    engine = make_engine(backend)
+
+    async def run():
+        results = await engine.run_batch(make_jobs(2))
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        return results, pending
+
+    results, pending = asyncio.run(run())
+    engine.flush()
+
+    assert all(result.success for result in results)
+    assert backend.warm_up_cancelled
+    assert pending == []
@@ -0,0 +1,62 @@
+# tests/test_job_queue.py
+from job_queue import JobQueue, PENDING, RUNNING, DONE, FAILED
+
+def enqueue(queue, make_jobs, count, batch_id="batch-test"):
+    return queue.enqueue(make_jobs(count), batch_id)
+
+def test_enqueue_ignores_duplicate_jobs(tmp_path, make_jobs):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"))
+    first = queue.enqueue(make_jobs(3), "batch-test")
+    second = queue.enqueue(make_jobs(3), "batch-test")
+
+    assert first == second
+    assert queue.counts() == {PENDING: 3}
+
+def test_recover_requeues_jobs_of_crashed_run(tmp_path, make_jobs):
+    db_path = str(tmp_path / "queue.sqlite3")
+    queue = JobQueue(db_path)
+    ids = enqueue(queue, make_jobs, 3)
+    queue.claim()
+    queue.claim()
+    # Tiến trình bị tắt khi hai job đang chạy
+    queue.close()
+
+    queue = JobQueue(db_path)
+    assert queue.counts() == {PENDING: 1, RUNNING: 2}
+    assert queue.recover() == 2
+    assert queue.counts() == {PENDING: 3}
+    assert [job.job_id for job in queue.iter_claims()] == ids
+
+def test_recover_keeps_jobs_with_recent_heartbeat(tmp_path, make_jobs):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"))
+    enqueue(queue, make_jobs, 1)
+    job = queue.claim()
+    queue.touch(job.job_id)
+
+    assert queue.recover(stale_after=60) == 0
+    assert queue.counts() == {RUNNING: 1}
+    assert queue.recover(stale_after=0) == 1
+
+def test_failed_job_is_retried_until_max_attempts(tmp_path, make_jobs):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"), max_attempts=2)
+    enqueue(queue, make_jobs, 1)
+
+    job = queue.claim()
+    assert queue.complete(job.job_id, False, message="lỗi") == PENDING
+    job = queue.claim()
+    assert queue.complete(job.job_id, False, message="lỗi") == FAILED
+    assert queue.claim() is None
+
+def test_claimed_job_round_trips(tmp_path, make_jobs):
+    queue = JobQueue(str(tmp_path / "queue.sqlite3"))
+    original = make_jobs(2)[1]
+    original.sample = 4
+    queue.enqueue([original], "batch-test")
+
+    job = queue.claim("batch-test")
+    queue.complete(job.job_id, True, result_path="out.png")
+
+    assert (job.person_image_path, job.clothing_image_path, job.variant_id, job.sample) == (
+        original.person_image_path, original.clothing_image_path, 1, 4)
+    assert job.generation_config == original.generation_config
+    assert queue.counts("batch-test") == {DONE: 1}
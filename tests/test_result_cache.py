@@ -0,0 +1,47 @@
+# tests/test_result_cache.py
+import os
+
+from result_cache import ResultCache, EVICT_TARGET
+
+def test_put_and_get(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10000)
+    path = cache.put("a", b"x" * 10)
+
+    assert cache.get("a") == path
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    with open(path, 'rb') as f:
+        assert f.read() == b"x" * 10
+
+def test_evicts_least_recently_used_down_to_low_water_mark(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    for mtime, key in enumerate("abc", 1):
+        os.utime(cache.put(key, b"x" * 300), (mtime, mtime))
+    # "a" cũ nhất nhưng vừa được dùng lại
+    cache.get("a")
+
+    cache.put("d", b"x" * 300)
+
+    assert not cache.contains("b")
+    assert all(cache.contains(key) for key in "acd")
+    assert cache.total_bytes == 900
+    assert cache.total_bytes <= cache.max_bytes * EVICT_TARGET
+
+def test_eviction_leaves_headroom_for_next_writes(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    for mtime, key in enumerate("abcdefghij", 1):
+        os.utime(cache.put(key, b"x" * 100), (mtime, mtime))
+
+    cache.put("k", b"x" * 100)
+
+    assert cache.total_bytes <= cache.max_bytes * EVICT_TARGET
+    assert not cache.contains("a") and not cache.contains("b")
+    assert cache.contains("k")
+
+def test_no_temp_files_left(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    cache.put("a", b"x" * 10)
+    cache.put("a", b"y" * 20)
+
+    assert os.listdir(str(tmp_path)) == ["a.png"]
+    assert cache.total_bytes == 20
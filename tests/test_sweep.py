@@ -0,0 +1,72 @@
+# tests/test_sweep.py
+import pytest
+
+from result_cache import ResultCache
+from sweep import parse_spec, plan_sweep
+from conftest import write_png
+
+def test_grids_merged_on_effective_config(inputs):
+    # top_p = 1.0 là giá trị mặc định nên hai lưới cho ra cùng cấu hình thực tế
+    expanded = parse_spec({"grids": [
+        {"prompt": "test", "temperature": [0.6, 0.8]},
+        {"prompt": "test", "temperature": 0.8, "top_p": 1.0, "repeats": 2},
+    ]})
+
+    plan = plan_sweep(expanded, [inputs])
+
+    assert len(plan.configs) == 2
+    assert plan.duplicates == 1
+    assert len(plan.jobs) == 3
+    keys = [(job.generation_config["temperature"], job.sample) for job in plan.jobs]
+    assert len(set(keys)) == len(keys)
+    assert all(job.generation_config["top_p"] == 1 for job in plan.jobs)
+
+def test_ranges_do_not_produce_float_duplicates(inputs):
+    expanded = parse_spec({"grids": [
+        {"temperature": {"start": 0.1, "stop": 0.3, "step": 0.1}},
+        {"temperature": 0.3},
+    ]})
+
+    plan = plan_sweep(expanded, [inputs])
+
+    assert len(plan.configs) == 3
+    assert plan.duplicates == 1
+
+def test_cached_combinations_are_skipped(tmp_path, inputs, make_engine):
+    engine = make_engine(result_cache=ResultCache(str(tmp_path / "cache")))
+    expanded = parse_spec({"temperature": [0.5, 0.7], "repeats": 2})
+
+    first = plan_sweep(expanded, [inputs], engine=engine)
+    engine.run_batch_sync(first.jobs[:3])
+    second = plan_sweep(expanded, [inputs], engine=engine)
+
+    assert (len(first.jobs), first.cached) == (4, 0)
+    assert (len(second.jobs), second.cached) == (1, 3)
+    assert len(plan_sweep(expanded, [inputs], engine=engine, include_cached=True).jobs) == 4
+
+def test_limit_defers_remaining_jobs(inputs):
+    expanded = parse_spec({"temperature": [0.3, 0.5, 0.7, 0.9]})
+
+    plan = plan_sweep(expanded, [inputs], limit=3)
+
+    assert len(plan.jobs) == 3
+    assert plan.deferred == 1
+    # Cấu hình đầu và cấu hình xa nhất được chạy trước
+    assert [job.generation_config["temperature"] for job in plan.jobs[:2]] == [0.3, 0.9]
+
+def test_output_paths_unique_per_pair(tmp_path):
+    pairs = [(write_png(str(tmp_path / "a" / "1.png")), write_png(str(tmp_path / "g.png"))),
+             (write_png(str(tmp_path / "b" / "1.png")), str(tmp_path / "g.png"))]
+    expanded = parse_spec({"temperature": [0.5, 0.7], "repeats": 2})
+
+    plan = plan_sweep(expanded, pairs, output_dir=str(tmp_path / "out"))
+
+    paths = [job.output_path for job in plan.jobs]
+    assert len(paths) == 8
+    assert len(set(paths)) == len(paths)
+
+def test_duplicate_pairs_rejected(tmp_path, inputs):
+    expanded = parse_spec({"temperature": 0.5})
+
+    with pytest.raises(ValueError):
+        plan_sweep(expanded, [inputs, inputs], output_dir=str(tmp_path / "out"))
@@ -0,0 +1,218 @@
+# thumbnails.py
+"""
+Giải mã và thu nhỏ ảnh xem trước ngoài luồng giao diện.
+
+Ảnh được đọc bằng QImageReader với setScaledSize (bộ giải mã chỉ đọc ở kích thước
+cần hiển thị) trong QThreadPool. Thumbnail đã tạo được cache trong bộ nhớ và trên
+đĩa theo hash nội dung file và kích thước đích, nên giao diện chỉ nhận ảnh sẵn sàng để vẽ.
+Cache trên đĩa bị giới hạn dung lượng, thumbnail ít được dùng nhất (LRU theo mtime) bị xóa trước.
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, QSize, Qt, QBuffer, QByteArray, QIODevice, pyqtSignal
+from PyQt6.QtGui import QImage, QImageReader
+
+from image_prep import file_sha256
+
+THUMBNAIL_CACHE_FOLDER = os.path.join('cache', 'thumbnails')
+DEFAULT_DISK_MAX_BYTES = 128 * 1024 * 1024
+
+class _ThumbnailTask(QRunnable):
+    def __init__(self, loader, path, size, callback, data=None):
+        super().__init__()
+        self.loader = loader
+        self.path = path
+        self.size = size
+        self.callback = callback
+        self.data = data
+
+    def run(self):
+        try:
+            image = self.loader._load(self.path, self.size, self.data)
+        except Exception as e:
+            print(f"Không thể tạo ảnh xem trước cho {self.path}: {str(e)}")
+            image = QImage()
+        self.loader._image_ready.emit(self.callback, self.path, image)
+
+class ThumbnailLoader(QObject):
+    """
+    Tạo thumbnail trong QThreadPool và trả về QImage trên luồng giao diện.
+
+    load(path, width, height, callback) gọi callback(path, image) trên luồng giao
+    diện; nếu thumbnail đã có trong bộ nhớ thì gọi ngay. Khi truyền data (bytes ảnh
+    vừa nhận từ API), ảnh được giải mã thẳng từ bộ nhớ, không cần file đã có trên đĩa.
+    """
+    _image_ready = pyqtSignal(object, str, QImage)
+
+    def __init__(self, parent=None, cache_dir=THUMBNAIL_CACHE_FOLDER, memory_items=256, max_threads=None,
+                 disk_max_bytes=DEFAULT_DISK_MAX_BYTES):
+        super().__init__(parent)
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.disk_max_bytes = disk_max_bytes
+        # Dung lượng cache đĩa, tính ở lần ghi đầu tiên (trên thread của pool) như result_cache.ResultCache
+        self._disk_bytes = None
+        self._memory = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._pool = QThreadPool(self)
+        if max_threads:
+            self._pool.setMaxThreadCount(max_threads)
+        self._image_ready.connect(self._deliver)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+        if digest is None:
+            digest = file_sha256(path)
+            with self._lock:
+                self._digests[memo_key] = digest
+        return digest
+
+    def _memory_key(self, path, size):
+        """Khóa bộ nhớ theo đường dẫn (kèm mtime) để tra cứu trên luồng giao diện không cần hash file"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, size.width(), size.height())
+
+    def _remember(self, key, image):
+        with self._lock:
+            self._memory[key] = image
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def cached(self, path, width, height):
+        """Thumbnail trong bộ nhớ nếu có, ngược lại None"""
+        key = self._memory_key(path, QSize(width, height))
+        with self._lock:
+            image = self._memory.get(key) if key else None
+            if image is not None:
+                self._memory.move_to_end(key)
+        return image
+
+    def load(self, path, width, height, callback, data=None):
+        """Yêu cầu thumbnail của path vừa khung width × height"""
+        image = self.cached(path, width, height) if data is None else None
+        if image is not None:
+            callback(path, image)
+            return
+        self._pool.start(_ThumbnailTask(self, path, QSize(width, height), callback, data))
+
+    def _disk_path(self, digest, size):
+        return os.path.join(self.cache_dir, f"{digest}_{size.width()}x{size.height()}.png")
+
+    def _disk_entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".png"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _disk_added(self, disk_path):
+        """Cộng thumbnail vừa ghi vào dung lượng cache đĩa và dọn bớt nếu vượt giới hạn"""
+        try:
+            size = os.path.getsize(disk_path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+            else:
+                self._disk_bytes += size
+            if self._disk_bytes <= self.disk_max_bytes:
+                return
+            # Dọn xuống 90% giới hạn để không phải quét thư mục ở mỗi lần ghi tiếp theo
+            target = self.disk_max_bytes * 0.9
+            entries = sorted(self._disk_entries())
+            self._disk_bytes = sum(size for _, _, size in entries)
+            for _, path, size in entries:
+                if self._disk_bytes <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._disk_bytes -= size
+
+    def _load(self, path, size, data=None):
+        """Chạy trên thread của pool: đọc cache đĩa hoặc giải mã ở kích thước thu nhỏ"""
+        if data is not None:
+            memory_key = None
+            digest = hashlib.sha256(data).hexdigest()
+        else:
+            memory_key = self._memory_key(path, size)
+            digest = self._digest(path)
+        disk_path = self._disk_path(digest, size) if self.cache_dir else None
+
+        image = QImage()
+        if disk_path and os.path.exists(disk_path):
+            image = QImage(disk_path)
+            if not image.isNull():
+                try:
+                    # Đánh dấu vừa được dùng cho LRU
+                    os.utime(disk_path, None)
+                except OSError:
+                    pass
+
+        if image.isNull():
+            if data is not None:
+                buffer = QBuffer()
+                buffer.setData(QByteArray(data))
+                buffer.open(QIODevice.OpenModeFlag.ReadOnly)
+                reader = QImageReader(buffer)
+            else:
+                reader = QImageReader(path)
+            reader.setAutoTransform(True)
+            source_size = reader.size()
+            if source_size.isValid():
+                # Giữ tỷ lệ khung hình khi hiển thị
+                target = source_size.scaled(size, Qt.AspectRatioMode.KeepAspectRatio)
+                if target.width() < source_size.width():
+                    reader.setScaledSize(target)
+            image = reader.read()
+            if image.isNull():
+                raise Exception(reader.errorString())
+            if image.width() > size.width() or image.height() > size.height():
+                image = image.scaled(size, Qt.AspectRatioMode.KeepAspectRatio,
+                                     Qt.TransformationMode.SmoothTransformation)
+            if disk_path:
+                self._save_to_disk(image, disk_path)
+
+        if memory_key:
+            self._remember(memory_key, image)
+        return image
+
+    def _save_to_disk(self, image, disk_path):
+        """
+        Ghi ảnh thu nhỏ vào file tạm rồi os.replace() sang disk_path, để luồng khác
+        (hoặc lần chạy sau khi bị ngắt giữa chừng) không bao giờ đọc phải PNG ghi dở.
+        File tạm không có đuôi .png nên không bị tính vào dung lượng cache.
+        """
+        tmp_path = f"{disk_path}.{os.getpid()}.{os.urandom(4).hex()}.tmp"
+        try:
+            if not image.save(tmp_path, "PNG"):
+                raise OSError(f"Không thể ghi ảnh thu nhỏ: {tmp_path}")
+            os.replace(tmp_path, disk_path)
+        except OSError as e:
+            print(f"Lỗi khi lưu ảnh thu nhỏ vào cache: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._disk_added(disk_path)
+
+    def _deliver(self, callback, path, image):
+        callback(path, image)
@@ -0,0 +1,942 @@
+# tryon_engine.py
+"""
+Lõi sinh ảnh thử đồ không phụ thuộc PyQt6.
+
+Dùng được từ giao diện (GeminiThread), từ pipeline catalog hoặc từ test/benchmark
+bằng cách thay backend Gemini bằng StubBackend.
+"""
+import os
+import time
+import asyncio
+import struct
+import zlib
+import threading
+import concurrent.futures
+
+from rate_limiter import AdaptiveRateLimiter, is_rate_limit_error, retry_after_from_error
+from image_prep import ImagePreparer
+from result_cache import make_cache_key
+from result_writer import ResultWriter, write_file_atomic
+from telemetry import StageTimer
+from gemini_client import get_client
+from key_pool import parse_api_keys
+from inflight import InFlightRequests
+
+# Thư mục để lưu ảnh kết quả
+UPLOAD_FOLDER = 'uploads'
+OUTPUT_FOLDER = 'results'
+
+MODEL_NAME = "gemini-2.0-flash-exp-image-generation"
+
+DEFAULT_PROMPT = "Generate a high-quality virtual try-on image showing the person wearing the clothing from the second image. Preserve all facial features, hairstyle, skin tone, body proportions, pose, and background."
+
+def read_api_key_from_file(file_path='api_key.txt'):
+    """Đọc API key từ file api_key.txt (key đầu tiên nếu file có nhiều key, xem key_pool.read_api_keys)"""
+    try:
+        with open(file_path, 'r') as file:
+            keys = parse_api_keys(file.read())
+            return keys[0] if keys else None
+    except FileNotFoundError:
+        print(f"Không tìm thấy file {file_path}")
+        return None
+    except Exception as e:
+        print(f"Lỗi khi đọc file API key: {str(e)}")
+        return None
+
+# Kích thước ảnh kết quả ước lượng ban đầu (byte), được cập nhật theo các kết quả thực tế
+EXPECTED_OUTPUT_BYTES = 1024 * 1024
+
+# Số mức nhiệt độ khác nhau; lô lớn hơn sẽ lặp lại các mức từ đầu để nhiệt độ không vượt quá 2.0
+TEMPERATURE_STEPS = 30
+
+def build_generation_config(variant_id):
+    """Cấu hình generation với nhiệt độ biến đổi theo variant_id"""
+    return {
+        "response_modalities": ["TEXT", "IMAGE"],
+        "temperature": 0.4 + (variant_id % TEMPERATURE_STEPS) * 0.05,  # Tăng dần độ sáng tạo
+        "top_k": 32,
+        "top_p": 1,
+        "max_output_tokens": 2048,
+    }
+
+class JobCancelled(Exception):
+    """Công việc bị hủy giữa chừng"""
+
+class TryOnJob:
+    """
+    Một yêu cầu thử đồ: ảnh người, ảnh quần áo, prompt và cấu hình generation
+    """
+    def __init__(self, person_image_path, clothing_image_path, prompt, variant_id=0, generation_config=None,
+                 output_path=None, job_id=None, sample=None):
+        self.person_image_path = person_image_path
+        self.clothing_image_path = clothing_image_path
+        self.prompt = prompt or DEFAULT_PROMPT
+        self.variant_id = variant_id
+        self.generation_config = generation_config or build_generation_config(variant_id)
+        # Đường dẫn lưu kết quả cố định (tùy chọn), mặc định lưu vào output_folder của engine
+        self.output_path = output_path
+        # id của job trong hàng đợi bền vững (job_queue.JobQueue), nếu có
+        self.job_id = job_id
+        # Số thứ tự mẫu trong cùng prompt và cấu hình, dùng cho khóa cache thay cho variant_id
+        # (sweep.py: variant_id chỉ là vị trí trong lô, đổi khi spec đổi); None = dùng variant_id
+        self.sample = sample
+
+    @property
+    def cache_variant(self):
+        return self.variant_id if self.sample is None else self.sample
+
+    def __repr__(self):
+        return (f"TryOnJob({self.person_image_path!r}, {self.clothing_image_path!r}, "
+                f"variant_id={self.variant_id})")
+
+class TryOnResult:
+    """
+    Kết quả của một TryOnJob. Khi success=False, message chứa thông báo lỗi
+    """
+    def __init__(self, job, success, image_path=None, message=None, elapsed=0.0, cached=False,
+                 image_data=None, saved=None, coalesced=False):
+        self.job = job
+        self.success = success
+        self.image_path = image_path
+        self.message = message if message is not None else image_path
+        self.elapsed = elapsed
+        # True nếu ảnh được lấy từ cache kết quả, không gọi API
+        self.cached = cached
+        # True nếu dùng chung kết quả của một request giống hệt đang chạy (inflight.InFlightRequests)
+        self.coalesced = coalesced
+        # Bytes ảnh trong bộ nhớ để hiển thị ngay, không cần đọc lại file
+        self.image_data = image_data
+        # Future của thao tác ghi file image_path (đang chạy nền)
+        self.saved = saved
+        # Thời gian từng bước (giây), xem telemetry.STAGES; "write" có sau khi saved xong
+        self.timings = {}
+        # Tổng số byte ảnh đầu vào gửi lên API
+        self.upload_bytes = 0
+        # True nếu đã gửi request dự phòng cho job này (xem hedging.HedgePolicy)
+        self.hedged = False
+
+    def wait_saved(self, timeout=None):
+        """Chờ tới khi image_path đã được ghi xuống đĩa"""
+        if self.saved is not None:
+            self.saved.result(timeout)
+        return self.image_path
+
+    def __repr__(self):
+        status = "ok" if self.success else "error"
+        return f"TryOnResult(variant_id={self.job.variant_id}, {status}, {self.message!r})"
+
+class GeminiBackend:
+    """
+    Backend gọi API Gemini thật. google.generativeai chỉ được import khi cần,
+    để engine dùng được với StubBackend mà không cần SDK.
+
+    Client và mô hình được dùng chung trong cả tiến trình cho mỗi API key
+    (gemini_client.get_client), nên mọi backend/engine cùng key dùng chung kết nối.
+    request_timeout giới hạn thời gian của mỗi lời gọi HTTP để request treo không giữ worker mãi.
+
+    endpoint (tùy chọn, ví dụ http://127.0.0.1:8089) chuyển SDK sang REST và gửi
+    request tới server đó thay vì API thật; dùng cho benchmark với mock_gemini.
+    """
+    name = "gemini"
+
+    def __init__(self, api_key, model_name=MODEL_NAME, request_timeout=120, endpoint=None):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.request_timeout = request_timeout
+        self.endpoint = endpoint
+        self.client = get_client(api_key, endpoint)
+        self._key_backends = {}
+        self._lock = threading.Lock()
+
+    def for_key(self, api_key):
+        """Backend cùng cấu hình nhưng gọi API bằng key khác (key do key_pool.ApiKeyPool chọn)"""
+        if api_key is None or api_key == self.api_key:
+            return self
+        with self._lock:
+            backend = self._key_backends.get(api_key)
+            if backend is None:
+                backend = self._key_backends[api_key] = GeminiBackend(
+                    api_key, self.model_name, self.request_timeout, self.endpoint)
+            return backend
+
+    def create_model(self, timings=None):
+        """
+        Mô hình Gemini dùng chung của API key (tạo ở lần gọi đầu). Nếu truyền dict
+        timings, thời gian "configure" (import SDK, tạo client) và "model_init" được ghi vào đó.
+        """
+        return self.client.model(self.model_name, timings)
+
+    def warm_up(self):
+        """Tạo client và mở sẵn kết nối tới API trước job đầu tiên"""
+        self.client.warm_up(self.model_name)
+
+    async def warm_up_async(self):
+        if self.endpoint:
+            await asyncio.get_running_loop().run_in_executor(None, self.warm_up)
+        else:
+            await self.client.warm_up_async(self.model_name)
+
+    def _contents(self, job, images):
+        return [job.prompt, *(image.as_part() for image in images)]
+
+    def generate(self, model, job, images):
+        """Gọi API với các ảnh đã chuẩn bị, trả về danh sách các part trong phản hồi"""
+        response = model.generate_content(
+            self._contents(job, images),
+            generation_config=job.generation_config,
+            request_options={"timeout": self.request_timeout}
+        )
+        return response.candidates[0].content.parts
+
+    async def generate_async(self, model, job, images):
+        """Như generate() nhưng dùng API bất đồng bộ: hủy task sẽ hủy luôn request đang chạy"""
+        if self.endpoint:
+            # Transport REST của SDK không có client bất đồng bộ, chạy bản đồng bộ trong executor
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.generate, model, job, images)
+        # Client bất đồng bộ gắn với event loop đang chạy
+        model = self.client.async_model(self.model_name)
+        response = await model.generate_content_async(
+            self._contents(job, images),
+            generation_config=job.generation_config,
+            request_options={"timeout": self.request_timeout}
+        )
+        return response.candidates[0].content.parts
+
+    def generate_stream(self, model, job, images):
+        """
+        Như generate() nhưng dùng phản hồi dạng stream: lần lượt trả về danh sách
+        part của từng chunk ngay khi chunk đó về tới
+        """
+        response = model.generate_content(
+            self._contents(job, images),
+            generation_config=job.generation_config,
+            request_options={"timeout": self.request_timeout},
+            stream=True
+        )
+        for chunk in response:
+            if chunk.candidates:
+                yield chunk.candidates[0].content.parts
+
+    async def generate_stream_async(self, model, job, images):
+        """Bản bất đồng bộ của generate_stream()"""
+        if self.endpoint:
+            # Transport REST chỉ có client đồng bộ: đọc từng chunk trong executor
+            loop = asyncio.get_running_loop()
+            chunks = self.generate_stream(model, job, images)
+            try:
+                while True:
+                    parts = await loop.run_in_executor(None, next, chunks, None)
+                    if parts is None:
+                        return
+                    yield parts
+            finally:
+                chunks.close()
+        model = self.client.async_model(self.model_name)
+        response = await model.generate_content_async(
+            self._contents(job, images),
+            generation_config=job.generation_config,
+            request_options={"timeout": self.request_timeout},
+            stream=True
+        )
+        async for chunk in response:
+            if chunk.candidates:
+                yield chunk.candidates[0].content.parts
+
+class _StubPart:
+    def __init__(self, text=None, data=None):
+        self.text = text
+        if data is not None:
+            self.inline_data = _StubInlineData(data)
+
+class _StubInlineData:
+    def __init__(self, data):
+        self.data = data
+        self.mime_type = "image/png"
+
+def make_png_bytes(width=64, height=64, color=(200, 120, 80)):
+    """Tạo ảnh PNG đơn sắc chỉ bằng thư viện chuẩn (dùng cho backend giả lập)"""
+    row = b"\x00" + bytes(color) * width
+    raw = row * height
+
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+class StubBackend:
+    """
+    Backend giả lập thay cho Gemini trong test và benchmark: không gọi mạng,
+    trả về ảnh PNG sau một độ trễ cấu hình được.
+    """
+    name = "stub"
+
+    def __init__(self, latency=0.0, image_size=(64, 64), fail_every=0):
+        self.latency = latency
+        self.image_size = image_size
+        self.fail_every = fail_every
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def create_model(self, timings=None):
+        return None
+
+    def _next_call(self):
+        with self._lock:
+            self.calls += 1
+            return self.calls
+
+    def _parts(self, job, call_no):
+        if self.fail_every and call_no % self.fail_every == 0:
+            return [_StubPart(text="stub: không có ảnh")]
+        width, height = self.image_size
+        shade = (40 + job.variant_id * 20) % 256
+        return [_StubPart(text="stub"), _StubPart(data=make_png_bytes(width, height, (shade, 120, 80)))]
+
+    def generate(self, model, job, images):
+        call_no = self._next_call()
+        if self.latency:
+            time.sleep(self.latency)
+        return self._parts(job, call_no)
+
+    async def generate_async(self, model, job, images):
+        call_no = self._next_call()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._parts(job, call_no)
+
+    def generate_stream(self, model, job, images):
+        """Mỗi part là một chunk, chia đều độ trễ giữa các chunk"""
+        parts = self._parts(job, self._next_call())
+        for part in parts:
+            if self.latency:
+                time.sleep(self.latency / len(parts))
+            yield [part]
+
+    async def generate_stream_async(self, model, job, images):
+        parts = self._parts(job, self._next_call())
+        for part in parts:
+            if self.latency:
+                await asyncio.sleep(self.latency / len(parts))
+            yield [part]
+
+def _image_data(part):
+    """Bytes ảnh của một part trong phản hồi, None nếu part không chứa ảnh"""
+    # Part dạng proto luôn có trường inline_data; với part text, trường này rỗng
+    inline_data = getattr(part, 'inline_data', None)
+    return (getattr(inline_data, 'data', None) or None) if inline_data else None
+
+def _parts_size(parts):
+    """Số byte nội dung (ảnh và text) của các part trong một chunk"""
+    return sum(len(_image_data(part) or b"") + len(getattr(part, 'text', None) or "") for part in parts)
+
+class TryOnEngine:
+    """
+    Chạy các TryOnJob với một backend có thể thay thế.
+
+    generate() chạy đồng bộ một job (dùng trong QThread), generate_async() là bản
+    asyncio có thể hủy giữa chừng (dùng bởi worker_pool.WorkerPool). run_batch()
+    và run_stream() chạy nhiều job cùng lúc với giới hạn max_concurrency.
+    """
+    def __init__(self, backend, max_concurrency=4, output_folder=OUTPUT_FOLDER, rate_limiter=None,
+                 max_rate_limit_retries=3, preparer=None, result_cache=None, force_regenerate=False,
+                 writer=None, telemetry=None, hedge_policy=None, stream=True, coalesce=True, result_store=None):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.output_folder = output_folder
+        # Limiter dùng chung cho mọi job của engine, thay cho việc chờ cố định giữa các request;
+        # có thể là key_pool.ApiKeyPool để chia request cho nhiều API key
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self.max_rate_limit_retries = max_rate_limit_retries
+        # Ảnh đầu vào được chuẩn bị một lần và dùng chung cho mọi biến thể
+        self.preparer = preparer or ImagePreparer()
+        # Cache kết quả (tùy chọn); force_regenerate=True bỏ qua cache nhưng vẫn cập nhật nó
+        self.result_cache = result_cache
+        self.force_regenerate = force_regenerate
+        # File kết quả được ghi ở luồng nền, worker trả bytes ảnh ngay
+        self.writer = writer or ResultWriter()
+        # telemetry.Telemetry (tùy chọn) nhận mỗi kết quả kèm thời gian từng bước
+        self.telemetry = telemetry
+        # hedging.HedgePolicy (tùy chọn): gửi request dự phòng khi lời gọi API chậm bất thường,
+        # chỉ áp dụng cho generate_async() vì cần hủy được request thua
+        self.hedge_policy = hedge_policy
+        # Dùng phản hồi dạng stream nếu backend hỗ trợ: tiến trình theo số byte đã nhận và
+        # kết quả được trả ngay khi part ảnh về tới, không chờ hết phản hồi
+        self.stream = stream
+        # Ước lượng kích thước ảnh kết quả để quy số byte đã nhận ra tiến trình
+        self._expected_output_bytes = EXPECTED_OUTPUT_BYTES
+        # Khóa các trạng thái dùng chung giữa luồng ghi, executor và event loop
+        self._lock = threading.Lock()
+        # Job giống hệt một job đang gọi API (cùng khóa nội dung) chờ và dùng chung kết quả của nó
+        self.inflight = InFlightRequests() if coalesce else None
+        # results_store.ResultStore (tùy chọn): kết quả được lưu vào thư mục shard của kho và ghi
+        # vào chỉ mục theo đầu vào; job có output_path riêng không thuộc kho
+        self.result_store = result_store
+        os.makedirs(self.output_folder, exist_ok=True)
+
+    def generate(self, job, progress=None, is_cancelled=None, force_regenerate=None):
+        """
+        Chạy một job và trả về TryOnResult. progress(value, variant_id) nhận các
+        mốc tiến trình; is_cancelled() được kiểm tra giữa các bước.
+        """
+        start = time.perf_counter()
+        timer = StageTimer()
+        progress = progress or (lambda value, variant_id: None)
+        is_cancelled = is_cancelled or (lambda: False)
+
+        def checkpoint(value=None):
+            if is_cancelled():
+                raise JobCancelled()
+            if value is not None:
+                progress(value, job.variant_id)
+
+        try:
+            checkpoint(10)
+            with timer.stage("prepare"):
+                images = self.prepare_images(job)
+
+            checkpoint(30)
+            cache_key, cached = self._lookup_cache(job, images, force_regenerate, start, timer)
+            if cached:
+                checkpoint(100)
+                return self._report(cached, timer)
+
+            key, flight, leader = self._join_flight(job, images, cache_key)
+            if not leader:
+                checkpoint(60)
+                data = self._wait_flight(flight, is_cancelled)
+                if data is not None:
+                    checkpoint(100)
+                    return self._report(self._shared_result(job, images, data, start, timer), timer)
+
+            shared = None
+            try:
+                model = self.backend.create_model(timer.timings)
+
+                checkpoint(50)
+                checkpoint(60)
+
+                parts = self._generate_with_limiter(model, job, images, is_cancelled, timer,
+                                                    self._chunk_progress(job, checkpoint))
+
+                checkpoint(80)
+                print(f"Xử lý phản hồi từ API cho kết quả {job.variant_id + 1}")
+                result = self._finish(job, images, parts, cache_key, start, checkpoint, timer)
+                shared = result.image_data
+            finally:
+                if leader and flight is not None:
+                    self.inflight.finish(key, flight, shared)
+
+            checkpoint(100)
+            return self._report(result, timer)
+
+        except JobCancelled:
+            raise
+        except Exception as e:
+            if is_cancelled():
+                raise JobCancelled()
+            return self._report(self._failure(job, e, start), timer)
+
+    async def generate_async(self, job, progress=None, force_regenerate=None):
+        """
+        Bản asyncio của generate(). Hủy task (task.cancel()) sẽ dừng job ngay, kể cả
+        khi đang chờ limiter hoặc đang gọi API nếu backend có generate_async().
+        """
+        start = time.perf_counter()
+        timer = StageTimer()
+        progress = progress or (lambda value, variant_id: None)
+        loop = asyncio.get_running_loop()
+
+        try:
+            progress(10, job.variant_id)
+            with timer.stage("prepare"):
+                images = await loop.run_in_executor(None, self.prepare_images, job)
+
+            progress(30, job.variant_id)
+            cache_key, cached = self._lookup_cache(job, images, force_regenerate, start, timer)
+            if cached:
+                progress(100, job.variant_id)
+                return self._report(cached, timer)
+
+            key, flight, leader = self._join_flight(job, images, cache_key)
+            if not leader:
+                progress(60, job.variant_id)
+                # shield: hủy job đang chờ không được hủy request đầu tiên mà các job khác cũng chờ
+                data = await asyncio.shield(asyncio.wrap_future(flight))
+                if data is not None:
+                    progress(100, job.variant_id)
+                    return self._report(self._shared_result(job, images, data, start, timer), timer)
+
+            shared = None
+            try:
+                model = self.backend.create_model(timer.timings)
+
+                progress(50, job.variant_id)
+                progress(60, job.variant_id)
+
+                parts = await self._generate_with_limiter_async(
+                    model, job, images, timer, self._chunk_progress(job, lambda value: progress(value, job.variant_id)))
+
+                progress(80, job.variant_id)
+                print(f"Xử lý phản hồi từ API cho kết quả {job.variant_id + 1}")
+                result = self._finish(job, images, parts, cache_key, start, lambda: None, timer)
+                shared = result.image_data
+            finally:
+                if leader and flight is not None:
+                    self.inflight.finish(key, flight, shared)
+
+            progress(100, job.variant_id)
+            return self._report(result, timer)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return self._report(self._failure(job, e, start), timer)
+
+    def _failure(self, job, error, start):
+        import traceback
+        traceback.print_exception(type(error), error, error.__traceback__)
+        return TryOnResult(job, False, message=str(error), elapsed=time.perf_counter() - start)
+
+    def _lookup_cache(self, job, images, force_regenerate, start, timer):
+        """Trả về (cache_key, TryOnResult từ cache hoặc None)"""
+        # Byte ảnh gửi lên API nếu không có trong cache
+        timer.upload_bytes = sum(len(image.data) for image in images)
+        if self.result_cache is None:
+            return None, None
+        if force_regenerate is None:
+            force_regenerate = self.force_regenerate
+        with timer.stage("cache_lookup"):
+            cache_key = self.cache_key(job, images)
+            cached_path = None if force_regenerate else self.result_cache.get(cache_key)
+            if not cached_path:
+                return cache_key, None
+            # Trả kết quả ngay từ cache, không gọi API
+            with open(cached_path, 'rb') as f:
+                data = f.read()
+        timer.upload_bytes = 0
+        result_image_path, saved = self._save(job, images, data, timer, cache_key)
+        print(f"Lấy kết quả {job.variant_id + 1} từ cache: {result_image_path}")
+        return cache_key, TryOnResult(job, True, result_image_path, elapsed=time.perf_counter() - start,
+                                      cached=True, image_data=data, saved=saved)
+
+    def _join_flight(self, job, images, cache_key):
+        """
+        Trả về (khóa, future, True nếu job này phải tự gọi API). Khi tắt gộp request
+        luôn trả về (None, None, True).
+        """
+        if self.inflight is None:
+            return None, None, True
+        key = cache_key or self.cache_key(job, images)
+        future, leader = self.inflight.join(key)
+        return key, future, leader
+
+    def _wait_flight(self, future, is_cancelled, poll_interval=0.1):
+        """Chờ request đầu tiên của cùng khóa, trả về bytes ảnh hoặc None nếu nó lỗi"""
+        while True:
+            try:
+                return future.result(poll_interval)
+            except concurrent.futures.TimeoutError:
+                if is_cancelled():
+                    raise JobCancelled()
+
+    def _shared_result(self, job, images, data, start, timer):
+        """Kết quả của job trùng: ghi bytes ảnh của request đầu tiên vào file kết quả riêng"""
+        timer.upload_bytes = 0
+        result_image_path, saved = self._save(job, images, data, timer)
+        print(f"Dùng chung kết quả của request giống hệt đang chạy cho kết quả {job.variant_id + 1}")
+        return TryOnResult(job, True, result_image_path, elapsed=time.perf_counter() - start,
+                           image_data=data, saved=saved, coalesced=True)
+
+    def _finish(self, job, images, parts, cache_key, start, checkpoint, timer):
+        """
+        Lấy ảnh đầu tiên trong phản hồi và trả về TryOnResult kèm bytes ảnh ngay;
+        việc ghi file kết quả và cập nhật cache được xếp vào luồng ghi nền.
+        """
+        with timer.stage("parse"):
+            data = self._first_image_data(job, parts, checkpoint)
+
+        if data is None:
+            raise Exception(f"API không trả về ảnh kết quả nào cho kết quả {job.variant_id + 1}")
+        with self._lock:
+            self._expected_output_bytes = int(0.8 * self._expected_output_bytes + 0.2 * len(data))
+
+        result_image_path, saved = self._save(job, images, data, timer, cache_key)
+        if cache_key:
+            self.writer.call(self.result_cache.put, cache_key, data)
+        return TryOnResult(job, True, result_image_path, elapsed=time.perf_counter() - start,
+                           image_data=data, saved=saved)
+
+    def _save(self, job, images, data, timer, cache_key=None):
+        """
+        Xếp việc ghi file kết quả vào luồng ghi nền (đo thời gian vào bước "write") và
+        ghi nó vào kho kết quả nếu có. Trả về (đường dẫn, Future của việc ghi).
+        """
+        path = self._result_path(job)
+        entry = None
+        if self.result_store is not None and not job.output_path:
+            entry = self.result_entry(job, images, cache_key)
+
+        def write():
+            with timer.stage("write"):
+                write_file_atomic(path, data)
+            if entry is not None:
+                self.result_store.add(path, len(data), entry)
+            return path
+        return path, self.writer.call(write)
+
+    def result_entry(self, job, images, cache_key=None):
+        """Thông tin đầu vào của một kết quả, dùng làm bản ghi trong kho kết quả"""
+        person_image, clothing_image = images
+        return {
+            "person_sha256": person_image.sha256,
+            "clothing_sha256": clothing_image.sha256,
+            "person_image_path": job.person_image_path,
+            "clothing_image_path": job.clothing_image_path,
+            "prompt": job.prompt,
+            "model": getattr(self.backend, 'model_name', self.backend.name),
+            "generation_config": job.generation_config,
+            "variant_id": job.variant_id,
+            "cache_key": cache_key or self.cache_key(job, images),
+        }
+
+    def _report(self, result, timer):
+        """Gắn thời gian các bước vào kết quả và chuyển cho telemetry khi file đã ghi xong"""
+        result.timings = timer.timings
+        result.upload_bytes = timer.upload_bytes
+        result.hedged = timer.hedged
+        if self.telemetry is not None:
+            if result.saved is not None:
+                result.saved.add_done_callback(lambda _: self.telemetry.observe(result))
+            else:
+                self.telemetry.observe(result)
+        return result
+
+    def warm_up(self):
+        """
+        Khởi động trước backend (import SDK, tạo client, mở kết nối) để biến thể đầu
+        tiên của lô không phải trả chi phí này. Lỗi chỉ được in ra, không ảnh hưởng job.
+        """
+        for backend in self._key_backends():
+            if hasattr(backend, 'warm_up'):
+                try:
+                    backend.warm_up()
+                except Exception as e:
+                    print(f"Không thể khởi động trước kết nối tới API: {str(e)}")
+
+    async def warm_up_async(self):
+        """Bản asyncio của warm_up(), khởi động client của event loop đang chạy"""
+        for backend in self._key_backends():
+            if hasattr(backend, 'warm_up_async'):
+                try:
+                    await backend.warm_up_async()
+                except Exception as e:
+                    print(f"Không thể khởi động trước kết nối tới API: {str(e)}")
+
+    def _key_backends(self):
+        """Backend của mọi API key mà limiter có thể chọn"""
+        if not hasattr(self.backend, 'for_key'):
+            return [self.backend]
+        keys = getattr(self.rate_limiter, 'keys', None) or [None]
+        return list(dict.fromkeys(self.backend.for_key(key) for key in keys))
+
+    def _backend_for(self, api_key, model, timer):
+        """Backend và mô hình cho key limiter vừa chọn (None = key của backend)"""
+        if api_key is None or not hasattr(self.backend, 'for_key'):
+            return self.backend, model
+        backend = self.backend.for_key(api_key)
+        if backend is self.backend:
+            return backend, model
+        return backend, backend.create_model(timer.timings)
+
+    def flush(self):
+        """Chờ mọi file kết quả đang ghi nền được ghi xong"""
+        self.writer.flush()
+
+    def prepare_images(self, job):
+        """Ảnh người và ảnh quần áo đã chuẩn bị (lấy từ cache nếu có)"""
+        return (self.preparer.prepare(job.person_image_path),
+                self.preparer.prepare(job.clothing_image_path))
+
+    def cache_key(self, job, images):
+        """Khóa cache kết quả của job, gồm cả hash ảnh đầu vào, generation_config và variant_id"""
+        person_image, clothing_image = images
+        return self._cache_key(job, person_image.sha256, clothing_image.sha256)
+
+    def plan_cache_key(self, job):
+        """Như cache_key() nhưng chỉ cần hash file đầu vào, không chuẩn bị ảnh (dùng khi lập kế hoạch)"""
+        return self._cache_key(job, self.preparer.digest(job.person_image_path),
+                               self.preparer.digest(job.clothing_image_path))
+
+    def _cache_key(self, job, person_sha256, clothing_sha256):
+        model_name = getattr(self.backend, 'model_name', self.backend.name)
+        return make_cache_key(person_sha256, clothing_sha256, job.prompt, model_name, job.generation_config,
+                              job.cache_variant)
+
+    def _result_path(self, job):
+        if job.output_path:
+            return job.output_path
+        if self.result_store is not None:
+            return self.result_store.new_path(job.variant_id)
+        # Thêm hậu tố ngẫu nhiên để hai biến thể xong cùng một giây không ghi đè lên nhau
+        return os.path.join(self.output_folder,
+                            f"result_{job.variant_id}_{int(time.time())}_{os.urandom(4).hex()}.png")
+
+    def _generate_with_limiter(self, model, job, images, is_cancelled, timer, on_chunk=None):
+        """Gọi backend khi limiter cho phép; gặp lỗi quota thì báo limiter và thử lại"""
+        attempt = 0
+        while True:
+            acquired = self.rate_limiter.acquire_key(is_cancelled)
+            if acquired is None:
+                raise JobCancelled()
+            api_key, waited = acquired
+            timer.add("limiter_wait", waited)
+            try:
+                backend, key_model = self._backend_for(api_key, model, timer)
+                with timer.stage("generate"):
+                    parts = self._call_backend(backend, key_model, job, images, is_cancelled, on_chunk)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_rate_limit_retries:
+                    raise
+                attempt += 1
+                self.rate_limiter.on_rate_limited(retry_after_from_error(e), api_key)
+                continue
+            self.rate_limiter.on_success(api_key)
+            return parts
+
+    async def _generate_with_limiter_async(self, model, job, images, timer, on_chunk=None):
+        """Bản asyncio của _generate_with_limiter()"""
+        attempt = 0
+        while True:
+            api_key, waited = await self.rate_limiter.acquire_key_async()
+            timer.add("limiter_wait", waited)
+            try:
+                backend, key_model = self._backend_for(api_key, model, timer)
+                with timer.stage("generate"):
+                    if self.hedge_policy is not None:
+                        parts = await self._generate_hedged(backend, key_model, model, job, images, timer, on_chunk)
+                    else:
+                        parts = await self._call_backend_async(backend, key_model, job, images, on_chunk)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_rate_limit_retries:
+                    raise
+                attempt += 1
+                self.rate_limiter.on_rate_limited(retry_after_from_error(e), api_key)
+                continue
+            self.rate_limiter.on_success(api_key)
+            return parts
+
+    def _chunk_progress(self, job, report):
+        """
+        Hàm nhận tổng số byte đã nhận của phản hồi stream và báo tiến trình 60-79
+        theo kích thước ảnh ước lượng (chỉ tăng, kể cả khi có request dự phòng)
+        """
+        last = [60]
+
+        def on_chunk(received):
+            with self._lock:
+                expected = self._expected_output_bytes
+            value = 60 + int(19 * min(1.0, received / expected))
+            if value > last[0]:
+                last[0] = value
+                report(value)
+        return on_chunk
+
+    def _call_backend(self, backend, model, job, images, is_cancelled=None, on_chunk=None):
+        """
+        Gọi backend. Với stream, các part được gom theo từng chunk và dừng đọc ngay
+        khi nhận được part ảnh đầu tiên; on_chunk(tổng số byte đã nhận) sau mỗi chunk.
+        """
+        if not (self.stream and hasattr(backend, 'generate_stream')):
+            return backend.generate(model, job, images)
+        parts = []
+        received = 0
+        chunks = backend.generate_stream(model, job, images)
+        try:
+            for chunk in chunks:
+                if is_cancelled is not None and is_cancelled():
+                    raise JobCancelled()
+                parts.extend(chunk)
+                received += _parts_size(chunk)
+                if on_chunk is not None:
+                    on_chunk(received)
+                if any(_image_data(part) is not None for part in chunk):
+                    break
+        finally:
+            chunks.close()
+        return parts
+
+    async def _call_backend_async(self, backend, model, job, images, on_chunk=None):
+        if self.stream and hasattr(backend, 'generate_stream_async'):
+            parts = []
+            received = 0
+            chunks = backend.generate_stream_async(model, job, images)
+            try:
+                async for chunk in chunks:
+                    parts.extend(chunk)
+                    received += _parts_size(chunk)
+                    if on_chunk is not None:
+                        on_chunk(received)
+                    if any(_image_data(part) is not None for part in chunk):
+                        break
+            finally:
+                await chunks.aclose()
+            return parts
+        if hasattr(backend, 'generate_async'):
+            return await backend.generate_async(model, job, images)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, backend.generate, model, job, images)
+
+    async def _timed_call(self, backend, model, job, images, on_chunk=None):
+        """Gọi backend và ghi thời gian của lời gọi thành công vào hedge_policy"""
+        start = time.perf_counter()
+        parts = await self._call_backend_async(backend, model, job, images, on_chunk)
+        self.hedge_policy.observe(time.perf_counter() - start)
+        return parts
+
+    async def _generate_hedged(self, backend, model, default_model, job, images, timer, on_chunk=None):
+        """
+        Gọi backend; nếu lời gọi chạy lâu hơn ngưỡng của hedge_policy và limiter còn
+        token ngay thì gửi thêm một request dự phòng (có thể bằng key khác). Kết quả
+        thành công đến trước được dùng, request còn lại bị hủy; chỉ khi mọi request
+        đều lỗi thì lỗi của request chính được trả về.
+        """
+        policy = self.hedge_policy
+        delay = policy.start_primary()
+        primary = asyncio.ensure_future(self._timed_call(backend, model, job, images, on_chunk))
+        tasks = [primary]
+        hedge_key = None
+        try:
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+                if not primary.done() and policy.try_hedge():
+                    acquired = self.rate_limiter.try_acquire_key()
+                    if acquired is None:
+                        # Không gửi dự phòng nếu phải chờ quota
+                        policy.refund_hedge()
+                    else:
+                        hedge_key = acquired[0]
+                        hedge_backend, hedge_model = self._backend_for(hedge_key, default_model, timer)
+                        print(f"Kết quả {job.variant_id + 1} chậm hơn {delay:.1f} giây, gửi request dự phòng")
+                        timer.hedged = True
+                        tasks.append(asyncio.ensure_future(
+                            self._timed_call(hedge_backend, hedge_model, job, images, on_chunk)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is not primary:
+                        self._settle_hedge(task, hedge_key)
+                    if task.exception() is None:
+                        if task is not primary:
+                            policy.on_hedge_won()
+                            print(f"Request dự phòng của kết quả {job.variant_id + 1} xong trước")
+                        return task.result()
+            return primary.result()
+        finally:
+            # Hủy request thua (với transport REST, lời gọi trong executor chạy nốt nhưng kết quả bị bỏ)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _settle_hedge(self, task, api_key):
+        """Báo limiter kết quả của request dự phòng (request chính do vòng thử lại xử lý)"""
+        error = task.exception()
+        if error is None:
+            self.rate_limiter.on_success(api_key)
+        elif is_rate_limit_error(error):
+            self.rate_limiter.on_rate_limited(retry_after_from_error(error), api_key)
+
+    def _first_image_data(self, job, parts, checkpoint):
+        for part in parts:
+            checkpoint()
+
+            # Kiểm tra nếu phần này là text
+            if getattr(part, 'text', None):
+                print(f"Phản hồi văn bản từ API (kết quả {job.variant_id + 1}):", part.text)
+
+            # Kiểm tra nếu phần này là hình ảnh
+            data = _image_data(part)
+            if data is not None:
+                print(f"Tìm thấy dữ liệu hình ảnh cho kết quả {job.variant_id + 1}")
+                return data
+        return None
+
+    async def run_batch(self, jobs, progress=None, on_result=None, cancel_event=None):
+        """
+        Chạy nhiều job cùng lúc, tối đa max_concurrency job một lúc. Trả về danh
+        sách TryOnResult theo đúng thứ tự jobs; job bị hủy trả về None.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        cancel_event = cancel_event or threading.Event()
+
+        async def run_one(job):
+            async with semaphore:
+                if cancel_event.is_set():
+                    return None
+                result = await self.generate_async(job, progress)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        # Chuẩn bị mỗi ảnh đầu vào đúng một lần cho cả lô trước khi chạy các biến thể,
+        # trong lúc đó mở sẵn kết nối tới API (không chờ nếu kết nối chậm)
+        warm_up = asyncio.ensure_future(self.warm_up_async())
+        try:
+            paths = [path for job in jobs for path in (job.person_image_path, job.clothing_image_path)]
+            try:
+                await loop.run_in_executor(None, self.preparer.prepare_many, paths)
+            except Exception as e:
+                # Lỗi sẽ được báo lại theo từng job khi chạy generate_async()
+                print(f"Lỗi khi chuẩn bị ảnh đầu vào: {str(e)}")
+            return await asyncio.gather(*(run_one(job) for job in jobs))
+        finally:
+            await self._end_warm_up(warm_up)
+
+    async def run_stream(self, jobs, on_result, progress=None, cancel_event=None):
+        """
+        Chạy một luồng job (có thể rất dài hoặc là generator) với max_concurrency
+        worker lấy job lần lượt, nên bộ nhớ không tăng theo số job. Mỗi kết quả
+        được chuyển ngay cho on_result(result). Trả về số job đã chạy xong.
+        """
+        cancel_event = cancel_event or threading.Event()
+        job_iter = iter(jobs)
+        completed = 0
+        warm_up = asyncio.ensure_future(self.warm_up_async())
+
+        async def worker():
+            nonlocal completed
+            for job in job_iter:
+                if cancel_event.is_set():
+                    return
+                result = await self.generate_async(job, progress)
+                completed += 1
+                on_result(result)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.max_concurrency)))
+        finally:
+            await self._end_warm_up(warm_up)
+        return completed
+
+    async def _end_warm_up(self, task):
+        """
+        Kết thúc task khởi động trước của một lô: hủy nếu vẫn đang chạy (kết nối chậm)
+        rồi chờ nó dừng hẳn, để task không bị bỏ lại khi event loop đóng.
+        """
+        if not task.done():
+            task.cancel()
+        # asyncio.wait() không nuốt lệnh hủy của chính lô đang chạy
+        await asyncio.wait([task])
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Không thể khởi động trước kết nối tới API: {str(task.exception())}")
+
+    def run_batch_sync(self, jobs, progress=None, on_result=None, cancel_event=None):
+        """Phiên bản đồng bộ của run_batch cho code không dùng asyncio"""
+        results = asyncio.run(self.run_batch(jobs, progress, on_result, cancel_event))
+        self.flush()
+        return results
@@ -0,0 +1,200 @@
+# worker_pool.py
+"""
+Pool worker dùng lâu dài cho giao diện và các client khác.
+
+Thay vì tạo mới 10 QThread và một GenerativeModel cho mỗi lần bấm nút, pool chạy
+một event loop nền duy nhất với số job đồng thời giới hạn. Mỗi job là một task
+asyncio nên hủy job sẽ hủy luôn request HTTP đang chạy và trả lại chỗ trống cho
+pool ngay lập tức, không cần chờ thread kết thúc.
+"""
+import asyncio
+import threading
+
+class JobHandle:
+    """
+    Tham chiếu tới một job đã gửi vào pool
+    """
+    def __init__(self, job, future):
+        self.job = job
+        self.future = future
+
+    def cancel(self):
+        """Hủy job (kể cả khi đang gọi API). Không chặn luồng gọi"""
+        return self.future.cancel()
+
+    def cancelled(self):
+        return self.future.cancelled()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+class WorkerPool:
+    """
+    Chạy engine.generate_async() trên một event loop nền, tối đa max_workers job cùng lúc.
+
+    submit() an toàn khi gọi từ bất kỳ luồng nào (kể cả luồng giao diện) và trả về
+    JobHandle ngay. on_done(handle) được gọi trên luồng của pool khi job kết thúc
+    hoặc bị hủy.
+    """
+    def __init__(self, max_workers=4, name='tryon-worker-pool'):
+        self.max_workers = max_workers
+        self._loop = asyncio.new_event_loop()
+        self._handles = set()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name=name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_workers)
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _run(self, engine, job, progress, force_regenerate):
+        async with self._semaphore:
+            return await engine.generate_async(job, progress, force_regenerate)
+
+    def submit(self, engine, job, progress=None, on_done=None, force_regenerate=None):
+        """Gửi một job vào pool, trả về JobHandle"""
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(engine, job, progress, force_regenerate), self._loop)
+        handle = JobHandle(job, future)
+        with self._lock:
+            self._handles.add(handle)
+
+        def finished(_):
+            with self._lock:
+                self._handles.discard(handle)
+            if on_done is not None:
+                on_done(handle)
+
+        future.add_done_callback(finished)
+        return handle
+
+    def warm_up(self, engine):
+        """Khởi động trước client của engine trên event loop của pool (không chặn luồng gọi)"""
+        return asyncio.run_coroutine_threadsafe(engine.warm_up_async(), self._loop)
+
+    @property
+    def active_count(self):
+        """Số job đang chạy hoặc đang chờ trong pool"""
+        with self._lock:
+            return len(self._handles)
+
+    def cancel_all(self):
+        """Hủy mọi job chưa xong. Trả về số job đã hủy"""
+        with self._lock:
+            handles = list(self._handles)
+        return sum(1 for handle in handles if handle.cancel())
+
+    def shutdown(self, timeout=1.0):
+        """Hủy các job còn lại và dừng event loop nền"""
+        self.cancel_all()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+
+class FirstKBatch:
+    """
+    Chạy một lô trên WorkerPool theo chế độ "K kết quả tốt đầu tiên".
+
+    Tối đa max_in_flight job chạy cùng lúc (lấy lần lượt từ jobs). Job lỗi hoặc
+    không trả về ảnh được thay bằng job kế tiếp; khi đã có want kết quả thành
+    công, mọi job đang chạy bị hủy và các job chưa gửi được bỏ qua (skipped).
+
+    on_submit(job) được gọi khi một job được gửi vào pool, on_done(handle) khi một
+    job kết thúc (kể cả bị hủy) và on_finished(batch) một lần khi cả lô kết thúc.
+    Các callback có thể chạy trên luồng của pool hoặc luồng gọi cancel().
+    """
+    def __init__(self, pool, engine, jobs, want, max_in_flight=None, progress=None, on_done=None,
+                 on_submit=None, on_finished=None, force_regenerate=None):
+        self.pool = pool
+        self.engine = engine
+        self.want = want
+        self.max_in_flight = max_in_flight or want
+        self.progress = progress
+        self.on_done = on_done
+        self.on_submit = on_submit
+        self.on_finished = on_finished
+        self.force_regenerate = force_regenerate
+        self._jobs = iter(jobs)
+        self._running = set()
+        self._lock = threading.RLock()
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.cancelled = []
+        self.skipped = []
+        self.stopped = False
+        self.finished = False
+
+    def start(self):
+        """Gửi max_in_flight job đầu tiên, trả về chính lô này"""
+        with self._lock:
+            self._fill()
+            finished = self._finish_if_done()
+        if finished and self.on_finished is not None:
+            self.on_finished(self)
+        return self
+
+    def cancel(self):
+        """Dừng lô: không gửi thêm job và hủy các job đang chạy"""
+        with self._lock:
+            self.stopped = True
+            running = list(self._running)
+        for handle in running:
+            handle.cancel()
+
+    def _fill(self):
+        """Gửi thêm job cho tới khi đủ max_in_flight (gọi khi đang giữ self._lock)"""
+        while not self.stopped and len(self._running) < self.max_in_flight:
+            job = next(self._jobs, None)
+            if job is None:
+                return
+            self.submitted += 1
+            if self.on_submit is not None:
+                self.on_submit(job)
+            handle = self.pool.submit(self.engine, job, self.progress, self._job_done, self.force_regenerate)
+            self._running.add(handle)
+
+    def _finish_if_done(self):
+        """Gọi khi đang giữ self._lock; True nếu lô vừa kết thúc"""
+        if self.finished or self._running:
+            return False
+        self.finished = True
+        self.skipped = list(self._jobs)
+        return True
+
+    def _job_done(self, handle):
+        success = False
+        if not handle.cancelled():
+            try:
+                success = handle.result().success
+            except Exception:
+                success = False
+        to_cancel = []
+        with self._lock:
+            self._running.discard(handle)
+            if handle.cancelled():
+                self.cancelled.append(handle.job)
+                # Job bị hủy từ bên ngoài (ví dụ đóng ứng dụng) cũng dừng cả lô
+                self.stopped = True
+            elif success:
+                self.succeeded += 1
+                if self.succeeded >= self.want and not self.stopped:
+                    self.stopped = True
+                    to_cancel = list(self._running)
+            else:
+                self.failed += 1
+            self._fill()
+            finished = self._finish_if_done()
+        if self.on_done is not None:
+            self.on_done(handle)
+        for other in to_cancel:
+            other.cancel()
+        if finished and self.on_finished is not None:
+            self.on_finished(self)